@@ -30,6 +30,9 @@ class Actuators : public WithNVMData<ActuatorsNVMData> {
   uint8_t calibrationPinLeft;
   uint8_t calibrationPinRight;
 
+  /// called between steps of a move, e.g. to keep reading the serial port
+  void (*idleCallback)() = []() {};
+
  public:
   Actuators(const uint8_t motorLPins[4], const uint8_t motorRPins[4],
             uint8_t penServoPin, uint8_t calibrationPinLeft,
@@ -121,6 +124,7 @@ class Actuators : public WithNVMData<ActuatorsNVMData> {
 
     int minStepsTaken = 0;
     for (int i = 0; i < abs(steps[biggerIndex]); i++) {
+      idleCallback();
       motors[biggerIndex]->step(sgn(steps[biggerIndex]));
       if (i > minStepsTaken * minStepRate) {
         motors[smallerIndex]->step(sgn(steps[smallerIndex]));
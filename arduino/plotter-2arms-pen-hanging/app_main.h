@@ -10,6 +10,7 @@
 #include "utils.h"
 #include "nvm_manager.h"
 #include "flash_manager.h"
+#include "motion_queue.h"
 
 // wires on pins 2-blue 3-yellow 4-orange 5-pink, same order for right motor
 constexpr uint8_t motorLPins[] {8, 9, 10, 11};
@@ -23,6 +24,38 @@ Actuators actuators{motorLPins, motorRPins, penServoPin, motorLCalibrationSwitch
 
 NVMManager<FlashManager, Actuators> nvmManager;
 
+constexpr uint8_t burstAttempts = 5;
+constexpr unsigned long burstPayloadTimeoutMs = 1000;
+
+MotionQueue<16> motionQueue;
+uint8_t advertisedFree = motionQueue.capacity;  //< free slots last reported to the host
+int16_t nakedSeq = -1;  //< missing frame already reported, not reported again
+
+// binary stream frames, see motion_stream.py
+// host -> device: <sync> <seq> <kind: l|u|d|s> [<left> <right>: int32 LE, 1e-5 degrees, only for l]
+//                 [<rpm>: uint16 LE, only for s] <crc8>
+// device -> host: <sync> <kind: a|n> <seq> <free> <crc8>, replies to binary frames only
+constexpr uint8_t binaryFrameVersion = 1;
+constexpr uint8_t speedFrameVersion = 1;  //< speed changes queued with the moves (s frames)
+constexpr uint8_t frameSync = 0xA5;  //< never sent in the ASCII protocol
+constexpr double angleScale = 100000.0;  //< fixed point units per degree
+constexpr uint8_t maxBinaryFrameLength = 12;
+
+// delta encoded bursts, announced by "burst s<points> d<version>", see motion_stream.py
+// <first point: left, right int32 LE, 1e-5 degrees>
+// [<each further point: left, right int8, 1/deltaScale degrees from the point before>] <crc16: uint16 LE>
+constexpr uint8_t deltaBurstVersion = 1;
+constexpr double deltaScale = 256.0;  //< delta units per degree
+
+uint8_t frameBuffer[maxBinaryFrameLength];
+uint8_t frameLength = 0;  //< bytes of the binary frame being received
+bool binaryReplies = false;  //< format of the last stream frame
+
+String lineBuffer;
+bool lineCorrupted = false;  //< non-ASCII bytes in lineBuffer
+String pendingCommand;  //< regular command, executed once the motion queue is empty
+bool commandPending = false;
+
 void printCurrentAngles() {
   auto angles = actuators.getCurrAngles();
   Serial.print("ok ");
@@ -31,194 +64,457 @@ void printCurrentAngles() {
   Serial.println(String(angles.second, 8));
 }
 
-void setup() {
-  Serial.begin(::baudRate);
-  Serial.setTimeout(10);
+void sendStreamResponse(char kind, uint8_t seq) {
+  if (binaryReplies) {
+    uint8_t response[] = {frameSync, static_cast<uint8_t>(kind), seq, advertisedFree, 0};
+    response[4] = crc8(response, 4);
+    Serial.write(response, sizeof(response));
+    return;
+  }
+  Serial.print(kind);
+  Serial.print(seq);
+  Serial.print(" f");
+  Serial.println(advertisedFree);
+}
 
-  nvmManager.restore<0>(actuators);
-  actuators.init();
-  actuators.setSpeed(200);
+void sendAck() {
+  advertisedFree = motionQueue.free();
+  nakedSeq = -1;
+  sendStreamResponse('a', motionQueue.lastInOrder());
+}
 
+/// asks the host to resend the first missing frame (once, unless forced)
+void sendNak(bool force = false) {
+  if (!force && nakedSeq == motionQueue.firstMissing()) {
+    return;
+  }
+  nakedSeq = motionQueue.firstMissing();
+  advertisedFree = motionQueue.free();
+  sendStreamResponse('n', motionQueue.firstMissing());
+}
 
-  Serial.println("Plotter ready");
+void queueStreamCommand(uint8_t seq, const MotionCommand& command) {
+  switch (motionQueue.put(seq, command)) {
+    case decltype(motionQueue)::Result::DUPLICATE:
+      sendAck();  // the acknowledgement was lost (or the host polls for credits)
+      break;
+    case decltype(motionQueue)::Result::OUT_OF_WINDOW:
+      sendNak(true);
+      break;
+    case decltype(motionQueue)::Result::ACCEPTED:
+      if (static_cast<uint8_t>(motionQueue.firstMissing() - seq - 1) < 128) {
+        sendAck();
+      } else {
+        sendNak();  // received out of order, an earlier frame is missing
+      }
+      break;
+  }
 }
 
-void loop() {
-  if (Serial.available() > 0) {
-    String incomingString = Serial.readStringUntil('\n');
-    if (incomingString.startsWith("setspeed")) {
-      int speed =
-          int(incomingString.substring(String("setSpeed").length() + 1)
-                  .toDouble());  // expecting double for future improvements
-      actuators.setSpeed(speed);
-      Serial.print("s");
-      Serial.println(double(speed), 8);
-
-    }    
-    ////////////////////////////////////////////////////////////////////////////////////////
-    // calibration stuff
-    ////////////////////////////////////////////////////////////////////////////////////////
-    
-    else if (incomingString.startsWith("zeroangles")) {
-      actuators.zeroStepState();
-      Serial.println("Position zeroed");
-
-    } else if (incomingString.startsWith("calautocal")) {
-      // arms need to be level to begin with
-      auto result = actuators.calibrateCalibrate();
-      nvmManager.persist<0>(actuators);
-      Serial.print(result.first, 4);
-      Serial.print(" ");
-      Serial.println(result.second, 4);
-
-    } else if (incomingString.startsWith("getautocaloffs")) {
-      auto offss = actuators.getAutoCalOffsets();
-      Serial.print(String(offss.first, 8));
-      Serial.print(" ");
-      Serial.println(String(offss.second, 8));
-
-    } else if (incomingString.startsWith("autocal")) {
-      auto offss = actuators.getAutoCalOffsets();
-      const double lOffset =
-          getCommandParam<double>(incomingString, "l", offss.first);
-      const double rOffset =
-          getCommandParam<double>(incomingString, "r", offss.second);
-      actuators.setAutoCalibrateOffsets(lOffset, rOffset);
-      actuators.autoCalibrate();
+/// 0 for unknown kinds
+uint8_t binaryFrameLength(uint8_t kind) {
+  switch (kind) {
+    case 'l':
+      return 12;
+    case 'u':
+    case 'd':
+      return 4;
+    case 's':
+      return 6;
+    default:
+      return 0;
+  }
+}
 
-      printCurrentAngles();
+int32_t readInt32LE(const uint8_t* data) {
+  return static_cast<int32_t>(static_cast<uint32_t>(data[0]) | static_cast<uint32_t>(data[1]) << 8 |
+                              static_cast<uint32_t>(data[2]) << 16 | static_cast<uint32_t>(data[3]) << 24);
+}
 
-    }     
-    // else if(incomingString.startsWith("setcurrangles ")){
+void handleBinaryFrame() {
+  binaryReplies = true;
+  if (crc8(frameBuffer, frameLength - 1) != frameBuffer[frameLength - 1]) {
+    sendNak();
+    return;
+  }
+  MotionCommand command{};
+  switch (frameBuffer[2]) {
+    case 'l':
+      command.type = MotionCommand::MOVE;
+      command.lDeg = readInt32LE(frameBuffer + 3) / angleScale;
+      command.rDeg = readInt32LE(frameBuffer + 7) / angleScale;
+      break;
+    case 'u':
+      command.type = MotionCommand::PEN_UP;
+      break;
+    case 'd':
+      command.type = MotionCommand::PEN_DOWN;
+      break;
+    case 's':
+      command.type = MotionCommand::SET_SPEED;
+      command.rpm = static_cast<uint16_t>(frameBuffer[3] | frameBuffer[4] << 8);
+      break;
+  }
+  queueStreamCommand(frameBuffer[1], command);
+}
 
-    //   const double leftAngle = getCommandParam<double>(incomingString, "l",
-    //   motorLeft.getCurrentAngleDeg());
-    //   motorLeft.setCurrentAngleDeg(leftAngle);
-    //   const double rightAngle = getCommandParam<double>(incomingString, "r",
-    //   motorRight.getCurrentAngleDeg());
-    //   motorRight.setCurrentAngleDeg(rightAngle);
-    //   Serial.println("Calibration done");
+/// frame format: "q<seq> <payload> *<crc8 of everything up to the '*', hex>"
+/// payload: "l<left deg> r<right deg>" | "u" (pen up) | "d" (pen down) | "s<rpm>" (speed of the next moves)
+void handleStreamFrame(const String& frame) {
+  binaryReplies = false;
+  const int crcIndex = frame.lastIndexOf('*');
+  const int payloadIndex = frame.indexOf(' ') + 1;
+  if (crcIndex < 0 || payloadIndex <= 0 || payloadIndex >= crcIndex) {
+    sendNak();
+    return;
+  }
+  const uint8_t receivedCrc = strtoul(frame.c_str() + crcIndex + 1, nullptr, 16);
+  if (crc8(reinterpret_cast<const uint8_t*>(frame.c_str()), crcIndex + 1) != receivedCrc) {
+    sendNak();
+    return;
+  }
 
-    // }
-    
-    ////////////////////////////////////////////////////////////////////////////////////////
-    // arm movement stuff
-    ////////////////////////////////////////////////////////////////////////////////////////
+  const uint8_t seq = frame.substring(1, payloadIndex).toInt();
+  MotionCommand command{};
+  switch (frame.charAt(payloadIndex)) {
+    case 'l':
+      command.type = MotionCommand::MOVE;
+      command.lDeg = getCommandParam<double>(frame, "l", 0.0);
+      command.rDeg = getCommandParam<double>(frame, "r", 0.0);
+      break;
+    case 'u':
+      command.type = MotionCommand::PEN_UP;
+      break;
+    case 'd':
+      command.type = MotionCommand::PEN_DOWN;
+      break;
+    case 's':
+      command.type = MotionCommand::SET_SPEED;
+      command.rpm = getCommandParam<long>(frame, "s", 0);
+      break;
+    default:
+      sendNak();
+      return;
+  }
+  queueStreamCommand(seq, command);
+}
 
-    else if (incomingString.startsWith("getcurrangles")) {
-      printCurrentAngles();
+/// reads the available characters; stream frames are handled right away
+/// (even during a move), other commands are kept for loop()
+void pollSerial() {
+  while (!commandPending && Serial.available() > 0) {
+    const uint8_t c = Serial.read();
+    if (frameLength > 0 || c == frameSync) {
+      if (frameLength == 0) {
+        // a partial line here is garbage left over from a corrupted binary frame
+        lineBuffer = "";
+        lineCorrupted = false;
+      }
+      frameBuffer[frameLength++] = c;
+      if (frameLength == 3 && binaryFrameLength(frameBuffer[2]) == 0) {
+        frameLength = 0;  // resynchronizes at the next sync byte
+        binaryReplies = true;
+        sendNak();
+      } else if (frameLength >= 3 && frameLength == binaryFrameLength(frameBuffer[2])) {
+        handleBinaryFrame();
+        frameLength = 0;
+      }
+      continue;
+    }
+    if (c != '\n') {
+      lineCorrupted = lineCorrupted || c >= 0x80;
+      lineBuffer += static_cast<char>(c);
+      continue;
+    }
+    if (lineCorrupted) {
+      // garbage, dropped
+    } else if (lineBuffer.startsWith("q")) {
+      handleStreamFrame(lineBuffer);
+    } else {
+      pendingCommand = lineBuffer;
+      commandPending = true;
+    }
+    lineBuffer = "";
+    lineCorrupted = false;
+  }
+}
 
-    } else if (incomingString.startsWith("saveangles")) {
-      nvmManager.persist<0>(actuators);
-      printCurrentAngles();
+void executeMotionCommand(const MotionCommand& command) {
+  switch (command.type) {
+    case MotionCommand::MOVE:
+      actuators.moveToDegs(command.lDeg, command.rDeg);
+      break;
+    case MotionCommand::PEN_UP:
+      actuators.penUp();
+      break;
+    case MotionCommand::PEN_DOWN:
+      actuators.penDown();
+      break;
+    case MotionCommand::SET_SPEED:
+      if (command.rpm > 0) {  // Stepper::setSpeed divides by it
+        actuators.setSpeed(command.rpm);
+      }
+      break;
+  }
+}
 
-    } else if (incomingString.startsWith("burst")) {
-      Serial.println("entered burst mode");
-      const uint16_t size = getCommandParam<long>(incomingString, "s", 15);
+/// burst payload: <left deg> <left 1/255 deg> <right deg> <right 1/255 deg>
+/// per point, then the sum of the points as 32 bit big endian words
+bool burstIntact(const uint8_t* buffer, uint16_t size) {
+  uint32_t expectedChecksum = static_cast<uint32_t>(buffer[size * 4 + 0]) << 8;
+  expectedChecksum = (expectedChecksum + buffer[size * 4 + 1]) << 8;
+  expectedChecksum = (expectedChecksum + buffer[size * 4 + 2]) << 8;
+  expectedChecksum = expectedChecksum + buffer[size * 4 + 3];
+
+  uint32_t actualChecksum = 0;
+  for (uint16_t i = 0; i < size; i++) {
+    uint32_t temp = static_cast<uint32_t>(buffer[(i + 1) * 4 - 4]) << 8;
+    temp = (temp + buffer[(i + 1) * 4 - 3]) << 8;
+    temp = (temp + buffer[(i + 1) * 4 - 2]) << 8;
+    temp = temp + buffer[(i + 1) * 4 - 1];
+    actualChecksum += temp;
+  }
+  return expectedChecksum == actualChecksum;
+}
 
-      uint8_t buffer[size * 4 + 4];
-      Serial.readBytes(buffer, size * 4 + 4);
+bool deltaBurstIntact(const uint8_t* buffer, uint16_t length) {
+  const uint16_t expectedCrc = buffer[length - 2] | static_cast<uint16_t>(buffer[length - 1]) << 8;
+  return crc16(buffer, length - 2) == expectedCrc;
+}
 
-      uint32_t expectedChecksum = static_cast<uint32_t>(buffer[size * 4 + 0]) << 8;
-      expectedChecksum = (expectedChecksum + buffer[size * 4 + 1]) << 8;
-      expectedChecksum = (expectedChecksum + buffer[size * 4 + 2]) << 8;
-      expectedChecksum = expectedChecksum + buffer[size * 4 + 3];
+/// the offsets are summed in delta units, so rounding errors do not add up
+void executeDeltaBurst(const uint8_t* buffer, uint16_t size) {
+  const double firstL = readInt32LE(buffer) / angleScale;
+  const double firstR = readInt32LE(buffer + 4) / angleScale;
+  actuators.moveToDegs(firstL, firstR);
+
+  int32_t offsetL = 0;
+  int32_t offsetR = 0;
+  for (uint16_t i = 1; i < size; i++) {
+    offsetL += static_cast<int8_t>(buffer[8 + (i - 1) * 2]);
+    offsetR += static_cast<int8_t>(buffer[8 + (i - 1) * 2 + 1]);
+    actuators.moveToDegs(firstL + offsetL / deltaScale, firstR + offsetR / deltaScale);
+  }
+}
 
-      uint32_t actualChecksum = 0;
-      for (uint16_t i = 0; i < size; i++) {
-        uint32_t temp = static_cast<uint32_t>(buffer[(i + 1) * 4 - 4]) << 8;
-        temp = (temp + buffer[(i + 1) * 4 - 3]) << 8;
-        temp = (temp + buffer[(i + 1) * 4 - 2]) << 8;
-        temp = temp + buffer[(i + 1) * 4 - 1];
-        actualChecksum += temp;
-      }
+void setup() {
+  Serial.begin(::baudRate);
+  Serial.setTimeout(10);
+
+  nvmManager.restore<0>(actuators);
+  actuators.init();
+  actuators.setSpeed(200);
+  actuators.idleCallback = pollSerial;
+
+
+  Serial.println("Plotter ready");
+}
 
-      if (expectedChecksum != actualChecksum) {
-        Serial.print("checksum error");
-        return;
+void handleCommand(const String& incomingString) {
+  if (incomingString.startsWith("setspeed")) {
+    int speed =
+        int(incomingString.substring(String("setSpeed").length() + 1)
+                .toDouble());  // expecting double for future improvements
+    actuators.setSpeed(speed);
+    Serial.print("s");
+    Serial.println(double(speed), 8);
+
+  }    
+  ////////////////////////////////////////////////////////////////////////////////////////
+  // calibration stuff
+  ////////////////////////////////////////////////////////////////////////////////////////
+  
+  else if (incomingString.startsWith("zeroangles")) {
+    actuators.zeroStepState();
+    Serial.println("Position zeroed");
+
+  } else if (incomingString.startsWith("calautocal")) {
+    // arms need to be level to begin with
+    auto result = actuators.calibrateCalibrate();
+    nvmManager.persist<0>(actuators);
+    Serial.print(result.first, 4);
+    Serial.print(" ");
+    Serial.println(result.second, 4);
+
+  } else if (incomingString.startsWith("getautocaloffs")) {
+    auto offss = actuators.getAutoCalOffsets();
+    Serial.print(String(offss.first, 8));
+    Serial.print(" ");
+    Serial.println(String(offss.second, 8));
+
+  } else if (incomingString.startsWith("autocal")) {
+    auto offss = actuators.getAutoCalOffsets();
+    const double lOffset =
+        getCommandParam<double>(incomingString, "l", offss.first);
+    const double rOffset =
+        getCommandParam<double>(incomingString, "r", offss.second);
+    actuators.setAutoCalibrateOffsets(lOffset, rOffset);
+    actuators.autoCalibrate();
+
+    printCurrentAngles();
+
+  }     
+  // else if(incomingString.startsWith("setcurrangles ")){
+
+  //   const double leftAngle = getCommandParam<double>(incomingString, "l",
+  //   motorLeft.getCurrentAngleDeg());
+  //   motorLeft.setCurrentAngleDeg(leftAngle);
+  //   const double rightAngle = getCommandParam<double>(incomingString, "r",
+  //   motorRight.getCurrentAngleDeg());
+  //   motorRight.setCurrentAngleDeg(rightAngle);
+  //   Serial.println("Calibration done");
+
+  // }
+  
+  ////////////////////////////////////////////////////////////////////////////////////////
+  // arm movement stuff
+  ////////////////////////////////////////////////////////////////////////////////////////
+
+  else if (incomingString.startsWith("getcurrangles")) {
+    printCurrentAngles();
+
+  } else if (incomingString.startsWith("saveangles")) {
+    nvmManager.persist<0>(actuators);
+    printCurrentAngles();
+
+  } else if (incomingString.startsWith("streaminfo")) {
+    Serial.print("stream q");
+    Serial.print(motionQueue.capacity);
+    Serial.print(" b");
+    Serial.print(binaryFrameVersion);
+    Serial.print(" s");
+    Serial.print(speedFrameVersion);
+    Serial.print(" d");
+    Serial.println(deltaBurstVersion);
+
+  } else if (incomingString.startsWith("burst")) {
+    Serial.println("entered burst mode");
+    const uint16_t size = getCommandParam<long>(incomingString, "s", 15);
+    const bool delta = getCommandParam<long>(incomingString, "d", 0) == deltaBurstVersion;
+    if (delta && size == 0) {  // no first point
+      printCurrentAngles();
+      return;
+    }
+    const uint16_t length = delta ? 8 + (size - 1) * 2 + 2 : size * 4 + 4;
+
+    uint8_t buffer[length];
+    bool intact = false;
+    for (uint8_t attempt = 0; attempt < burstAttempts && !intact; attempt++) {
+      // the host only sends the payload after reading the line above
+      Serial.setTimeout(burstPayloadTimeoutMs);
+      Serial.readBytes(buffer, length);
+      Serial.setTimeout(10);
+
+      intact = delta ? deltaBurstIntact(buffer, length) : burstIntact(buffer, size);
+      if (!intact) {
+        Serial.println("checksum error");  // the host resends the payload
       }
+    }
+    if (!intact) {
+      return;
+    }
 
+    if (delta) {
+      executeDeltaBurst(buffer, size);
+    } else {
       for (uint16_t i = 0; i < size; i++) {
         const double ldegrees = buffer[i * 4] + buffer[i * 4 + 1] / 255.0;
         const double rdegrees = buffer[i * 4 + 2] + buffer[i * 4 + 3] / 255.0;
 
         actuators.moveToDegs(ldegrees, rdegrees);
       }
+    }
 
-      printCurrentAngles();
+    printCurrentAngles();
 
-    } else if (incomingString.startsWith("move ") || incomingString.startsWith("moveto")) {
+  } else if (incomingString.startsWith("move ") || incomingString.startsWith("moveto")) {
 
-      auto currAngles = actuators.getCurrAngles();
-      const double ldegrees =
-          getCommandParam<double>(incomingString, "l", currAngles.first);
-      const double rdegrees =
-          getCommandParam<double>(incomingString, "r", currAngles.second);
+    auto currAngles = actuators.getCurrAngles();
+    const double ldegrees =
+        getCommandParam<double>(incomingString, "l", currAngles.first);
+    const double rdegrees =
+        getCommandParam<double>(incomingString, "r", currAngles.second);
 
-      actuators.moveToDegs(ldegrees, rdegrees);
+    actuators.moveToDegs(ldegrees, rdegrees);
 
-      // return actual angles in degrees (!= requested due to finite stepper
-      // resolution)
-      printCurrentAngles();
+    // return actual angles in degrees (!= requested due to finite stepper
+    // resolution)
+    printCurrentAngles();
 
-    } else if (incomingString.startsWith("moveby")) {
-      const double ldegreesDelta =
-          getCommandParam<double>(incomingString, "l", 0.0);
-      const double rdegreesDelta =
-          getCommandParam<double>(incomingString, "r", 0.0);
+  } else if (incomingString.startsWith("moveby")) {
+    const double ldegreesDelta =
+        getCommandParam<double>(incomingString, "l", 0.0);
+    const double rdegreesDelta =
+        getCommandParam<double>(incomingString, "r", 0.0);
 
-      auto currAngles = actuators.getCurrAngles();    
+    auto currAngles = actuators.getCurrAngles();    
 
-      actuators.moveToDegs(currAngles.first + ldegreesDelta, currAngles.second + rdegreesDelta);
+    actuators.moveToDegs(currAngles.first + ldegreesDelta, currAngles.second + rdegreesDelta);
 
-      // return actual angles in degrees (!= requested due to finite stepper
-      // resolution)
-      printCurrentAngles();
+    // return actual angles in degrees (!= requested due to finite stepper
+    // resolution)
+    printCurrentAngles();
 
-    } 
+  } 
 
-    ////////////////////////////////////////////////////////////////////////////////////////
-    // Pen servo stuff
-    ////////////////////////////////////////////////////////////////////////////////////////
+  ////////////////////////////////////////////////////////////////////////////////////////
+  // Pen servo stuff
+  ////////////////////////////////////////////////////////////////////////////////////////
 
-    else if (incomingString.startsWith("penup")) {
-      actuators.penUp();
-      Serial.println("pen is up");
+  else if (incomingString.startsWith("penup")) {
+    actuators.penUp();
+    Serial.println("pen is up");
 
-    } else if (incomingString.startsWith("pendown")) {
-      actuators.penDown();
-      Serial.println("pen is down");
+  } else if (incomingString.startsWith("pendown")) {
+    actuators.penDown();
+    Serial.println("pen is down");
 
-    }else if (incomingString.startsWith("penset")) {
-      const int16_t angleDeg = getCommandParam<long>(incomingString, "a", -1);
-      if (angleDeg == -1){
-        Serial.println("invalid angle");
-        return;
-      }
-      actuators.setPenServoAngle(angleDeg);
-      Serial.print("servo angle is ");
-      Serial.println(angleDeg);
-
-    } else if (incomingString.startsWith("pensaveasdown")) {
-      actuators.penSetAsDown();
-      nvmManager.persist<0>(actuators);
-      Serial.println("saved");
-
-    } else if (incomingString.startsWith("pengetservoangles")) {
-      Serial.print("up ");
-      Serial.print(actuators.getPenUpAngle());
-      Serial.print(" down ");
-      Serial.println(actuators.getPenDownAngle());
-
-    } else if (incomingString.startsWith("pensaveasup")) {
-      actuators.penSetAsUp();
-      nvmManager.persist<0>(actuators);
-      Serial.println("saved");
+  }else if (incomingString.startsWith("penset")) {
+    const int16_t angleDeg = getCommandParam<long>(incomingString, "a", -1);
+    if (angleDeg == -1){
+      Serial.println("invalid angle");
+      return;
+    }
+    actuators.setPenServoAngle(angleDeg);
+    Serial.print("servo angle is ");
+    Serial.println(angleDeg);
+
+  } else if (incomingString.startsWith("pensaveasdown")) {
+    actuators.penSetAsDown();
+    nvmManager.persist<0>(actuators);
+    Serial.println("saved");
+
+  } else if (incomingString.startsWith("pengetservoangles")) {
+    Serial.print("up ");
+    Serial.print(actuators.getPenUpAngle());
+    Serial.print(" down ");
+    Serial.println(actuators.getPenDownAngle());
+
+  } else if (incomingString.startsWith("pensaveasup")) {
+    actuators.penSetAsUp();
+    nvmManager.persist<0>(actuators);
+    Serial.println("saved");
+
+  } else {
+    Serial.print("Invalid command: ");
+    Serial.println(incomingString);
+  }
+}
 
-    } else {
-      Serial.print("Invalid command: ");
-      Serial.println(incomingString);
+void loop() {
+  pollSerial();
+
+  if (!motionQueue.empty()) {
+    executeMotionCommand(motionQueue.pop());
+    if (advertisedFree == 0) {
+      sendAck();  // the host may be waiting for credits
     }
+    return;
+  }
+
+  if (commandPending) {
+    handleCommand(pendingCommand);
+    commandPending = false;
   }
 }
 
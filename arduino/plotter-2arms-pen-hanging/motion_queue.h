@@ -0,0 +1,70 @@
+#pragma once
+
+#include "utils.h"
+
+/// Queued motion commands received in sequence-numbered stream frames.
+///
+/// Frames are stored in the slot of their sequence number, so frames arriving
+/// after a lost or corrupted one are kept until the missing one is resent.
+/// Commands are only executed in sequence order.
+struct MotionCommand {
+  enum Type : uint8_t { MOVE, PEN_UP, PEN_DOWN, SET_SPEED };
+
+  Type type;
+  double lDeg;
+  double rDeg;
+  uint16_t rpm;  //< SET_SPEED only
+};
+
+template <uint8_t size>
+class MotionQueue {
+  static_assert((size & (size - 1)) == 0 && size <= 128,
+                "slots are indexed by the 8 bit sequence number");
+
+ private:
+  MotionCommand slots[size];
+  bool valid[size] = {};
+
+  uint8_t head = 0;      //< sequence number of the next command to execute
+  uint8_t expected = 0;  //< first sequence number not yet received
+
+ public:
+  static constexpr uint8_t capacity = size;
+
+  enum class Result : uint8_t { ACCEPTED, DUPLICATE, OUT_OF_WINDOW };
+
+  /// sequence numbers are 8 bit, compared within the window of the queue
+  Result put(uint8_t seq, const MotionCommand& command) {
+    const uint8_t aheadOfHead = static_cast<uint8_t>(seq - head);
+    if (static_cast<uint8_t>(expected - seq - 1) < 128) {  // seq < expected
+      return Result::DUPLICATE;
+    }
+    if (aheadOfHead >= size) {
+      return Result::OUT_OF_WINDOW;
+    }
+    slots[seq % size] = command;
+    valid[seq % size] = true;
+    while (static_cast<uint8_t>(expected - head) < size &&
+           valid[expected % size]) {
+      expected++;
+    }
+    return Result::ACCEPTED;
+  }
+
+  bool empty() const { return head == expected; }
+
+  /// number of commands that can be received before the queue is full
+  uint8_t free() const { return size - static_cast<uint8_t>(expected - head); }
+
+  /// last sequence number received in order (cumulative acknowledgement)
+  uint8_t lastInOrder() const { return expected - 1; }
+
+  uint8_t firstMissing() const { return expected; }
+
+  MotionCommand pop() {
+    const MotionCommand command = slots[head % size];
+    valid[head % size] = false;
+    head++;
+    return command;
+  }
+};
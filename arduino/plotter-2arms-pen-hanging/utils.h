@@ -77,4 +77,29 @@ T getCommandParam(const String& str, const String& pattern,
   const double result = toNumber<T>(
       str.substring(patternIndex + pattern.length(), endOfPatternIndex));
   return result;
-}
\ No newline at end of file
+}
+
+/// CRC-8 (polynomial 0x07, initial value 0), used by the stream frames
+uint8_t crc8(const uint8_t* data, size_t length, uint8_t crc = 0) {
+  for (size_t i = 0; i < length; i++) {
+    crc ^= data[i];
+    for (uint8_t bit = 0; bit < 8; bit++) {
+      crc = (crc & 0x80) ? static_cast<uint8_t>((crc << 1) ^ 0x07)
+                         : static_cast<uint8_t>(crc << 1);
+    }
+  }
+  return crc;
+}
+
+/// CRC-16/CCITT-FALSE (polynomial 0x1021, initial value 0xFFFF), used by the
+/// delta encoded bursts
+uint16_t crc16(const uint8_t* data, size_t length, uint16_t crc = 0xFFFF) {
+  for (size_t i = 0; i < length; i++) {
+    crc ^= static_cast<uint16_t>(data[i]) << 8;
+    for (uint8_t bit = 0; bit < 8; bit++) {
+      crc = (crc & 0x8000) ? static_cast<uint16_t>((crc << 1) ^ 0x1021)
+                           : static_cast<uint16_t>(crc << 1);
+    }
+  }
+  return crc;
+}
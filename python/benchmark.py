@@ -0,0 +1,224 @@
+"""Benchmarks of the parse -> interpolate -> IK -> serialize pipeline on synthetic G-code.
+
+    python benchmark.py --sizes 10k,1M,100M --save baseline.json
+    python benchmark.py --sizes 10k,1M,100M --compare baseline.json
+
+Every stage is timed on its own. `points` is the number of items the stage produced
+(segments for parse, points for the others), peak memory is measured with tracemalloc
+in a separate run so that tracing does not distort the wall times.
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import typing
+from collections import namedtuple
+
+import numpy as np
+
+from gcodehandler import *
+from kinematics import *
+from preflight import preflight_check
+from printer_commander import serialize_delta_burst, PrinterCommander
+from synthetic_gcode import *
+
+BASELINE_FORMAT_VERSION = 1
+
+StageResult = namedtuple('StageResult', ['scenario', 'size_bytes', 'stage', 'wall_time', 'points',
+                                         'points_per_sec', 'peak_memory'])
+
+SCENARIOS = {
+    'dense_arcs': dense_arcs,
+    'long_polylines': long_polylines,
+    'pen_lifts': pen_lifts,
+}
+
+
+def parse_size(text: str) -> int:
+    """'10k', '1M', '200M' -> bytes"""
+    units = {'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30}
+    text = text.strip()
+    if text[-1].lower() in units:
+        return int(float(text[:-1]) * units[text[-1].lower()])
+    return int(text)
+
+
+# --- measurements
+
+def _measure(func: typing.Callable[[], typing.Any], trace_memory: bool,
+             repeat: int = 1) -> typing.Tuple[typing.Any, float, int]:
+    """(result, best wall time of `repeat` runs, peak traced bytes or -1)"""
+    wall_time = float('inf')
+    for _ in range(repeat):
+        result = None
+        start = time.perf_counter()
+        result = func()
+        wall_time = min(wall_time, time.perf_counter() - start)
+    peak = -1
+    if trace_memory:
+        del result
+        tracemalloc.start()
+        result = func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, wall_time, peak
+
+
+def _serialize_all(alphas: IKSolution) -> int:
+    """burst payloads for every point, the way PrinterCommander.burst builds them"""
+    angles = PointBuffer(alpha1=alphas.alpha1, alpha2=alphas.alpha2)
+    size = PrinterCommander.DELTA_BURST_SIZE
+    n_bytes = i = 0
+    while i < len(angles):
+        payload, count = serialize_delta_burst(angles[i:i + size])
+        n_bytes += len(payload)
+        i += count
+    return n_bytes
+
+
+def benchmark_file(filename: str, scenario: str = "", resolution: float = 0.1,
+                   trace_memory: bool = True, repeat: int = 1) -> typing.List[StageResult]:
+    size_bytes = os.path.getsize(filename)
+    results = []
+
+    def record(stage, func, count):
+        result, wall_time, peak = _measure(func, trace_memory, repeat)
+        points = count(result)
+        results.append(StageResult(scenario, size_bytes, stage, wall_time, points,
+                                   points / wall_time if wall_time > 0 else float('inf'), peak))
+        return result
+
+    program = record('parse', lambda: MotionProgram.from_file(filename), len)
+    record('parse_parallel', lambda: parse_gcode_file(filename), len)  # a process per CPU (memory of this one only)
+    # a fresh sampling each time, MotionProgram.resample would answer the second run from its cache
+    points = record('interpolate',
+                    lambda: PointBuffer.adopt(**dict(zip('xyz', sample_segments(program.segments, resolution))))
+                    .remove_duplicates(),
+                    len)
+    del program
+    record('interpolate_stream',
+           lambda: sum(1 for _ in GCodeInterpolator(read_gcode_file(filename), resolution).iter_interpolated()),
+           lambda n: n)
+    kinematics = TwoArmKinematics()
+    xys = points.xy
+    alphas = record('ik', lambda: kinematics.inverse(xys), lambda solution: len(solution.alpha1))
+    record('preflight', lambda: preflight_check(kinematics, xys, (alphas.alpha1, alphas.alpha2)),
+           lambda report: report.points)
+    record('serialize', lambda: _serialize_all(alphas), lambda _: len(alphas.alpha1))
+    return results
+
+
+def run_benchmarks(sizes: typing.Iterable[int], scenarios: typing.Iterable[str] = tuple(SCENARIOS),
+                   resolution: float = 0.1, trace_memory: bool = True, repeat: int = 1,
+                   directory: typing.Optional[str] = None) -> typing.List[StageResult]:
+    results = []
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        for scenario, size in itertools.product(scenarios, sizes):
+            filename = os.path.join(tmp, f"{scenario}_{size}.ngc")
+            write_gcode(filename, SCENARIOS[scenario](), size)
+            results += benchmark_file(filename, scenario, resolution, trace_memory, repeat)
+            os.remove(filename)
+    return results
+
+
+# --- baselines
+
+def _result_key(result: dict) -> typing.Tuple[str, int, str]:
+    return result['scenario'], result['size_bytes'], result['stage']
+
+
+def _commit() -> typing.Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_baseline(filename: str, results: typing.List[StageResult], resolution: float):
+    with open(filename, "w") as f:
+        json.dump({
+            'version': BASELINE_FORMAT_VERSION,
+            'commit': _commit(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.platform(),
+            'resolution': resolution,
+            'results': [r._asdict() for r in results],
+        }, f, indent=1)
+
+
+def compare_to_baseline(filename: str, results: typing.List[StageResult],
+                        tolerance: float = .2,
+                        min_delta: float = .01) -> typing.List[typing.Tuple[StageResult, dict]]:
+    """(result, baseline) pairs where the wall time grew by more than `tolerance` (relative)
+
+    Slowdowns below `min_delta` seconds are timer noise and are ignored.
+    """
+    with open(filename) as f:
+        baseline = json.load(f)
+    if baseline.get('version') != BASELINE_FORMAT_VERSION:
+        raise ValueError(f"unsupported baseline version {baseline.get('version')}")
+    by_key = {_result_key(r): r for r in baseline['results']}
+    regressions = []
+    for result in results:
+        old = by_key.get(_result_key(result._asdict()))
+        if old is not None and result.wall_time > old['wall_time'] * (1 + tolerance) \
+                and result.wall_time - old['wall_time'] > min_delta:
+            regressions.append((result, old))
+    return regressions
+
+
+def format_results(results: typing.List[StageResult]) -> str:
+    lines = [f"{'scenario':<16}{'size':>12} {'stage':<20}{'wall [s]':>10}{'points':>12}"
+             f"{'points/s':>14}{'peak [MB]':>11}"]
+    for r in results:
+        peak = f"{r.peak_memory / 2 ** 20:.1f}" if r.peak_memory >= 0 else "-"
+        lines.append(f"{r.scenario:<16}{r.size_bytes:>12} {r.stage:<20}{r.wall_time:>10.3f}{r.points:>12}"
+                     f"{r.points_per_sec:>14.0f}{peak:>11}")
+    return "\n".join(lines)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10k,1M", help="comma separated file sizes, e.g. 10k,1M,100M")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated scenario names")
+    parser.add_argument("--resolution", type=float, default=.1, help="interpolation resolution in mm")
+    parser.add_argument("--repeat", type=int, default=3, help="best of this many timed runs per stage")
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc runs")
+    parser.add_argument("--tmpdir", help="directory for the generated G-code files")
+    parser.add_argument("--save", metavar="JSON", help="write the results as a baseline")
+    parser.add_argument("--compare", metavar="JSON", help="compare against a baseline, exit 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=.2, help="allowed relative slowdown")
+    parser.add_argument("--min-delta", type=float, default=.01, help="ignored absolute slowdown in seconds")
+    args = parser.parse_args(argv)
+
+    sizes = [parse_size(s) for s in args.sizes.split(",")]
+    scenarios = args.scenarios.split(",")
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            parser.error(f"unknown scenario {scenario}, choose from {', '.join(SCENARIOS)}")
+
+    results = run_benchmarks(sizes, scenarios, args.resolution, not args.no_memory, args.repeat,
+                             args.tmpdir)
+    print(format_results(results))
+
+    if args.save:
+        save_baseline(args.save, results, args.resolution)
+    if args.compare:
+        regressions = compare_to_baseline(args.compare, results, args.tolerance, args.min_delta)
+        for result, old in regressions:
+            print(f"REGRESSION {result.scenario} {result.size_bytes} {result.stage}: "
+                  f"{old['wall_time']:.3f}s -> {result.wall_time:.3f}s")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,40 @@
+import os
+import tempfile
+import unittest
+
+from benchmark import *
+
+
+class SyntheticGCodeTest(unittest.TestCase):
+    def test_generators_are_reachable_and_sized(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, generator in SCENARIOS.items():
+                filename = os.path.join(tmp, name + ".ngc")
+                write_gcode(filename, generator(), 4096)
+                self.assertLess(abs(os.path.getsize(filename) - 4096), 200)
+                xs, ys, _ = MotionProgram.from_file(filename).resample(0.5)
+                self.assertGreater(len(xs), 10)
+                self.assertEqual(0, len(TwoArmKinematics().inverse(np.column_stack((xs, ys))).unreachable), name)
+
+    def test_parse_size(self):
+        self.assertEqual(10 * 1024, parse_size("10k"))
+        self.assertEqual(200 * 1024 * 1024, parse_size("200M"))
+        self.assertEqual(123, parse_size("123"))
+
+
+class BaselineTest(unittest.TestCase):
+    def test_regression_detected_against_saved_baseline(self):
+        results = run_benchmarks([2048], ['pen_lifts'], trace_memory=False)
+        self.assertEqual(['parse', 'parse_parallel', 'interpolate', 'interpolate_stream', 'ik', 'preflight',
+                          'serialize'],
+                         [r.stage for r in results])
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "baseline.json")
+            save_baseline(filename, results, 0.1)
+            self.assertEqual([], compare_to_baseline(filename, results))
+            slower = [r._replace(wall_time=r.wall_time + 1) for r in results]
+            self.assertEqual(len(results), len(compare_to_baseline(filename, slower)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import json
+import logging
+import os
+import tempfile
+import time
+import typing
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHECKPOINT_DIR = os.path.join(os.path.expanduser("~"), ".cache", "2arm-wire-plotter", "checkpoints")
+
+# index: of the last point of the compiled job known to be drawn, pen_down: the pen state of the move to it
+Checkpoint = namedtuple('Checkpoint', ['key', 'index', 'pen_down', 'points', 'source', 'updated'])
+
+
+class CheckpointStore:
+    """Progress of unfinished jobs, a small JSON file per compiled job (keyed by the job cache key: the source
+    content hash, the interpolation settings and the plotter geometry).
+
+    Files are replaced atomically, an interruption while saving leaves the previous checkpoint.
+    """
+
+    def __init__(self, directory: str = DEFAULT_CHECKPOINT_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".json")
+
+    def load(self, key: str) -> typing.Optional[Checkpoint]:
+        try:
+            with open(self.path(key)) as f:
+                values = json.load(f)
+            return Checkpoint(**values)
+        except FileNotFoundError:
+            return None
+        except (ValueError, TypeError) as e:  # corrupted: start over
+            logger.warning("ignoring the checkpoint %s: %r", self.path(key), e)
+            return None
+
+    def save(self, key: str, index: int, pen_down: bool, points: int, source: str = "") -> Checkpoint:
+        """points: number of points of the job"""
+        checkpoint = Checkpoint(key, index, pen_down, points, source, time.time())
+        fd, temp_filename = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        with os.fdopen(fd, "w") as f:
+            json.dump(checkpoint._asdict(), f)
+        os.replace(temp_filename, self.path(key))
+        return checkpoint
+
+    def clear(self, key: str):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def list(self) -> typing.List[Checkpoint]:
+        """every unfinished job, the most recently updated first"""
+        checkpoints = [self.load(name[:-len(".json")]) for name in os.listdir(self.directory)
+                       if name.endswith(".json")]
+        return sorted((c for c in checkpoints if c is not None), key=lambda c: c.updated, reverse=True)
@@ -0,0 +1,140 @@
+import os
+import tempfile
+import unittest
+from queue import Queue
+
+from synthetic_gcode import pen_lifts, write_gcode
+from checkpoint import *
+from drawing_process import *
+from plotter_simulator import *
+
+
+class RecordingPlotter(SimulatedPlotter):
+    def __init__(self):
+        super().__init__()
+        self.executed = []
+
+    def execute(self, command, then):
+        self.executed.append(command)
+        super().execute(command, then)
+
+
+class StoppingQueue(Queue):
+    """drawn_points of a process, stops it after `count` points"""
+
+    def __init__(self, process: DrawingProcess, count: int):
+        super().__init__()
+        self.process = process
+        self.count = count
+
+    def put(self, item, *args, **kwargs):
+        super().put(item, *args, **kwargs)
+        if self.qsize() >= self.count:
+            self.process.stop()
+
+
+class CheckpointStoreTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.store = CheckpointStore(tmp.name)
+
+    def test_saved_and_cleared(self):
+        self.assertIsNone(self.store.load("abc"))
+        self.store.save("abc", 10, True, 100, "job.ngc")
+        self.store.save("abc", 20, False, 100, "job.ngc")
+        self.store.save("def", 5, False, 50)
+        checkpoint = self.store.load("abc")
+        self.assertEqual(("abc", 20, False, 100, "job.ngc"), checkpoint[:5])
+        self.assertEqual(["def", "abc"], [c.key for c in self.store.list()])
+        self.store.clear("abc")
+        self.store.clear("abc")
+        self.assertIsNone(self.store.load("abc"))
+        self.assertEqual([".json"], list({os.path.splitext(name)[1] for name in os.listdir(self.store.directory)}))
+
+    def test_corrupted_checkpoint_ignored(self):
+        with open(self.store.path("abc"), "w") as f:
+            f.write('{"key": "abc", "ind')
+        self.assertIsNone(self.store.load("abc"))
+
+
+class ResumeTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.filename = os.path.join(tmp.name, "strokes.ngc")
+        write_gcode(self.filename, pen_lifts(), 20000)
+        self.cache = JobCache(os.path.join(tmp.name, "cache"))
+        self.store = CheckpointStore(os.path.join(tmp.name, "checkpoints"))
+
+    def process(self, device: SimulatedPlotter, resume: bool = True) -> DrawingProcess:
+        return DrawingProcess(PrinterCommander(connection=SimulatedSerial(device)), self.filename,
+                              job_cache=self.cache, checkpoints=self.store, resume=resume)
+
+    @staticmethod
+    def moves(device: RecordingPlotter) -> typing.List[tuple]:
+        return [command for command in device.executed if command[0] == "l"]
+
+    def test_resumed_where_stopped(self):
+        full = RecordingPlotter()
+        self.process(full, resume=False).run()
+        self.assertEqual([], self.store.list())
+
+        first = RecordingPlotter()
+        process = self.process(first)
+        process.drawn_points = StoppingQueue(process, 500)
+        process.run()
+        checkpoint = self.store.load(process.job.key)
+        self.assertEqual(499, checkpoint.index)  # every move sent was done when the stream ended
+        self.assertEqual(len(self.moves(full)), checkpoint.points)
+
+        second = RecordingPlotter()
+        resumed = self.process(second)
+        resumed.run()
+        self.assertEqual(499, resumed.start_index)
+        self.assertEqual(499, resumed.metrics.counters['points_skipped'])
+        commands = [command[0] for command in second.executed if command[0] != "s"]
+        self.assertEqual(["u", "l"], commands[:2])  # pen-up travel to the last point drawn
+        self.assertEqual(self.moves(first)[-1], self.moves(second)[0])
+        self.assertEqual(self.moves(full), self.moves(first) + self.moves(second)[1:])
+        self.assertIsNone(self.store.load(resumed.job.key))  # finished
+
+    def test_periodic_checkpoints_are_done_moves(self):
+        device = RecordingPlotter()
+        saved = []
+
+        class RecordingStore(CheckpointStore):
+            def save(self, key, index, *args):
+                saved.append((index, len([c for c in device.executed if c[0] == "l"])))
+                return super().save(key, index, *args)
+
+        self.store = RecordingStore(self.store.directory)
+        process = self.process(device)
+        process.CHECKPOINT_INTERVAL = 0
+        process.drawn_points = StoppingQueue(process, 300)
+        process.run()
+        self.assertGreater(len(saved), 100)
+        for index, moves_done in saved:
+            self.assertLess(index, moves_done)
+        self.assertEqual(299, saved[-1][0])
+        self.assertEqual(sorted(saved), saved)
+
+    def test_mismatching_checkpoint_ignored(self):
+        finished = RecordingPlotter()
+        process = self.process(finished)
+        process.run()
+        points = len(self.moves(finished))
+        self.store.save(process.job.key, 100, False, points + 1)
+        device = RecordingPlotter()
+        process = self.process(device)
+        process.run()
+        self.assertEqual(0, process.start_index)
+        self.assertEqual(points, len(self.moves(device)))
+
+    def test_needs_the_job_cache(self):
+        with self.assertRaises(ValueError):
+            DrawingProcess(PrinterCommander(connection=SimulatedSerial()), self.filename, checkpoints=self.store)
+
+
+if __name__ == '__main__':
+    unittest.main()
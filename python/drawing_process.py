@@ -1,61 +1,467 @@
+import collections
+import itertools
+import logging
 from threading import Thread, Event
 from queue import Queue
 
 from printer_commander import *
 from gcodehandler import *
+from travel_optimizer import *
+from job_cache import *
+from joint_simplifier import *
+from motion_planner import *
+from pipeline import *
+from checkpoint import *
+from preflight import *
+from svghandler import *
+
+logger = logging.getLogger(__name__)
+
+MOVE_COLUMNS = ('x', 'y', 'z', 'alpha1', 'alpha2', 'feed')  # of the PointBuffers of moves, see Move
+
+def chunked(iterable: typing.Iterable[T], size: int) -> typing.Iterator[typing.List[T]]:
+    iterator = iter(iterable)
+    while chunk := list(itertools.islice(iterator, size)):
+        yield chunk
 
 
 class DrawingProcess(Thread):
+    """Plots a G-code file as a pipeline: parse -> interpolate -> IK -> plan -> encode -> transmit.
+
+    Every stage but the last one runs on a thread of its own (see Pipeline), passing chunks of points and moves
+    through bounded queues, so the CPU work for the next moves overlaps the serial waits for the previous ones and
+    the first move is sent after a few chunks whatever the size of the file. The transmitting stage runs on this
+    thread. stop() ends every stage.
+
+    With checkpoints, the index of the last point of the compiled job drawn for sure is saved regularly and when the
+    job is stopped, a resumed job seeks to it in the job file.
+    """
+
+    IK_CHUNK_SIZE = 1024  # points solved together, small enough not to delay the first move noticeably
+    PIPELINE_QUEUE_SIZE = 4  # chunks buffered between two stages
+    CHECKPOINT_INTERVAL = 5.0  # seconds between two checkpoints while plotting
+
     def __init__(self,
                  printer: PrinterCommander,
                  filename: str,
                  interpolation_resolution: float = 0.1,
-                 speed: float = 300):
+                 speed: float = 300,
+                 rapid_speed: typing.Optional[float] = None,
+                 feed_rates: bool = True,
+                 motion_program: typing.Optional[MotionProgram] = None,
+                 chord_tolerance: typing.Optional[float] = None,
+                 reorder_strokes: bool = False,
+                 job_cache: typing.Optional[JobCache] = None,
+                 simplify_tolerance: typing.Optional[float] = None,
+                 planner: typing.Optional[MotionPlanner] = None,
+                 metrics_export: typing.Optional[str] = None,
+                 checkpoints: typing.Optional[CheckpointStore] = None,
+                 resume: bool = False,
+                 preflight_policy: typing.Optional[str] = None,
+                 bursts: bool = False):
+        """speed: rpm of the moves without a feed (F) in the file, the most the feeds are converted to
+        rapid_speed: rpm of the rapid (G00) moves, `speed` if not given
+        feed_rates: convert the feeds (F, mm/min of the pen) of the file to the speeds of the moves; the speed is only
+        changed when it differs from the previous one
+        motion_program: already parsed `filename` (e.g. shared with a preview), the file is streamed if not given
+        (an SVG file is converted into one right away, see svghandler)
+        chord_tolerance: adaptive sampling (mm of pen path deviation), interpolation_resolution is then only an upper
+        bound of the point distance (math.inf: none)
+        reorder_strokes: shorten the pen-up travel with optimize_travel (the file is parsed up front)
+        job_cache: compile the job (IK solved, packed angles) into the cache and stream it from there, a repeated job
+        is not parsed again
+        simplify_tolerance: drop the targets the arms reach anyway within this many mm of the pen (or half a motor
+        step) with joint-linear moves, see JointPathSimplifier
+        planner: per-move stepper speeds with look-ahead instead of `speed`, `rapid_speed` and the plain feed
+        conversion
+        Speed changes need speed frames in the motion stream, or cost a command each without streaming.
+        metrics_export: path without extension, the job's metrics are written to <path>.json and <path>.csv at the end
+        (printer.metrics is reset at the start of the job)
+        checkpoints: record the progress of the job there (needs job_cache, the indices are those of the compiled
+        job), the checkpoint is removed once the job is finished
+        resume: start at the checkpoint of the job if there is one: the pen travels up to the last point drawn,
+        then the job continues from there (the skipped points are not interpolated or read)
+        preflight_policy: run the pre-flight check before anything is sent to the plotter: 'warn' logs its problems,
+        'refuse' ends run() with a PreflightError if some point is unreachable or outside of the angle limits
+        bursts: without the motion stream, send the moves in bursts (see burst_printing) instead of one each, at
+        `speed` (no planner or feed conversion)"""
         super().__init__()
         self.stop_event = Event()
+        self.error: typing.Optional[BaseException] = None  # that ended run()
         self.printer = printer
-        self.drawn_points = Queue()  # todo: make this exist in main thread (bug: last segment not displayed on screen)
+        self.metrics = printer.metrics
+        self.metrics_export = metrics_export
+        self.drawn_points = Queue()  # (x, y, z) of the points reached, see LiveView
         self.interpolator = GCodeInterpolator(read_gcode_file(filename),
-                                              max_point_distance_mm=interpolation_resolution)
+                                              max_point_distance_mm=interpolation_resolution,
+                                              chord_tolerance_mm=chord_tolerance,
+                                              kinematics=printer.kinematics)
+        self.filename = filename
+        if motion_program is None and is_svg_file(filename):
+            motion_program = read_program(filename)  # flattened right away, no G-code in between
+        self.motion_program = motion_program
+        self.job_cache = job_cache
+        self.job_settings = JobSettings(interpolation_resolution, chord_tolerance, reorder_strokes)
+        self.job: typing.Optional[CompiledJob] = None
+        self.pipeline: typing.Optional[Pipeline] = None  # of the current run
+        if checkpoints is not None and job_cache is None:
+            raise ValueError("checkpoints need the job cache (the progress is an index into the compiled job)")
+        self.checkpoints = checkpoints
+        self.resume = resume
+        if preflight_policy not in (None, 'warn', 'refuse'):
+            raise ValueError(f"unknown pre-flight policy: {preflight_policy}")
+        self.preflight_policy = preflight_policy
+        self.preflight_report: typing.Optional[PreflightReport] = None
+        self.start_index = 0  # of the first point of the compiled job plotted
+        self.checkpoint: typing.Optional[Checkpoint] = None  # the last one saved
+        self._sent_moves: typing.Deque[typing.Tuple[int, int]] = collections.deque()  # (last frame seq, index)
+        self._last_checkpoint_time = 0.0
+        self.travel_report: typing.Optional[TravelReport] = None
+        self.simplifier = JointPathSimplifier(printer.kinematics, simplify_tolerance) \
+            if simplify_tolerance is not None else None
+        if reorder_strokes and job_cache is None:
+            program = motion_program if motion_program is not None else MotionProgram.from_file(filename)
+            self.reorder_strokes(program)
+        self.planner = planner
         self.speed = speed
-        self.printing_method = self.regular_printing
+        self.rapid_speed = rapid_speed if rapid_speed is not None else speed
+        self.feed_rates = feed_rates
+        self.fixed_speed = printer.supports_streaming and not printer.supports_speed_frames
+        if self.fixed_speed:
+            logger.warning("the firmware does not take speed changes in the motion stream, printing at %s rpm", speed)
+            self.planner = None
+        if printer.supports_streaming:
+            self.printing_method = self.streaming_printing
+        elif bursts:
+            self.printing_method = self.burst_printing
+            self.fixed_speed = True  # a burst is a single command, moved at the speed set before it
+            self.planner = None
+        else:
+            self.printing_method = self.regular_printing
+
+    def reorder_strokes(self, program: MotionProgram):
+        self.motion_program, self.travel_report = optimize_travel(program)
+        logger.info("pen-up travel %.1f mm -> %.1f mm, pen lifts %d -> %d", self.travel_report.travel_before,
+                    self.travel_report.travel_after, self.travel_report.pen_lifts_before,
+                    self.travel_report.pen_lifts_after)
 
     def stop(self):
         self.stop_event.set()
 
     def run(self):
-        self.printer.set_rpm(self.speed)
-        self.printing_method()
+        self.metrics.reset()
+        try:
+            if self.job_cache is not None:
+                try:
+                    with self.metrics.timed('compile'):
+                        self.job = self.job_cache.get_or_compile(self.filename, self.job_settings,
+                                                                 self.printer.kinematics, self.compiled_points)
+                except UnreachablePointsError:
+                    if self.preflight_policy is not None:
+                        self.run_preflight()  # of the file, reports (or refuses) the job
+                    raise
+            if self.preflight_policy is not None:
+                self.run_preflight()
+            if self.checkpoints is not None and self.resume:
+                self.start_index = self.resume_index()
+            self.printer.set_rpm(self.speed)
+            self.pipeline = Pipeline(self.stop_event, self.PIPELINE_QUEUE_SIZE, self.metrics)
+            self._last_checkpoint_time = time.monotonic()
+            with self.pipeline:
+                self.printing_method()
+            if self.checkpoints is not None:
+                if self.stop_event.is_set():
+                    self.save_checkpoint()  # every move sent is done by now
+                else:
+                    self.checkpoints.clear(self.job.key)
+            if self.simplifier is not None:
+                report = self.simplifier.report
+                self.metrics.count('points_simplified_away', report.points_removed)
+                logger.info("joint path simplification removed %d of %d points", report.points_removed,
+                            report.points_in)
+            if self.metrics.counters.get('speed_changes'):
+                self.printer.set_rpm(self.speed)
+            if self.planner is not None:
+                logger.info("planned motion time %.1f s", self.planner.estimated_time)
+        except BaseException as e:
+            self.error = e
+            raise
+        finally:
+            if self.job is not None:
+                self.job.close()
+            self.metrics.finish()
+            logger.info("job finished: %s", self.metrics.summary())
+            if self.metrics_export is not None:
+                self.metrics.export_json(self.metrics_export + ".json")
+                self.metrics.export_csv(self.metrics_export + ".csv")
+
+    def run_preflight(self):
+        """the pre-flight check of run(), of the compiled job if there is one; raises PreflightError if the policy
+        refuses the job"""
+        with self.metrics.timed('preflight'):
+            self.preflight_report = self.preflight()
+        if self.preflight_policy == 'refuse' and not self.preflight_report.ok:
+            raise PreflightError(self.filename, self.preflight_report)
+
+    def resume_index(self) -> int:
+        """index of the point the checkpoint of the job stopped at, 0 if there is none"""
+        checkpoint = self.checkpoints.load(self.job.key)
+        if checkpoint is None:
+            return 0
+        if checkpoint.points != len(self.job) or not 0 <= checkpoint.index < len(self.job):
+            logger.warning("the checkpoint of %s does not match the job, starting over", self.filename)
+            return 0
+        logger.info("resuming %s at point %d of %d", self.filename, checkpoint.index, len(self.job))
+        self.metrics.count('points_skipped', checkpoint.index)
+        return checkpoint.index
+
+    def track_progress(self, index: typing.Optional[int], seq: int = 0,
+                       completed_seq: typing.Optional[int] = None):
+        """records the move to the point `index` of the job, sent in the frame `seq`; saves a checkpoint every
+        CHECKPOINT_INTERVAL seconds with the moves up to completed_seq (all moves sent if None) done"""
+        if self.checkpoints is None or index is None:
+            return
+        self._sent_moves.append((seq, index))
+        if time.monotonic() - self._last_checkpoint_time >= self.CHECKPOINT_INTERVAL:
+            self.save_checkpoint(completed_seq)
+
+    def save_checkpoint(self, completed_seq: typing.Optional[int] = None):
+        index = None
+        while self._sent_moves and (completed_seq is None or self._sent_moves[0][0] <= completed_seq):
+            _, index = self._sent_moves.popleft()
+        self._last_checkpoint_time = time.monotonic()
+        if index is None:
+            return
+        self.checkpoint = self.checkpoints.save(self.job.key, index, bool(self.job.records[index]['pen_down']),
+                                                len(self.job), os.path.basename(self.filename))
+        self.metrics.count('checkpoints')
+        logger.debug("checkpoint at point %d of %d", index, len(self.job))
+
+    def compiled_points(self) -> typing.Iterator[FeedPoint]:
+        """points of a job compiled into the cache (the reordering is done only now, on a cache miss)"""
+        self._reorder_if_needed()
+        return self.points()
+
+    def _reorder_if_needed(self):
+        if self.job_settings.reorder_strokes and self.travel_report is None:
+            self.reorder_strokes(self.motion_program if self.motion_program is not None
+                                 else MotionProgram.from_file(self.filename))
+
+    def all_points(self) -> PointBuffer:
+        """every point of the job (x, y, z, feed) in one buffer, in the order they are plotted (the file is parsed
+        on its own for it, the points streamed by run() are not consumed)"""
+        self._reorder_if_needed()
+        program = self.motion_program if self.motion_program is not None else MotionProgram.from_file(self.filename)
+        return program.points(self.interpolator.max_point_distance_mm, self.interpolator.chord_tolerance,
+                              self.interpolator.kinematics, with_feed=True)
+
+    def preflight(self, points: typing.Optional[PointBuffer] = None, **limits) -> PreflightReport:
+        """Checks every point of the job before start() (see preflight_check, limits: its alpha_limits,
+        singularity_margin), run by run() itself with a preflight_policy. The angles of the compiled job are checked
+        if there is one, otherwise the whole file is interpolated for it unless its `points` (all_points()) are
+        given; the check itself is vectorized."""
+        if points is None and self.job is not None:  # the file is not parsed again
+            alpha1 = self.job.records['alpha1'].astype(float)
+            alpha2 = self.job.records['alpha2'].astype(float)
+            xys = np.column_stack(self.printer.kinematics.forward(alpha1, alpha2))
+            report = preflight_check(self.printer.kinematics, xys, (alpha1, alpha2), **limits)
+        else:
+            points = points if points is not None else self.all_points()
+            report = preflight_check(self.printer.kinematics, points, **limits)
+        log = logger.info if report.ok else logger.warning
+        log("pre-flight check of %s: %s", self.filename, report.summary())
+        return report
+
+    def points(self) -> typing.Iterator[FeedPoint]:
+        return itertools.chain.from_iterable(self.point_buffers())
+
+    def point_buffers(self, batches: typing.Optional[typing.Iterable[np.ndarray]] = None) \
+            -> typing.Iterator[PointBuffer]:
+        """the points (x, y, z, feed) in buffers of up to IK_CHUNK_SIZE points, see rechunk
+        batches: the segment batches to interpolate (parsed on another thread), the file's by default"""
+        if self.motion_program is not None:
+            buffers = [self.motion_program.points(self.interpolator.max_point_distance_mm,
+                                                  self.interpolator.chord_tolerance, self.interpolator.kinematics,
+                                                  with_feed=True)]
+        else:
+            buffers = self.interpolator.interpolate_buffers(batches if batches is not None
+                                                            else self.interpolator.segment_batches())
+        return self.metrics.timed_iter('parse', rechunk(buffers, self.IK_CHUNK_SIZE))
+
+    def moves(self, solved_points: typing.Optional[typing.Iterable[Move]] = None) -> typing.Iterator[Move]:
+        """(x, y, z, alpha1, alpha2, feed) of the points to move to (of solved_points() if not given), simplified
+        if enabled"""
+        solved_points = solved_points if solved_points is not None else self.solved_points()
+        if self.simplifier is not None:
+            return self.simplifier.simplify(solved_points)
+        return iter(solved_points)
+
+    def planned_moves(self, moves: typing.Optional[typing.Iterable[Move]] = None) \
+            -> typing.Iterator[typing.Tuple[Move, typing.Optional[int]]]:
+        """the moves (moves() if not given) with the speed to set before each (None: unchanged)"""
+        moves = moves if moves is not None else self.moves()
+        if self.fixed_speed:
+            for move in moves:
+                yield move, None
+            return
+        if not self.feed_rates:
+            moves = (move[:5] + (RAPID_FEED if move[5] == RAPID_FEED else 0.0,) + move[6:] for move in moves)
+        rpm = self.speed
+        speeds = self.planner.plan(moves) if self.planner is not None else self.feed_speeds(moves)
+        for move, planned_rpm in speeds:
+            if planned_rpm != rpm:
+                rpm = planned_rpm
+                self.metrics.count('speed_changes')
+                yield move, rpm
+            else:
+                yield move, None
+
+    def feed_speeds(self, moves: typing.Iterable[Move]) -> typing.Iterator[PlannedMove]:
+        """the moves with their speeds without look-ahead: rapid_speed, the feed converted (see feed_rpm) or speed"""
+        previous = None
+        rpm = self.speed
+        for move in moves:
+            feed = move[5]
+            if feed == RAPID_FEED:
+                rpm = self.rapid_speed
+            elif feed <= 0:
+                rpm = self.speed
+            elif previous is not None:
+                rpm = feed_rpm(previous, move, self.speed, rpm)
+            previous = move
+            yield move, rpm
+
+    def solved_points(self) -> typing.Iterator[Move]:
+        """(x, y, z, alpha1, alpha2, feed) of every point, from the compiled job if there is one"""
+        buffers = self.job_moves() if self.job is not None else self.solve(self.point_buffers())
+        return itertools.chain.from_iterable(buffers)
+
+    def job_moves(self) -> typing.Iterator[PointBuffer]:
+        """solved_points of the compiled job from start_index, in buffers (MOVE_COLUMNS and the index of the points
+        in the job); the move to the first point of a resumed job is a pen-up travel"""
+        start = self.start_index
+        for records in self.job.iter_chunks(self.IK_CHUNK_SIZE, start):
+            alpha1 = records['alpha1'].astype(float)
+            alpha2 = records['alpha2'].astype(float)
+            xs, ys = self.printer.kinematics.forward(alpha1, alpha2)  # for the preview only
+            zs = np.where(records['pen_down'], -1., 1.)
+            if start == self.start_index > 0:
+                zs[0] = 1.
+            yield PointBuffer(x=xs, y=ys, z=zs, alpha1=alpha1, alpha2=alpha2, feed=records['feed'],
+                              index=np.arange(start, start + len(records)))
+            start += len(records)
+
+    def solve(self, buffers: typing.Iterable[PointBuffer]) -> typing.Iterator[PointBuffer]:
+        """IK of the buffers of points, the moves in buffers (MOVE_COLUMNS)"""
+        for buffer in buffers:
+            with self.metrics.timed('ik'):
+                alphas = self.printer.get_alphas_batch(buffer)
+            yield buffer.with_columns(alpha1=alphas.alpha1, alpha2=alphas.alpha2).select(*MOVE_COLUMNS)
+
+    def staged_moves(self) -> typing.Iterator[typing.List[typing.Tuple[Move, typing.Optional[int]]]]:
+        """planned_moves in chunks, from the stages of the pipeline: parse -> interpolate -> IK -> plan (or the
+        compiled job -> plan)"""
+        pipeline = self.pipeline
+        if self.job is not None:
+            solved = pipeline.stage('read', self.job_moves())
+        else:
+            batches = pipeline.stage('parse', self.interpolator.segment_batches()) \
+                if self.motion_program is None else None
+            points = pipeline.stage('interpolate', self.point_buffers(batches))
+            solved = pipeline.stage('ik', self.solve(points))
+        moves = self.moves(itertools.chain.from_iterable(solved))
+        return pipeline.stage('plan', growing_chunks(self.planned_moves(moves), self.IK_CHUNK_SIZE))
+
+    @staticmethod
+    def encode(planned: typing.Iterable[typing.List[typing.Tuple[Move, typing.Optional[int]]]], encoder: FrameEncoder,
+               previous_z: float = 1) \
+            -> typing.Iterator[typing.List[typing.Tuple[typing.List[bytes], Point, typing.Optional[int]]]]:
+        """the frames of every move (pen change, speed change, move) with the point it reaches and its index in the
+        job (None without a job), in chunks
+        previous_z: of the pen before the first move, negative: down"""
+        for chunk in planned:
+            encoded = []
+            for move, rpm in chunk:
+                x, y, z, alpha1, alpha2 = move[:5]
+                frames = []
+                if z < 0 <= previous_z:
+                    frames.append(encoder.pen_down())
+                elif z > 0 >= previous_z:
+                    frames.append(encoder.pen_up())
+                previous_z = z
+                if rpm is not None:
+                    frames.append(encoder.set_speed(rpm))
+                frames.append(encoder.move_to_alphas(alpha1, alpha2))
+                encoded.append((frames, (x, y, z), int(move[6]) if len(move) > 6 else None))
+            yield encoded
+
+    @property
+    def initial_z(self) -> float:
+        """z assumed before the first move: the pen may be down if the job was interrupted, it is lifted then"""
+        return -1 if self.start_index > 0 else 1
 
     def regular_printing(self):
-        previous_z = 1
-        for x, y, z in self.interpolator.xy_list_interpolated:
-            if self.stop_event.is_set():
-                return
-            if z < 0 <= previous_z:
-                self.printer.pen_down()
-            elif z > 0 >= previous_z:
-                self.printer.pen_up()
-            previous_z = z
-            self.printer.move_to_xy(x, y)
-            self.drawn_points.put((x, y))
+        previous_z = self.initial_z
+        for chunk in self.staged_moves():
+            for move, rpm in chunk:
+                if self.stop_event.is_set():
+                    return
+                x, y, z, alpha1, alpha2 = move[:5]
+                if z < 0 <= previous_z:
+                    self.printer.pen_down()
+                elif z > 0 >= previous_z:
+                    self.printer.pen_up()
+                previous_z = z
+                if rpm is not None:
+                    self.printer.set_rpm(rpm)
+                self.printer.move_to_alphas(alpha1, alpha2)
+                self.metrics.count('points')
+                self.drawn_points.put((x, y, z))
+                self.track_progress(int(move[6]) if len(move) > 6 else None)
+
+    def streaming_printing(self):
+        """like regular_printing, but keeps the firmware's motion queue filled instead of waiting for every move,
+        the frames are encoded by a stage of the pipeline"""
+        with self.printer.motion_stream() as stream:
+            encoded = self.encode(self.staged_moves(), stream.frame_encoder(), self.initial_z)
+            for chunk in self.pipeline.stage('encode', encoded):
+                for frames, point, index in chunk:
+                    if self.stop_event.is_set():
+                        return
+                    for frame in frames:
+                        stream.send_frame(frame)
+                    self.metrics.count('points')
+                    self.drawn_points.put(point)
+                    self.track_progress(index, stream.next_seq - 1, stream.completed_seq)
 
     def burst_printing(self):
-        burst_size = self.printer.BURST_SIZE
-        previous_z = 1
-        curr_burst: typing.List[typing.Tuple[float, float]] = []  # z coordinate fixed within burst
-        for p in self.interpolator.xy_list_interpolated:
-            if self.stop_event.is_set():
-                return
-            if math.copysign(1, p[2]) == math.copysign(1, previous_z) \
-                    and len(curr_burst) < burst_size:
-                curr_burst.append(p[0:2])
-            else:
-                self.printer.burst(curr_burst)
-                if math.copysign(1, p[2]) != math.copysign(1, previous_z):
-                    if math.copysign(1, p[2]) < 0:
-                        self.printer.pen_down()
-                    else:
-                        self.printer.pen_up()
-                    previous_z = p[2]
-                curr_burst = []
\ No newline at end of file
+        """like regular_printing, but the moves between two pen changes are sent in bursts of printer.burst_size
+        (a round trip per burst instead of per move, at a fixed speed)"""
+        previous_z = self.initial_z
+        burst: typing.List[Move] = []
+
+        def flush():
+            if burst:
+                self.printer.burst_alphas([move[3:5] for move in burst])
+                self.metrics.count('points', len(burst))
+                for move in burst:
+                    self.drawn_points.put(move[:3])
+                    self.track_progress(int(move[6]) if len(move) > 6 else None)
+                burst.clear()
+
+        for chunk in self.staged_moves():
+            for move, _ in chunk:
+                if self.stop_event.is_set():
+                    return
+                z = move[2]
+                if z < 0 <= previous_z:
+                    flush()
+                    self.printer.pen_down()
+                elif z > 0 >= previous_z:
+                    flush()
+                    self.printer.pen_up()
+                previous_z = z
+                burst.append(move)
+                if len(burst) == self.printer.burst_size:
+                    flush()
+        flush()
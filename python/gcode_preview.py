@@ -3,8 +3,8 @@ from gcodehandler import *
 # interpolator = GCodeInterpolator(read_gcode_file("../kutya_0009.ngc"), max_point_distance_mm=1)
 # refined_point_list = interpolator.xy_list_interpolated
 #
-interpolator = GCodeInterpolator(read_gcode_file("../text.ngc"), max_point_distance_mm=1)
-refined_point_list = interpolator.xy_list_interpolated
+program = MotionProgram.from_file("../text.ngc")  # parsed once, resampling at other resolutions is cheap
+points = program.points(max_point_dist=1)  # PointBuffer, its columns are plotted without copying
 
 
 # interpolator = GCodeInterpolator(
@@ -30,8 +30,7 @@ refined_point_list = interpolator.xy_list_interpolated
 
 from matplotlib import pyplot as plt
 
-xs, ys, zs = list(zip(*tuple(refined_point_list)))
-plt.plot(xs, ys)
+plt.plot(points.x, points.y)
 plt.show()
 
 interpolator = GCodeInterpolator(
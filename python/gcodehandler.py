@@ -1,14 +1,29 @@
+import logging
 import math
+import concurrent.futures
+import io
+import itertools
+import os
 import re
 import typing
-import itertools
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+
+import numpy as np
+
+from kinematics import TwoArmKinematics
+from point_buffer import PointBuffer, rechunk
+
+logger = logging.getLogger(__name__)
 
 
-def read_gcode_file(filename: str) -> typing.Iterable[str]:
+def read_gcode_file(filename: str) -> typing.Iterator[str]:
+    """Yields the instruction lines of a G-code file one by one, without reading the whole file into memory."""
     with open(filename) as f:
-        lines = f.readlines()
-    return filter(lambda x: x[0].isalpha(), lines)
+        yield from _instruction_lines(f)
+
+
+def _instruction_lines(lines: typing.Iterable[str]) -> typing.Iterator[str]:
+    return (line for line in lines if line[0].isalpha())
 
 
 T = typing.TypeVar('T')
@@ -19,28 +34,249 @@ def remove_duplicates(iterable: typing.Iterable[T]) -> typing.Iterable[T]:
 
 Command = namedtuple('Command', ['letter', 'number'])
 
+Point = typing.Tuple[float, float, float]
+FeedPoint = typing.Tuple[float, float, float, float]  # x, y, z, feed of the move to the point
+
+# segment kinds, numbered after the G command producing them
+RAPID = 0
+LINE = 1
+ARC_CW = 2
+ARC_CCW = 3
+
+RAPID_FEED = math.inf  # feed of the rapid moves: as fast as the plotter goes
+
+# (i, j): arc center relative to the start point; (x0, y0) of a rapid move is its end point
+# feed: the modal F value (mm/min) of the move, 0 if the file did not set one (ignored for rapids)
+Segment = namedtuple('Segment', ['kind', 'x0', 'y0', 'x1', 'y1', 'z', 'i', 'j', 'feed'], defaults=[0.0])
+
+_COMMENT_PATTERN = re.compile(r"\(.*?\)|;.*$")
+
+
+def _count_below(limits: np.ndarray, step: np.ndarray, first: int) -> np.ndarray:
+    """number of integers k >= first with k * step < limit"""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        counts = np.ceil(limits / step) - first
+    counts = np.nan_to_num(counts, nan=0, posinf=0, neginf=0)
+    counts = np.maximum(counts, 0)
+    # ceil of the quotient may be off by one due to roundoff
+    counts -= (counts > 0) & ((counts - 1 + first) * step >= limits)
+    counts += (counts + first) * step < limits
+    return counts.astype(np.int64)
+
+
+def _local_indices(counts: np.ndarray) -> np.ndarray:
+    """concatenation of arange(count) for every count"""
+    ends = np.cumsum(counts)
+    return np.arange(ends[-1] if len(ends) > 0 else 0) - np.repeat(ends - counts, counts)
+
+
+def _arc_geometry(segments: np.ndarray) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """radius, start angle and signed sweep angle (negative for CW) of every row, meaningful for arcs only"""
+    kind, x0, y0, x1, y1, z, i, j = segments.T[:8]
+    cw_dir = kind == ARC_CW
+    R_sq = i ** 2 + j ** 2
+    R = np.sqrt(R_sq)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cos_phi = (-i * (x1 - x0 - i) - j * (y1 - y0 - j)) / R_sq
+        cos_phi = np.clip(cos_phi, -1, 1)  # can be invalid due roundoff errors
+        sgn_phi = np.where(i * (y1 - y0) - j * (x1 - x0) > 0, -1, 1)
+        phi = sgn_phi * np.arccos(cos_phi)
+        phi = np.where(cw_dir & (phi > 0), phi - 2 * np.pi, phi)  # always need a negative value, since going CW
+        phi = np.where(~cw_dir & (phi < 0), phi + 2 * np.pi, phi)  # always need a positive value, since going CCW
+    gamma = np.arctan2(-j, -i)
+    return R, gamma, phi
+
+
+def point_feeds(segments: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    """feeds of points sampled from the given rows of the segments, RAPID_FEED for rapids"""
+    return np.where(segments[rows, 0] == RAPID, RAPID_FEED, segments[rows, 8])
+
+
+def sample_segments(segments: np.ndarray, max_point_dist: float,
+                    return_feeds: bool = False) -> typing.Tuple[np.ndarray, ...]:
+    """Samples a batch of segments (rows of `Segment` fields) at once.
+
+    Lines are sampled from their start point at `max_point_dist` steps, arcs from one step after their start point,
+    every segment is closed by its end point, rapids are only their end point. Duplicates are not removed.
+    return: x, y, z coordinate arrays (and the feeds of the points if `return_feeds`, see point_feeds)
+    """
+    kind, x0, y0, x1, y1, z, i, j = segments.T[:8]
+    is_line = kind == LINE
+    is_arc = (kind == ARC_CW) | (kind == ARC_CCW)
+
+    # lines
+    dvx = x1 - x0
+    dvy = y1 - y0
+    dv_norm = np.hypot(dvx, dvy)
+    is_line &= dv_norm > 0.00000001  # not just Z coord change
+
+    # arcs
+    cw_dir = kind == ARC_CW
+    R, gamma, phi = _arc_geometry(segments)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        max_angle_dist = max_point_dist / R
+
+    n_inner = np.zeros(len(kind), dtype=np.int64)
+    n_inner[is_line] = _count_below(dv_norm[is_line], max_point_dist, 0)
+    n_inner[is_arc] = _count_below(np.abs(phi[is_arc]), max_angle_dist[is_arc], 1)
+
+    counts = n_inner + 1  # inner points and the end point
+    ends = np.cumsum(counts)
+    first_positions = ends - counts
+
+    xs = np.empty(ends[-1] if len(ends) > 0 else 0)
+    ys = np.empty_like(xs)
+    zs = np.repeat(z, counts)
+    xs[ends - 1] = x1
+    ys[ends - 1] = y1
+
+    lines = np.flatnonzero(is_line)
+    n = n_inner[lines]
+    k = _local_indices(n)
+    positions = np.repeat(first_positions[lines], n) + k
+    curr_len = k * max_point_dist
+    xs[positions] = np.repeat(x0[lines], n) + np.repeat(dvx[lines] / dv_norm[lines], n) * curr_len
+    ys[positions] = np.repeat(y0[lines], n) + np.repeat(dvy[lines] / dv_norm[lines], n) * curr_len
+
+    arcs = np.flatnonzero(is_arc)
+    n = n_inner[arcs]
+    k = _local_indices(n)
+    positions = np.repeat(first_positions[arcs], n) + k
+    increment = np.where(cw_dir[arcs], -max_angle_dist[arcs], max_angle_dist[arcs])
+    curr_angle = np.repeat(gamma[arcs], n) + (k + 1) * np.repeat(increment, n)
+    radius = np.repeat(R[arcs], n)
+    xs[positions] = np.repeat(x0[arcs] + i[arcs], n) + np.cos(curr_angle) * radius
+    ys[positions] = np.repeat(y0[arcs] + j[arcs], n) + np.sin(curr_angle) * radius
+
+    if return_feeds:
+        return xs, ys, zs, point_feeds(segments, np.repeat(np.arange(len(kind)), counts))
+    return xs, ys, zs
+
+
+ADAPTIVE_PROBES = (.25, .5, .75)  # fractions of a move at which the pen path is compared to the segment
+ADAPTIVE_MAX_DEPTH = 30  # halvings of a segment at most
+
+
+def sample_segments_adaptive(segments: np.ndarray, tolerance: float, kinematics, max_point_dist: float = math.inf,
+                             return_feeds: bool = False) -> typing.Tuple[np.ndarray, ...]:
+    """Samples a batch of segments with as few points as the arm geometry allows.
+
+    The plotter moves linearly in joint space between two points, so the pen follows a curve instead of the straight
+    line (or arc) between them. Segments are halved until the pen path stays within `tolerance` mm of the segment
+    at the probe points (ADAPTIVE_PROBES of every move). Points are at most `max_point_dist` apart along the segment.
+    Rapid moves are only sampled at their end points, unreachable parts of the segments are not refined.
+    kinematics: provides inverse(xys) and forward(alpha1, alpha2), e.g. TwoArmKinematics
+    return: x, y, z coordinate arrays (and the feeds if `return_feeds`), duplicates are not removed
+    """
+    kind, x0, y0, x1, y1, z, i, j = segments.T[:8]
+    dvx = x1 - x0
+    dvy = y1 - y0
+    length = np.hypot(dvx, dvy)
+    is_line = (kind == LINE) & (length > 0.00000001)
+    is_arc = (kind == ARC_CW) | (kind == ARC_CCW)
+    R, gamma, phi = _arc_geometry(segments)
+    cx, cy = x0 + i, y0 + j
+    length = np.where(is_arc, R * np.abs(phi), length)
+
+    def path_points(seg: np.ndarray, t: np.ndarray) -> typing.Tuple[np.ndarray, np.ndarray]:
+        angle = gamma[seg] + t * phi[seg]
+        xs = np.where(is_arc[seg], cx[seg] + R[seg] * np.cos(angle), x0[seg] + t * dvx[seg])
+        ys = np.where(is_arc[seg], cy[seg] + R[seg] * np.sin(angle), y0[seg] + t * dvy[seg])
+        return xs, ys
+
+    def distance_to_path(seg: np.ndarray, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            t = np.clip(((xs - x0[seg]) * dvx[seg] + (ys - y0[seg]) * dvy[seg]) / length[seg] ** 2, 0, 1)
+        line_distance = np.hypot(xs - x0[seg] - t * dvx[seg], ys - y0[seg] - t * dvy[seg])
+        arc_distance = np.abs(np.hypot(xs - cx[seg], ys - cy[seg]) - R[seg])  # distance from the full circle
+        return np.where(is_arc[seg], arc_distance, line_distance)
+
+    # initial pieces of the curves, every other segment is just its end point
+    is_curve = is_line | is_arc
+    counts = np.ones(len(kind), dtype=np.int64)
+    if max_point_dist != math.inf:
+        counts[is_curve] = np.maximum(np.ceil(length[is_curve] / max_point_dist), 1)
+    seg = np.repeat(np.arange(len(kind)), counts)
+    k = _local_indices(counts)
+    t0 = k / counts[seg]
+    t1 = (k + 1) / counts[seg]
+    refine = is_curve[seg]
+    done_seg, done_t = [seg[~refine]], [t1[~refine]]
+    seg, t0, t1 = seg[refine], t0[refine], t1[refine]
+
+    for _ in range(ADAPTIVE_MAX_DEPTH):
+        if len(seg) == 0:
+            break
+        start = kinematics.inverse(np.column_stack(path_points(seg, t0)))
+        end = kinematics.inverse(np.column_stack(path_points(seg, t1)))
+        error = np.zeros(len(seg))
+        for u in ADAPTIVE_PROBES:
+            xs, ys = kinematics.forward(start.alpha1 + u * (end.alpha1 - start.alpha1),
+                                        start.alpha2 + u * (end.alpha2 - start.alpha2))
+            error = np.fmax(error, distance_to_path(seg, xs, ys))  # NaN (unreachable) counts as accurate
+        split = error > tolerance
+        done_seg.append(seg[~split])
+        done_t.append(t1[~split])
+        seg, t0, t1 = seg[split], t0[split], t1[split]
+        middle = (t0 + t1) / 2
+        seg, t0, t1 = np.concatenate((seg, seg)), np.concatenate((t0, middle)), np.concatenate((middle, t1))
+    done_seg.append(seg)
+    done_t.append(t1)
+
+    seg = np.concatenate(done_seg)
+    t = np.concatenate(done_t)
+    order = np.lexsort((t, seg))
+    seg, t = seg[order], t[order]
+    xs, ys = path_points(seg, t)
+    is_end = (t >= 1) | ~is_curve[seg]  # exact end points, no roundoff
+    xs[is_end] = x1[seg[is_end]]
+    ys[is_end] = y1[seg[is_end]]
+    if return_feeds:
+        return xs, ys, z[seg], point_feeds(segments, seg)
+    return xs, ys, z[seg]
+
+
 class GCodeInterpolator:
-    def __init__(self,
-                 gcode_instruction_list: typing.Iterable[str],
-                 max_point_distance_mm: float = 1):
+    """Turns G-code instruction lines into a stream of (x, y, z) points.
+
+    The instruction lines are consumed lazily: every iteration walks over `gcode_instruction_list` once, tokenizing
+    each line a single time. If a one-shot iterator (e.g. `read_gcode_file(...)`) is passed, only the first pass
+    sees the lines; pass a list if the points need to be produced more than once.
 
-        only_command_lines = filter(lambda l: len(l) > 0 and l[0].upper() == "G", gcode_instruction_list)
-        comments_stripped = map(lambda l: re.sub(r"\(.*?\)", "", l), only_command_lines)
-        comments_stripped = map(lambda l: re.sub(r";.*?$", "", l), comments_stripped)
-        upper_cased = map(lambda l: l.upper(), comments_stripped)
-        self.gcode_instruction_lines = list(upper_cased)
+    If `chord_tolerance_mm` is given, segments are sampled adaptively (see sample_segments_adaptive) with the
+    maximum point distance as an upper bound only.
+    """
 
+    SEGMENT_BATCH_SIZE = 4096
+
+    def __init__(self,
+                 gcode_instruction_list: typing.Iterable[str],
+                 max_point_distance_mm: float = 1,
+                 chord_tolerance_mm: typing.Optional[float] = None,
+                 kinematics: typing.Optional[TwoArmKinematics] = None):
+        self.gcode_instruction_source = gcode_instruction_list
         self.max_point_dist = max_point_distance_mm
+        self.chord_tolerance = chord_tolerance_mm
+        self.kinematics = kinematics if kinematics is not None else TwoArmKinematics()
+        self._motion_program: typing.Optional[MotionProgram] = None
+
+    @staticmethod
+    def clean_line(line: str) -> str:
+        return _COMMENT_PATTERN.sub("", line).upper()
 
     @staticmethod
     def coords(line):
         # assert line[0].upper() == "G0"
 
         words = line.split()
+        return GCodeInterpolator._coords_of_words(words)
+
+    @staticmethod
+    def _coords_of_words(words: typing.Sequence[str]) -> typing.Dict[str, float]:
         try:
             return {word[0].upper(): float(word[1:]) for word in words[1:]}
         except Exception:
-            print(words)
+            logger.warning("unparsable G-code words: %s", words)
             return {} #todo: fix this
 
     @staticmethod
@@ -49,121 +285,311 @@ class GCodeInterpolator:
         comm = line.split()[0]
         return Command(comm[0].upper(), int(comm[1:]))
 
-    # todo: filter for z > 0 ?
+    def iter_instruction_lines(self) -> typing.Iterator[str]:
+        """Yields the G command lines, comments stripped and upper cased."""
+        for line in self.gcode_instruction_source:
+            if len(line) > 0 and line[0].upper() == "G":
+                yield GCodeInterpolator.clean_line(line)
 
     @property
-    def raw_coord_list(self) -> typing.Iterable[dict[str, float]]:
+    def gcode_instruction_lines(self) -> typing.List[str]:
+        return list(self.iter_instruction_lines())
+
+    def iter_instructions(self) -> typing.Iterator[typing.Tuple[Command, typing.Dict[str, float]]]:
+        """Yields (command, coordinates) pairs, splitting every line only once."""
+        for line in self.iter_instruction_lines():
+            words = line.split()
+            yield Command(words[0][0], int(words[0][1:])), GCodeInterpolator._coords_of_words(words)
+
+    # todo: filter for z > 0 ?
+
+    def iter_raw_coords(self) -> typing.Iterator[typing.Dict[str, float]]:
+        return itertools.dropwhile(lambda d: "X" not in d or "Y" not in d,
+                                   self._iter_merged_coords())  # potential initial z axis adjustment
+
+    def _iter_merged_coords(self) -> typing.Iterator[typing.Dict[str, float]]:
         curr_point = {}
-        point_list = []
-        for line in self.gcode_instruction_lines:
-            command = GCodeInterpolator.command(line)
+        for command, coords in self.iter_instructions():
             if command.letter == "G" and command.number in [0, 1, 2, 3]:
-                coords = GCodeInterpolator.coords(line)
                 curr_point = {**curr_point, **coords}  # merging
-                # print(f"({curr_x},{curr_y}),", end='')
-                point_list.append(curr_point)
+                yield curr_point
 
-        point_list = itertools.dropwhile(lambda d: "X" not in d or "Y" not in d, point_list)  # potential initial z axis adjustment
-        return point_list
+    @property
+    def raw_coord_list(self) -> typing.Iterable[typing.Dict[str, float]]:
+        return self.iter_raw_coords()
 
     @property
-    def xy_list_raw(self) -> typing.Collection[typing.Tuple[float, float, float]]:
+    def xy_list_raw(self) -> typing.Collection[Point]:
         res = remove_duplicates(map(lambda coords: (coords['X'], coords['Y'], coords['Z']),
-                                  self.raw_coord_list))
+                                    self.iter_raw_coords()))
         return list(res)
 
+    def iter_segments(self) -> typing.Iterator[Segment]:
+        """Yields the motion primitives with resolved absolute coordinates."""
+        x: typing.Optional[float] = None
+        y: typing.Optional[float] = None
+        z: typing.Optional[float] = None
+        feed = 0.0  # modal, also set by the F word of a rapid
+        has_point = False  # no meaningful current point until x, y and z are all known
+
+        for command, coords in self.iter_instructions():
+            if command.letter != "G":
+                continue
+            new_x = coords.get("X", x)
+            new_y = coords.get("Y", y)
+            new_z = coords.get("Z", z)
+            feed = coords.get("F", feed)
+
+            if command.number == 0 or not has_point:
+                x, y, z = new_x, new_y, new_z
+                if x is not None and y is not None and z is not None:
+                    has_point = True
+                    yield Segment(RAPID, x, y, x, y, z, 0.0, 0.0, feed)
+            elif command.number == 1:  # linear interpolation
+                yield Segment(LINE, x, y, new_x, new_y, new_z, 0.0, 0.0, feed)
+                x, y, z = new_x, new_y, new_z
+            elif command.number in [2, 3]:  # circular interpolation
+                yield Segment(command.number, x, y, new_x, new_y, new_z, coords["I"], coords["J"], feed)
+                x, y, z = new_x, new_y, new_z
+
+    def iter_interpolated(self, with_feed: bool = False) -> typing.Iterator[typing.Union[Point, FeedPoint]]:
+        """Lazily yields the interpolated points, at most `max_point_dist` apart, consecutive duplicates removed.
+        with_feed: (x, y, z, feed) points, see point_feeds
+
+        Segments are sampled in batches; the batch size starts at a single segment (so that the first point is
+        available right away) and doubles up to SEGMENT_BATCH_SIZE, keeping memory use independent of the input.
+        """
+        return self.interpolate_batches(self.segment_batches(), with_feed)
+
+    def interpolate_batches(self, batches: typing.Iterable[np.ndarray],
+                            with_feed: bool = False) -> typing.Iterator[typing.Union[Point, FeedPoint]]:
+        """iter_interpolated of the given segment batches (e.g. segment_batches parsed on another thread)"""
+        for buffer in self.interpolate_buffers(batches):
+            yield from buffer if with_feed else buffer.select('x', 'y', 'z')
+
+    def interpolate_buffers(self, batches: typing.Iterable[np.ndarray]) -> typing.Iterator[PointBuffer]:
+        """the points of interpolate_batches in a PointBuffer (x, y, z, feed) per segment batch"""
+        last_point = None
+        for batch in batches:
+            if self.chord_tolerance is None:
+                xs, ys, zs, feeds = sample_segments(batch, self.max_point_dist, return_feeds=True)
+            else:
+                xs, ys, zs, feeds = sample_segments_adaptive(batch, self.chord_tolerance, self.kinematics,
+                                                             self.max_point_dist, return_feeds=True)
+            buffer = PointBuffer.adopt(x=xs, y=ys, z=zs, feed=feeds).remove_duplicates(last_point)
+            if len(buffer) > 0:
+                last_point = buffer[-1]
+                yield buffer
+
     @property
-    def xy_list_interpolated(self) -> typing.Collection[typing.Tuple[float, float, float]]:
-        curr_point: dict[str, float] = {}
-        point_list: list[typing.Tuple[float, float, float]] = []
-
-        for line in self.gcode_instruction_lines:
-            command = GCodeInterpolator.command(line)
-            coords = GCodeInterpolator.coords(line)
-
-            if command.letter == "G" and \
-                    (command.number == 0
-                     or not point_list):  # no meaningful current point yet
-                curr_point = {**curr_point, **coords}
-                if all(coord in curr_point for coord in ["X", "Y", "Z"]):
-                    point_list.append((curr_point['X'], curr_point['Y'], curr_point['Z']))
-            elif command.letter == "G" and (command.number in [1])\
-                    and point_list:  # linear interpolation
-                xyz = {**curr_point, **coords}
-                x, y, z = xyz['X'], xyz['Y'], xyz['Z']
-
-                curr_x = curr_point['X']
-                curr_y = curr_point['Y']
-
-                dvx = x - curr_x
-                dvy = y - curr_y
-                dv_norm = math.sqrt(dvx**2 + dvy**2)
-
-                if dv_norm > 0.00000001:  # not just Z coord change
-                    dvx_normed = dvx / dv_norm
-                    dvy_normed = dvy / dv_norm
-
-                    curr_len = 0.0
-                    while curr_len < dv_norm:
-                        new_x = curr_x + dvx_normed * curr_len
-                        new_y = curr_y + dvy_normed * curr_len
-                        curr_len += self.max_point_dist
-                        point_list.append((new_x, new_y, z))
-                point_list.append((x, y, z))
-
-                curr_point = {**xyz, **coords}
-                # print(f"({curr_x},{curr_y}),", end='')
-                # point_list.append((curr_point['X'], curr_point['Y']))
-
-            elif command.letter == "G" and (command.number in [2, 3])\
-                    and point_list:  # circular interpolation
-                cw_dir = command.number == 2
-
-                xyz = {**curr_point, **coords}
-                x, y, z = xyz['X'], xyz['Y'], xyz['Z']
-
-                i = coords["I"]
-                j = coords["J"]
-                curr_x = curr_point['X']
-                curr_y = curr_point['Y']
-
-                R = math.sqrt(i ** 2 + j ** 2)
-                cos_phi = (-i * (x - curr_x - i) - j * (y - curr_y - j)) / (i ** 2 + j ** 2)
-                sgn_phi = -1 if (i * (y - curr_y) - j * (x - curr_x)) > 0 else 1
-                cos_phi = max(-1, min(1, cos_phi))  # can be invalid due roundoff errors
-                phi = sgn_phi * math.acos(cos_phi)
-
-                if cw_dir:
-                    if phi > 0:
-                        phi -= 2 * math.pi  # always need a negative value, since going CW
-                else:
-                    if phi < 0:
-                        phi += 2 * math.pi  # always need a positive value, since going CCW
-                gamma = math.atan2(-j, -i)
-
-                max_angle_dist = self.max_point_dist / R
-
-                curr_angle = gamma
-
-                increment_sgn = -1 if cw_dir else 1
-                curr_angle += max_angle_dist * increment_sgn
-                while (cw_dir and curr_angle > phi + gamma) or \
-                        (not cw_dir and curr_angle < phi + gamma):
-                    new_x = curr_x + i + math.cos(curr_angle) * R
-                    new_y = curr_y + j + math.sin(curr_angle) * R
-                    point_list.append((new_x, new_y, z))
-                    # print(f"({new_x},{new_y}),", end='')
-                    curr_angle += max_angle_dist * increment_sgn
-                # print(f"({x},{y}),", end='')
-                point_list.append((x, y, z))
-                curr_point = {**curr_point, **coords}
-
-        return list(remove_duplicates(point_list))
+    def interpolated_points(self) -> PointBuffer:
+        return self.motion_program.points(self.max_point_dist, self.chord_tolerance, self.kinematics)
 
     @property
-    def max_point_distcane_mm(self):
+    def xy_list_interpolated(self) -> typing.List[Point]:
+        return self.interpolated_points.tolist()
+
+    @property
+    def motion_program(self) -> 'MotionProgram':
+        """The parsed segments, built on first access; changing the resolution afterwards needs no re-parsing."""
+        if self._motion_program is None:
+            self._motion_program = MotionProgram(self.iter_segments())
+        return self._motion_program
+
+    def segment_batches(self) -> typing.Iterator[np.ndarray]:
+        """iter_segments in arrays of growing size (see iter_interpolated)"""
+        segments = self.iter_segments()
+        batch_size = 1
+        while batch := list(itertools.islice(segments, batch_size)):
+            yield np.array(batch, dtype=float)
+            batch_size = min(2 * batch_size, self.SEGMENT_BATCH_SIZE)
+
+    @property
+    def max_point_distance_mm(self):
         return self.max_point_dist
 
-    @max_point_distcane_mm.setter
-    def max_point_distcane_mm(self, max_point_distcane_mm):
-        self.max_point_distcane_mm = max_point_distcane_mm
\ No newline at end of file
+    @max_point_distance_mm.setter
+    def max_point_distance_mm(self, max_point_distance_mm):
+        self.max_point_dist = max_point_distance_mm
+
+
+# --- parallel parsing: the file is split into byte ranges at line starts, the ranges are tokenized by a process
+# pool, then the modal coordinates are resolved chunk by chunk in order (vectorized, carrying the state across)
+
+PARSE_CHUNK_BYTES = 4 << 20
+_MODAL_WORDS = "XYZFIJ"  # columns of the tokenized words
+
+_ModalState = namedtuple('_ModalState', ['position', 'known', 'feed', 'has_point'])
+
+
+def gcode_chunk_ranges(filename: str, chunk_bytes: int = PARSE_CHUNK_BYTES) -> typing.List[typing.Tuple[int, int]]:
+    """(start, end) byte ranges of about `chunk_bytes` covering the file, every range starts at a line start"""
+    size = os.path.getsize(filename)
+    starts = [0]
+    with open(filename, "rb") as f:
+        for offset in range(chunk_bytes, size, chunk_bytes):
+            f.seek(offset - 1)
+            f.readline()  # to the start of the next line (offset itself if the previous byte ends a line)
+            if f.tell() > starts[-1] and f.tell() < size:
+                starts.append(f.tell())
+    return list(zip(starts, starts[1:] + [size]))
+
+
+def tokenize_gcode_chunk(filename: str, start: int, end: int) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Tokenizes the G commands of the lines in a byte range of the file, as GCodeInterpolator.iter_instructions.
+    return: command numbers, values of the _MODAL_WORDS (n x 6, 0 where absent) and their presence (n x 6)"""
+    with open(filename, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    lines = io.TextIOWrapper(io.BytesIO(data))  # decoded like open(filename) does
+    numbers, values, present = [], [], []
+    for command, coords in GCodeInterpolator(_instruction_lines(lines)).iter_instructions():
+        numbers.append(command.number)
+        values.append([coords.get(word, 0.0) for word in _MODAL_WORDS])
+        present.append([word in coords for word in _MODAL_WORDS])
+    return (np.array(numbers, dtype=np.int64), np.array(values, dtype=float).reshape(-1, len(_MODAL_WORDS)),
+            np.array(present, dtype=bool).reshape(-1, len(_MODAL_WORDS)))
+
+
+def _resolve_modal(numbers: np.ndarray, values: np.ndarray, present: np.ndarray,
+                   state: _ModalState) -> typing.Tuple[np.ndarray, _ModalState]:
+    """segment rows of a tokenized chunk, as GCodeInterpolator.iter_segments would yield them after `state`"""
+    n = len(numbers)
+    index = np.arange(n)
+    motion = (numbers >= 0) & (numbers <= 3)
+    position_present = present[:, :3]
+    if state.has_point:
+        first = -1
+    else:  # every command sets the coordinates until all three are known, then only the motion commands
+        known = np.logical_or.accumulate(position_present, axis=0) | np.array(state.known)
+        complete = np.flatnonzero(known.all(axis=1))
+        first = int(complete[0]) if len(complete) > 0 else n
+    updates = motion | (index <= first)
+
+    def forward_fill(column: int, mask: np.ndarray, carried: float) -> np.ndarray:
+        source = np.maximum.accumulate(np.where(mask, index, -1)) if n > 0 else index
+        return np.where(source >= 0, values[np.maximum(source, 0), column], carried)
+
+    after = np.column_stack([forward_fill(c, position_present[:, c] & updates, state.position[c]) for c in range(3)])
+    before = np.vstack((np.array(state.position, dtype=float), after[:-1])).reshape(-1, 3)
+    feeds = forward_fill(3, present[:, 3], state.feed)
+
+    emit = (index == first) | ((index > first) & motion)
+    arcs = emit & (index != first) & (numbers >= 2)
+    missing = np.flatnonzero(arcs & ~(present[:, 4] & present[:, 5]))
+    if len(missing) > 0:
+        raise KeyError("I" if not present[missing[0], 4] else "J")
+    kinds = np.where(index == first, RAPID, numbers)
+    start = np.where((kinds == RAPID)[:, None], after[:, :2], before[:, :2])
+    rows = np.column_stack((kinds, start, after, np.where(arcs[:, None], values[:, 4:6], 0.0), feeds))[emit]
+
+    if n == 0:
+        return rows, state
+    new_state = _ModalState(tuple(after[-1].tolist()),
+                            tuple((np.array(state.known) | (position_present & updates[:, None]).any(axis=0)).tolist()),
+                            float(feeds[-1]), state.has_point or first < n)
+    return rows, new_state
+
+
+def parse_gcode_file(filename: str, processes: typing.Optional[int] = None,
+                     executor: typing.Optional[concurrent.futures.Executor] = None,
+                     chunk_bytes: typing.Optional[int] = None) -> np.ndarray:
+    """The segments of a G-code file (rows of `Segment` fields), identical to GCodeInterpolator.iter_segments, with
+    the file tokenized in parallel.
+    processes: size of the process pool started for the parsing (default: the number of CPUs), 1 parses in this
+    process; or an `executor` to use
+    chunk_bytes: size of the byte ranges tokenized at once, by default a few per process (at most PARSE_CHUNK_BYTES)
+    """
+    processes = processes or os.cpu_count() or 1
+    if chunk_bytes is None:
+        chunk_bytes = max(min(os.path.getsize(filename) // (4 * processes) + 1, PARSE_CHUNK_BYTES), 1 << 16)
+    ranges = gcode_chunk_ranges(filename, chunk_bytes)
+    own_executor = None
+    if executor is None and processes > 1 and len(ranges) > 1:
+        executor = own_executor = concurrent.futures.ProcessPoolExecutor(min(processes, len(ranges)))
+    try:
+        if executor is None:
+            tokenized = (tokenize_gcode_chunk(filename, start, end) for start, end in ranges)
+        else:
+            tokenized = executor.map(tokenize_gcode_chunk, itertools.repeat(filename), *zip(*ranges))
+        state = _ModalState((0.0, 0.0, 0.0), (False, False, False), 0.0, False)
+        pieces = []
+        for numbers, values, present in tokenized:
+            rows, state = _resolve_modal(numbers, values, present, state)
+            pieces.append(rows)
+    finally:
+        if own_executor is not None:
+            own_executor.shutdown(cancel_futures=True)
+    logger.debug("parsed %s in %d chunks", filename, len(ranges))
+    return np.concatenate(pieces).reshape(-1, len(Segment._fields))
+
+
+class MotionProgram:
+    """Intermediate representation of a G-code file: its motion primitives with resolved absolute coordinates.
+
+    Parsed once, resampled at any resolution. Resampling results are memoized for the RESAMPLE_CACHE_SIZE most
+    recently used resolutions. With a `tolerance` (and kinematics), segments are sampled adaptively, see
+    sample_segments_adaptive.
+    """
+
+    RESAMPLE_CACHE_SIZE = 8
+
+    def __init__(self, segments: typing.Iterable[Segment]):
+        if not isinstance(segments, np.ndarray):
+            segments = list(segments)
+        self.segments = np.array(segments, dtype=float).reshape(-1, len(Segment._fields))
+        self.segments.flags.writeable = False
+        # key -> ((xs, ys, zs), (xs, ys, zs, feeds))
+        self._resampled: typing.OrderedDict[tuple, typing.Tuple[tuple, tuple]] = OrderedDict()
+
+    @classmethod
+    def parse(cls, gcode_instruction_list: typing.Iterable[str]) -> 'MotionProgram':
+        return cls(GCodeInterpolator(gcode_instruction_list).iter_segments())
+
+    @classmethod
+    def from_file(cls, filename: str, processes: int = 1) -> 'MotionProgram':
+        """processes: parse the file in parallel with that many processes (None: all CPUs), see parse_gcode_file"""
+        if processes == 1:
+            return cls.parse(read_gcode_file(filename))
+        return cls(parse_gcode_file(filename, processes))
+
+    def __len__(self):
+        return len(self.segments)
+
+    def resample(self, max_point_dist: float, tolerance: typing.Optional[float] = None,
+                 kinematics: typing.Optional[TwoArmKinematics] = None,
+                 return_feeds: bool = False) -> typing.Tuple[np.ndarray, ...]:
+        """return: read-only x, y, z arrays of the interpolated points, consecutive duplicates removed (and their
+        feeds if `return_feeds`, see point_feeds)"""
+        key = (max_point_dist, tolerance, kinematics)
+        if key in self._resampled:
+            self._resampled.move_to_end(key)
+            coords, with_feeds = self._resampled[key]
+            return with_feeds if return_feeds else coords
+
+        if tolerance is None:
+            xs, ys, zs, feeds = sample_segments(self.segments, max_point_dist, return_feeds=True)
+        else:
+            kinematics = kinematics if kinematics is not None else TwoArmKinematics()
+            xs, ys, zs, feeds = sample_segments_adaptive(self.segments, tolerance, kinematics, max_point_dist,
+                                                         return_feeds=True)
+        with_feeds = PointBuffer.adopt(x=xs, y=ys, z=zs, feed=feeds).remove_duplicates().columns
+        for arr in with_feeds:
+            arr.flags.writeable = False  # shared by every caller of the cache
+        coords = with_feeds[:3]
+        self._resampled[key] = coords, with_feeds
+        if len(self._resampled) > self.RESAMPLE_CACHE_SIZE:
+            self._resampled.popitem(last=False)
+        return with_feeds if return_feeds else coords
+
+    def points(self, max_point_dist: float, tolerance: typing.Optional[float] = None,
+               kinematics: typing.Optional[TwoArmKinematics] = None, with_feed: bool = False) -> PointBuffer:
+        """the resampled points (x, y, z and feed if `with_feed`), sharing the memoized arrays"""
+        columns = self.resample(max_point_dist, tolerance, kinematics, return_feeds=with_feed)
+        return PointBuffer(**dict(zip(('x', 'y', 'z', 'feed'), columns)))
+
+    def iter_interpolated(self, max_point_dist: float, tolerance: typing.Optional[float] = None,
+                          kinematics: typing.Optional[TwoArmKinematics] = None,
+                          with_feed: bool = False) -> typing.Iterator[typing.Union[Point, FeedPoint]]:
+        return iter(self.points(max_point_dist, tolerance, kinematics, with_feed))
+
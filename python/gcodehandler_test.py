@@ -1,6 +1,9 @@
+import os
+import tempfile
 import unittest
 
 from gcodehandler import *
+from synthetic_gcode import dense_arcs, write_gcode
 
 
 class TestCaseWithAllAlmostEqual(unittest.TestCase):
@@ -136,5 +139,209 @@ class GCodeInterpolatorInterpolationTest(TestCaseWithAllAlmostEqual):
         self.assertAllAlmostEquals(expected, interp.xy_list_interpolated, delta=0.01)
 
 
+class GCodeInterpolatorStreamingTest(TestCaseWithAllAlmostEqual):
+    def test_points_yielded_before_input_is_exhausted(self):
+        consumed_lines = []
+
+        def lines():
+            yield "G00 X0 Y0 Z0\n"
+            for k in itertools.count(1):
+                line = f"G01 X{k} Y0\n"
+                consumed_lines.append(line)
+                yield line
+
+        points = GCodeInterpolator(lines(), 0.5).iter_interpolated()
+        first_points = list(itertools.islice(points, 4))
+
+        self.assertAllAlmostEquals([(0, 0, 0), (0.5, 0, 0), (1, 0, 0), (1.5, 0, 0)], first_points, delta=0.01)
+        self.assertLessEqual(len(consumed_lines), 2)
+
+    def test_streamed_points_match_list(self):
+        text = [
+            "G00 X3 Y3 z0\n",
+            "G03 X1 Y1 i0 j-2\n",
+            "G01 X1 Y1 Z-1\n",
+            "G01 X2.5 Y1\n",
+        ]
+        interp = GCodeInterpolator(text, 0.3)
+        self.assertEqual(interp.xy_list_interpolated, list(interp.iter_interpolated()))
+
+
+class SampleSegmentsTest(TestCaseWithAllAlmostEqual):
+    def test_batch_matches_single_segments(self):
+        text = [
+            "G00 X3 Y3 z1\n",
+            "G01 X7.5 Y7.5\n",
+            "G02 X9.5 Y9.5 i2 j0\n",
+            "G01 Z-1\n",
+            "G03 X7.5 Y7.5 i0 j-2\n",
+            "G00 X0 Y0\n",
+            "G01 X-2 Y-4\n",
+        ]
+        segments = np.array(list(GCodeInterpolator(text).iter_segments()))
+        batched = np.column_stack(sample_segments(segments, 0.7))
+        one_by_one = np.concatenate([np.column_stack(sample_segments(segments[k:k + 1], 0.7))
+                                     for k in range(len(segments))])
+        self.assertAllAlmostEquals(one_by_one.tolist(), batched.tolist(), places=12)
+
+    def test_duplicates_removed_across_batches(self):
+        buffer = PointBuffer(x=[1.0, 1.0, 2.0], y=np.zeros(3), z=np.zeros(3)).remove_duplicates((1.0, 0.0, 0.0))
+        self.assertEqual([2.0], buffer.x.tolist())
+
+
+class AdaptiveSamplingTest(TestCaseWithAllAlmostEqual):
+    def setUp(self):
+        self.kinematics = TwoArmKinematics()
+        self.text = [
+            "G00 X5 Y5 z0\n",
+            "G01 X70 Y60\n",
+            "G03 X50 Y60 i-10 j0\n",
+            "G01 X50 Y60 Z-1\n",
+            "G00 X10 Y70\n",
+        ]
+        self.segments = MotionProgram.parse(self.text).segments
+
+    def pen_path_deviation(self, xs: np.ndarray, ys: np.ndarray, distance) -> float:
+        """largest distance of the pen from the drawing while moving linearly in joint space between the points"""
+        solution = self.kinematics.inverse(np.column_stack((xs, ys)))
+        u = np.linspace(0, 1, 101)[:, None]
+        pen_xs, pen_ys = self.kinematics.forward(solution.alpha1[:-1] + u * np.diff(solution.alpha1),
+                                                 solution.alpha2[:-1] + u * np.diff(solution.alpha2))
+        return distance(pen_xs, pen_ys).max()
+
+    def test_pen_path_within_tolerance(self):
+        for tolerance in [0.1, 0.01]:
+            xs, ys, zs = sample_segments_adaptive(self.segments[1:3], tolerance, self.kinematics)
+            corner = int(np.flatnonzero((xs == 70) & (ys == 60))[0])
+            line_xs, line_ys = np.concatenate(([5], xs[:corner + 1])), np.concatenate(([5], ys[:corner + 1]))
+            arc_xs, arc_ys = xs[corner:], ys[corner:]
+            self.assertLessEqual(self.pen_path_deviation(
+                line_xs, line_ys, lambda px, py: np.abs((px - 5) * 55 - (py - 5) * 65) / np.hypot(65, 55)), tolerance)
+            self.assertLessEqual(self.pen_path_deviation(
+                arc_xs, arc_ys, lambda px, py: np.abs(np.hypot(px - 60, py - 60) - 10)), tolerance)
+
+    def test_far_fewer_points_than_fixed_spacing(self):
+        adaptive = PointBuffer(**dict(zip('xyz', sample_segments_adaptive(self.segments, 0.01, self.kinematics))))
+        fixed = PointBuffer(**dict(zip('xyz', sample_segments(self.segments, 0.1))))
+        self.assertLess(len(adaptive.remove_duplicates()), len(fixed.remove_duplicates()) / 5)
+        self.assertEqual((10, 70, -1), adaptive[-1])
+
+    def test_max_point_dist_is_upper_bound(self):
+        xs, ys, _ = sample_segments_adaptive(self.segments[:2], 1000, self.kinematics, max_point_dist=2)
+        self.assertLessEqual(np.hypot(np.diff(xs), np.diff(ys)).max(), 2 + 1e-9)
+
+    def test_interpolator_and_program_agree(self):
+        streamed = list(GCodeInterpolator(self.text, math.inf, chord_tolerance_mm=0.05).iter_interpolated())
+        program = MotionProgram.parse(self.text)
+        self.assertAllAlmostEquals(streamed, program.points(math.inf, 0.05), places=12)
+        self.assertIs(program.resample(math.inf, 0.05), program.resample(math.inf, 0.05))
+
+
+class MotionProgramTest(TestCaseWithAllAlmostEqual):
+    def setUp(self):
+        self.text = [
+            "G00 X3 Y3 z0\n",
+            "G03 X1 Y1 i0 j-2\n",
+            "G01 X1 Y1 Z-1\n",
+            "G02 X3 Y3 i2 j0\n",
+        ]
+        self.program = MotionProgram.parse(self.text)
+
+    def test_segments(self):
+        self.assertEqual([RAPID, ARC_CCW, LINE, ARC_CW], self.program.segments[:, 0].tolist())
+        self.assertEqual([3, 3, 1, 1, 0, 0, -2, 0], self.program.segments[1, 1:].tolist())
+
+    def test_feeds(self):
+        text = ["G00 X0 Y0 Z1 F900\n", "G01 X0 Y0 Z-1\n", "G01 X2 Y0 F300\n", "G00 X0 Y5 Z1\n",
+                "G02 X2 Y5 I1 J0\n"]
+        program = MotionProgram.parse(text)
+        self.assertEqual([900, 900, 300, 300, 300], program.segments[:, 8].tolist())
+        xs, ys, zs, feeds = program.resample(0.5, return_feeds=True)
+        self.assertEqual(RAPID_FEED, feeds[0])
+        self.assertEqual([900] + [300] * 4, feeds[1:6].tolist())  # pen down, then the line
+        self.assertEqual(([2], [0]), (xs[5:6].tolist(), ys[5:6].tolist()))
+        self.assertEqual([(0, 5, 1, RAPID_FEED)], [p for p in zip(xs, ys, zs, feeds) if p[1] == 5 and p[0] == 0])
+        self.assertTrue(np.all(feeds[7:] == 300))
+        self.assertEqual(list(program.iter_interpolated(0.5, with_feed=True)),
+                         list(GCodeInterpolator(text, 0.5).iter_interpolated(with_feed=True)))
+        self.assertEqual(program.points(0.5), list(GCodeInterpolator(text, 0.5).iter_interpolated()))
+
+    def test_resample_matches_interpolator(self):
+        for max_point_dist in [2, 1, 0.3]:
+            expected = GCodeInterpolator(self.text, max_point_dist).xy_list_interpolated
+            self.assertAllAlmostEquals(expected, self.program.points(max_point_dist), places=12)
+            self.assertAllAlmostEquals(expected, list(self.program.iter_interpolated(max_point_dist)), places=12)
+
+    def test_resample_is_memoized(self):
+        first = self.program.resample(0.5)
+        self.assertIs(first, self.program.resample(0.5))
+        self.assertFalse(first[0].flags.writeable)
+
+    def test_resample_cache_is_bounded(self):
+        first = self.program.resample(0.5)
+        for k in range(MotionProgram.RESAMPLE_CACHE_SIZE):
+            self.program.resample(1 + k)
+        self.assertIsNot(first, self.program.resample(0.5))
+
+    def test_changing_resolution_does_not_reparse(self):
+        interp = GCodeInterpolator(iter(self.text), 2)  # one-shot source
+        coarse = interp.xy_list_interpolated
+        interp.max_point_distance_mm = 0.5
+        self.assertEqual(0.5, interp.max_point_distance_mm)
+        self.assertGreater(len(interp.xy_list_interpolated), len(coarse))
+
+
+class ParallelParseTest(unittest.TestCase):
+    TEXT = ["(Header)\r\n", "G21 (All units in mm)\r\n", "\r\n", "g00 Z5.000000 F800\n", "G90 X1\n", "M3\n",
+            "G01 Y2 (not a point until X, Y and Z are known)\n", "G00 X32.758016 Y69.299180\n", "G92 X7 F500\n",
+            "G01 Z-0.125000 F100.0(Penetrate)\n", "g03 X29.636206 y68.702469 Z-0.125000 I4.877502 J-33.982124\n",
+            "G02 X25.484210 Y67.556340 I14.691402 J-61.315086 F400.000000 ; arc\n", "G00 Z5\n", "G01 X3 Y3\n",
+            "G03 X1 Y1 I0 J-2"]
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+
+    def write(self, name: str, lines: typing.Iterable[str]) -> str:
+        filename = os.path.join(self.tmp, name)
+        with open(filename, "w", newline="") as f:
+            f.writelines(lines)
+        return filename
+
+    def test_identical_to_single_threaded_at_any_chunking(self):
+        filename = self.write("edge.ngc", self.TEXT)
+        expected = MotionProgram.from_file(filename).segments
+        self.assertEqual([RAPID, RAPID, LINE, ARC_CCW, ARC_CW, RAPID, LINE, ARC_CCW], expected[:, 0].tolist())
+        for chunk_bytes in (1, 7, 16, 100, 10000):
+            self.assertEqual(expected.tolist(), parse_gcode_file(filename, 1, chunk_bytes=chunk_bytes).tolist())
+
+    def test_process_pool(self):
+        filename = self.write("arcs.ngc", [])
+        write_gcode(filename, dense_arcs(), 200000)
+        expected = MotionProgram.from_file(filename).segments
+        self.assertGreater(len(gcode_chunk_ranges(filename, 20000)), 5)
+        self.assertEqual(expected.tolist(), parse_gcode_file(filename, 2, chunk_bytes=20000).tolist())
+        self.assertEqual(expected.tolist(), MotionProgram.from_file(filename, processes=2).segments.tolist())
+
+    def test_chunk_ranges_start_at_lines(self):
+        filename = self.write("edge.ngc", self.TEXT)
+        with open(filename, "rb") as f:
+            data = f.read()
+        ranges = gcode_chunk_ranges(filename, 10)
+        self.assertEqual((0, len(data)), (ranges[0][0], ranges[-1][1]))
+        for (_, end), (start, _) in zip(ranges[:-1], ranges[1:]):
+            self.assertEqual(end, start)
+            self.assertEqual(b"\n", data[start - 1:start])
+
+    def test_arc_without_center(self):
+        filename = self.write("bad.ngc", ["G00 X1 Y1 Z1\n", "G01 X2\n", "G02 X3 Y3 I1\n"])
+        with self.assertRaises(KeyError) as expected:
+            MotionProgram.from_file(filename)
+        with self.assertRaises(KeyError) as parallel:
+            parse_gcode_file(filename, 1, chunk_bytes=5)
+        self.assertEqual(expected.exception.args, parallel.exception.args)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,197 @@
+import hashlib
+import itertools
+import json
+import os
+import struct
+import tempfile
+import typing
+from collections import namedtuple
+
+import numpy as np
+
+from gcodehandler import *
+from kinematics import *
+from travel_optimizer import *
+from svghandler import *
+
+# job file: <magic> <record count: u64 LE> <header length: u32 LE> <header: JSON> <padding to 16 bytes> <records>
+JOB_MAGIC = b"PLOTJOB2"
+_PREAMBLE = struct.Struct("<8sQI")
+RECORD_DTYPE = np.dtype([('alpha1', '<f4'), ('alpha2', '<f4'), ('pen_down', 'u1'),
+                         ('feed', '<f4')])  # packed, 13 bytes; feed: see gcodehandler.point_feeds
+
+JobSettings = namedtuple('JobSettings', ['max_point_dist', 'chord_tolerance', 'reorder_strokes'])
+
+GEOMETRY_FIELDS = ['R1', 'R2', 'l1', 'l2', 'D', 'width', 'height', 'x_min', 'y_min']
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "2arm-wire-plotter", "jobs")
+DEFAULT_MAX_CACHE_BYTES = 512 * 2 ** 20
+
+
+def file_hash(filename: str, block_size: int = 2 ** 20) -> str:
+    """sha256 of the file's content, hex"""
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        while block := f.read(block_size):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def geometry(kinematics: TwoArmKinematics) -> typing.Dict[str, float]:
+    return {field: float(getattr(kinematics, field)) for field in GEOMETRY_FIELDS}
+
+
+class CompiledJob:
+    """Memory-mapped job file: arm angles, pen states and feeds of every point, ready to be sent to the plotter."""
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        with open(filename, "rb") as f:
+            magic, count, header_length = _PREAMBLE.unpack(f.read(_PREAMBLE.size))
+            if magic != JOB_MAGIC:
+                raise ValueError(f"{filename} is not a job file")
+            self.header = json.loads(f.read(header_length).decode("utf-8"))
+        offset = _data_offset(header_length)
+        if count == 0:
+            self.records = np.empty(0, dtype=RECORD_DTYPE)
+        else:
+            self.records = np.memmap(filename, dtype=RECORD_DTYPE, mode='r', offset=offset, shape=(count,))
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def key(self) -> str:
+        """the job cache key of the job (see JobCache.key)"""
+        return os.path.splitext(os.path.basename(self.filename))[0]
+
+    def iter_chunks(self, size: int, start: int = 0) -> typing.Iterator[np.ndarray]:
+        """consecutive slices of the records from the `start`-th one (views of the mapped file, nothing is read
+        ahead, the ones before `start` are not touched)"""
+        for first in range(start, len(self.records), size):
+            yield self.records[first:first + size]
+
+    def close(self):
+        """drops the mapping (it is unmapped once no chunk refers to it)"""
+        self.records = np.empty(0, dtype=RECORD_DTYPE)
+
+
+def source_points(filename: str, settings: JobSettings, kinematics: TwoArmKinematics) -> typing.Iterator[FeedPoint]:
+    """the points a job is compiled from, as DrawingProcess produces them (for compiling without one)"""
+    if settings.reorder_strokes or is_svg_file(filename):
+        program = read_program(filename)
+        if settings.reorder_strokes:
+            program, _ = optimize_travel(program)
+        return program.iter_interpolated(settings.max_point_dist, settings.chord_tolerance, kinematics,
+                                         with_feed=True)
+    return GCodeInterpolator(read_gcode_file(filename), settings.max_point_dist, settings.chord_tolerance,
+                             kinematics).iter_interpolated(with_feed=True)
+
+
+def _data_offset(header_length: int) -> int:
+    return (_PREAMBLE.size + header_length + 15) // 16 * 16
+
+
+def compile_job(points: typing.Iterable[typing.Union[Point, FeedPoint]], job_filename: str, header: dict,
+                kinematics: TwoArmKinematics, chunk_size: int = 65536):
+    """Solves IK for the points and writes the job file (via a temporary file, so that it appears complete or not
+    at all). Pen states follow DrawingProcess: down below z = 0, up above it, unchanged at 0. The feed of points
+    without one is 0.
+    Raises UnreachablePointsError (with indices into `points`) if a point can not be reached.
+    """
+    header = dict(header, geometry=geometry(kinematics), record_dtype=RECORD_DTYPE.descr)
+    header_bytes = json.dumps(header, sort_keys=True).encode("utf-8")
+    offset = _data_offset(len(header_bytes))
+
+    directory = os.path.dirname(os.path.abspath(job_filename))
+    fd, temp_filename = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(_PREAMBLE.pack(JOB_MAGIC, 0, len(header_bytes)) + header_bytes)
+            f.write(b"\0" * (offset - f.tell()))
+            count = 0
+            pen_down = False
+            iterator = iter(points)
+            while chunk := list(itertools.islice(iterator, chunk_size)):
+                values = np.array(chunk, dtype=float)
+                xyz = values[:, :3]
+                solution = kinematics.inverse(xyz[:, :2])
+                if len(solution.unreachable) > 0:
+                    raise UnreachablePointsError(solution.unreachable + count)
+                # z == 0 keeps the previous state: forward fill the last non-zero z
+                z = xyz[:, 2]
+                signed = np.where(z < 0, 1, np.where(z > 0, -1, 0))
+                last_set = np.maximum.accumulate(np.where(signed != 0, np.arange(len(z)), -1))
+                states = np.where(last_set >= 0, signed[np.maximum(last_set, 0)] > 0, pen_down)
+                pen_down = bool(states[-1])
+
+                records = np.empty(len(chunk), dtype=RECORD_DTYPE)
+                records['alpha1'] = solution.alpha1
+                records['alpha2'] = solution.alpha2
+                records['pen_down'] = states
+                records['feed'] = values[:, 3] if values.shape[1] > 3 else 0.0
+                f.write(records.tobytes())
+                count += len(chunk)
+            f.seek(0)
+            f.write(_PREAMBLE.pack(JOB_MAGIC, count, len(header_bytes)))
+        os.replace(temp_filename, job_filename)
+    except BaseException:
+        os.remove(temp_filename)
+        raise
+
+
+class JobCache:
+    """Compiled jobs, keyed by the source file content, the interpolation settings and the plotter geometry.
+
+    The least recently used job files are deleted once the directory grows over `max_bytes`.
+    """
+
+    def __init__(self, directory: str = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_MAX_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, source_hash: str, settings: JobSettings, kinematics: TwoArmKinematics) -> str:
+        description = json.dumps([JOB_MAGIC.decode(), source_hash, settings._asdict(), geometry(kinematics)],
+                                 sort_keys=True)  # jobs of older formats are not found (and evicted eventually)
+        return hashlib.sha256(description.encode("utf-8")).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".job")
+
+    def get_or_compile(self, source_filename: str, settings: JobSettings, kinematics: TwoArmKinematics,
+                       points: typing.Callable[[], typing.Iterable[typing.Union[Point, FeedPoint]]]) -> CompiledJob:
+        """points: produces the interpolated points of the source with the settings, only called on a cache miss"""
+        source_hash = file_hash(source_filename)
+        path = self.path(self.key(source_hash, settings, kinematics))
+        if os.path.exists(path):
+            os.utime(path)  # recently used
+            self.hits += 1
+        else:
+            self.misses += 1
+            header = {'source': os.path.basename(source_filename), 'source_sha256': source_hash,
+                      'settings': settings._asdict()}
+            compile_job(points(), path, header, kinematics)
+            self.evict(keep=path)
+        return CompiledJob(path)
+
+    def evict(self, keep: typing.Optional[str] = None):
+        """deletes the least recently used jobs until the cache fits in max_bytes"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".job"):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(self.directory, name)))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:  # in use (Windows) or already gone
+                continue
+            total -= size
@@ -0,0 +1,125 @@
+import os
+import tempfile
+import unittest
+
+from drawing_process import *
+from job_cache import *
+from plotter_simulator import *
+
+GCODE = """%
+G21
+G00 Z5.000000
+G00 X10.000000 Y10.000000
+G01 Z-0.125000 F100.0
+G01 X30.000000 Y12.000000 Z-0.125000 F400.000000
+G03 X40.000000 Y22.000000 Z-0.125000 I0.000000 J10.000000 F400.000000
+G00 Z5.000000
+G00 X50.000000 Y50.000000
+G01 Z-0.125000 F100.0
+G01 X55.000000 Y60.000000 Z-0.125000 F400.000000
+G00 Z5.000000
+M2
+%
+"""
+
+
+class JobCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.source = os.path.join(self.tmp.name, "job.ngc")
+        self.write_source(GCODE)
+        self.cache = JobCache(os.path.join(self.tmp.name, "cache"))
+        self.kinematics = TwoArmKinematics()
+        self.settings = JobSettings(0.1, None, False)
+        self.compilations = 0
+
+    def write_source(self, text: str):
+        with open(self.source, "w") as f:
+            f.write(text)
+
+    def points(self) -> typing.Iterator[FeedPoint]:
+        self.compilations += 1
+        return GCodeInterpolator(read_gcode_file(self.source), 0.1).iter_interpolated(with_feed=True)
+
+    def compile(self, settings: typing.Optional[JobSettings] = None) -> CompiledJob:
+        job = self.cache.get_or_compile(self.source, settings or self.settings, self.kinematics, self.points)
+        self.addCleanup(job.close)
+        return job
+
+    def test_records_match_ik_and_pen_states(self):
+        job = self.compile()
+        points = list(self.points())
+        solution = self.kinematics.inverse([p[0:2] for p in points])
+        self.assertEqual(len(points), len(job))
+        self.assertEqual(13, job.records.itemsize)
+        np.testing.assert_allclose(solution.alpha1, job.records['alpha1'], atol=1e-4)
+        np.testing.assert_allclose(solution.alpha2, job.records['alpha2'], atol=1e-4)
+        pen_down = False
+        np.testing.assert_array_equal(np.array([p[3] for p in points], dtype='<f4'), job.records['feed'])
+        for (_, _, z, _), down in zip(points, job.records['pen_down']):
+            pen_down = z < 0 if z != 0 else pen_down
+            self.assertEqual(pen_down, bool(down))
+        self.assertEqual(file_hash(self.source), job.header['source_sha256'])
+        self.assertEqual(self.kinematics.R1, job.header['geometry']['R1'])
+        self.assertEqual(0.1, job.header['settings']['max_point_dist'])
+
+    def test_repeated_job_not_compiled_again(self):
+        first = self.compile()
+        second = self.compile()
+        self.assertEqual(1, self.compilations)
+        self.assertEqual(first.filename, second.filename)
+        self.assertIsInstance(second.records, np.memmap)
+        self.assertEqual(sum(len(chunk) for chunk in second.iter_chunks(100)), len(second))
+
+    def test_changed_source_settings_or_geometry_recompiled(self):
+        filenames = {self.compile().filename}
+        self.write_source(GCODE.replace("X55.000000", "X56.000000"))
+        filenames.add(self.compile().filename)
+        filenames.add(self.compile(JobSettings(0.2, None, False)).filename)
+        self.kinematics.l1 += 1
+        filenames.add(self.compile().filename)
+        self.assertEqual(4, self.compilations)
+        self.assertEqual(4, len(filenames))
+
+    def test_unreachable_point_leaves_no_file(self):
+        self.write_source(GCODE.replace("X55.000000 Y60.000000", "X500.000000 Y600.000000"))
+        with self.assertRaises(UnreachablePointsError):
+            self.compile()
+        self.assertEqual([], os.listdir(self.cache.directory))
+
+    def test_least_recently_used_evicted(self):
+        first = self.compile()
+        size = os.path.getsize(first.filename)
+        self.cache.max_bytes = 2 * size + size // 2
+        second = self.compile(JobSettings(0.1, None, True))
+        os.utime(first.filename, (0, 0))
+        os.utime(second.filename, (1, 1))
+        self.compile()  # hit, first becomes the most recently used
+        third = self.compile(JobSettings(0.1, 0.01, False))
+        self.assertTrue(os.path.exists(first.filename))
+        self.assertFalse(os.path.exists(second.filename))
+        self.assertTrue(os.path.exists(third.filename))
+
+    def test_drawing_from_cache_sends_same_moves(self):
+        def draw(job_cache):
+            device = SimulatedPlotter()
+            executed = []
+            device.execute = lambda command, then, execute=device.execute: \
+                (executed.append(command), execute(command, then))
+            process = DrawingProcess(PrinterCommander(connection=SimulatedSerial(device)), self.source,
+                                     job_cache=job_cache)
+            process.run()
+            return executed
+
+        direct = draw(None)
+        compiled = draw(self.cache)
+        from_cache = draw(self.cache)
+        self.assertEqual([c[0] for c in direct], [c[0] for c in compiled])
+        self.assertEqual(compiled, from_cache)
+        for expected, actual in zip(direct, compiled):
+            np.testing.assert_allclose(expected[1:], actual[1:], atol=1e-4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,233 @@
+import concurrent.futures
+import itertools
+import logging
+import os
+import threading
+import time
+import typing
+
+from drawing_process import *
+
+logger = logging.getLogger(__name__)
+
+
+def precompile(filename: str, settings: JobSettings, kinematics: TwoArmKinematics, cache_directory: str,
+               cache_max_bytes: int) -> str:
+    """compiles the job into the cache (in a worker process), returns the path of the job file"""
+    cache = JobCache(cache_directory, cache_max_bytes)
+    job = cache.get_or_compile(filename, settings, kinematics, lambda: source_points(filename, settings, kinematics))
+    job.close()
+    return job.filename
+
+
+class PlotJob:
+    """A file in the JobQueue.
+
+    status: queued (waiting for a worker), compiling, ready, plotting, done, failed (see `error`), cancelled
+    """
+
+    def __init__(self, job_id: int, filename: str, priority: int, future: concurrent.futures.Future):
+        self.id = job_id
+        self.filename = filename
+        self.priority = priority
+        self.future = future  # of the precompilation
+        self.state = 'waiting'  # until it is plotted: waiting, plotting, done, failed, cancelled
+        self.error: typing.Optional[BaseException] = None
+        self.added = time.monotonic()
+        self.started: typing.Optional[float] = None
+        self.finished: typing.Optional[float] = None
+        self.idle_before: typing.Optional[float] = None  # seconds the plotter waited for this job
+
+    @property
+    def status(self) -> str:
+        if self.state != 'waiting':
+            return self.state
+        if self.future.done():
+            return 'failed' if self.future.cancelled() or self.future.exception() is not None else 'ready'
+        return 'compiling' if self.future.running() else 'queued'
+
+    def __repr__(self):
+        return f"PlotJob({self.id}, {self.filename!r}, priority={self.priority}, {self.status})"
+
+
+class JobQueue:
+    """Plots the files added to it one after the other, highest priority first (in the order added among equal
+    priorities).
+
+    Every job is compiled into the job cache by a process pool as soon as it is added, so that the next one is
+    usually ready to be streamed when the plotter finishes the current one. The time the plotter waits between
+    jobs (for the next job to be compiled, or to be added) is recorded in the jobs' `idle_before` and in
+    `idle_times`.
+    """
+
+    def __init__(self, printer: PrinterCommander, job_cache: typing.Optional[JobCache] = None,
+                 executor: typing.Optional[concurrent.futures.Executor] = None, max_workers: int = 2,
+                 planner_factory: typing.Optional[typing.Callable[[], MotionPlanner]] = None,
+                 metrics_dir: typing.Optional[str] = None, paused: bool = False, **drawing_options):
+        """drawing_options: passed to every DrawingProcess (interpolation_resolution, chord_tolerance,
+        reorder_strokes, speed, ...), the first three also set up the compilation
+        planner_factory: a new planner for every job
+        metrics_dir: the metrics of every job are exported there (DrawingProcess's metrics_export)
+        paused: no job is started until resume()"""
+        self.printer = printer
+        self.job_cache = job_cache if job_cache is not None else JobCache()
+        self.executor = executor if executor is not None else concurrent.futures.ProcessPoolExecutor(max_workers)
+        self._owns_executor = executor is None
+        self.planner_factory = planner_factory
+        self.metrics_dir = metrics_dir
+        self.drawing_options = drawing_options
+        self.settings = JobSettings(drawing_options.get('interpolation_resolution', 0.1),
+                                    drawing_options.get('chord_tolerance'),
+                                    drawing_options.get('reorder_strokes', False))
+        self.jobs: typing.List[PlotJob] = []
+        self.idle_times: typing.List[float] = []
+        self.current: typing.Optional[PlotJob] = None
+        self.current_process: typing.Optional[DrawingProcess] = None
+        self._ids = itertools.count(1)
+        self._condition = threading.Condition()
+        self._closed = False
+        self._paused = paused
+        self._last_finished: typing.Optional[float] = None
+        self._thread = threading.Thread(target=self._run, name="JobQueue", daemon=True)
+        self._thread.start()
+
+    def add(self, filename: str, priority: int = 0) -> PlotJob:
+        future = self.executor.submit(precompile, filename, self.settings, self.printer.kinematics,
+                                      self.job_cache.directory, self.job_cache.max_bytes)
+        with self._condition:
+            job = PlotJob(next(self._ids), filename, priority, future)
+            self.jobs.append(job)
+            self._condition.notify_all()
+        logger.info("job %d added: %s", job.id, filename)
+        return job
+
+    def job(self, job_id: int) -> PlotJob:
+        return next(job for job in self.jobs if job.id == job_id)
+
+    def cancel(self, job_id: int):
+        """the job is not plotted, or stopped if it is being plotted"""
+        with self._condition:
+            job = self.job(job_id)
+            if job.state == 'plotting':
+                self.current_process.stop()
+            elif job.state == 'waiting':
+                job.future.cancel()  # a compilation in progress is finished, the result is left in the cache
+                job.state = 'cancelled'
+                self._condition.notify_all()
+
+    def set_priority(self, job_id: int, priority: int):
+        with self._condition:
+            self.job(job_id).priority = priority
+
+    def pause(self):
+        """no further job is started (the current one is finished)"""
+        with self._condition:
+            self._paused = True
+
+    def resume(self):
+        with self._condition:
+            self._paused = False
+            self._condition.notify_all()
+
+    def status(self) -> typing.List[typing.Tuple[int, str, str, int]]:
+        """(id, file name, status, priority) of every job, in the order they are plotted (the plotted ones first)"""
+        with self._condition:
+            waiting = sorted((job for job in self.jobs if job.state == 'waiting'), key=self._order)
+            others = sorted((job for job in self.jobs if job.state != 'waiting'),
+                            key=lambda job: job.started if job.started is not None else job.added)
+            return [(job.id, os.path.basename(job.filename), job.status, job.priority) for job in others + waiting]
+
+    @property
+    def busy(self) -> bool:
+        """a job is being plotted or waiting to be plotted"""
+        with self._condition:
+            return any(job.state in ('waiting', 'plotting') for job in self.jobs)
+
+    @property
+    def total_idle(self) -> float:
+        return sum(self.idle_times)
+
+    def join(self, timeout: typing.Optional[float] = None) -> bool:
+        """waits until every job is plotted, returns False on timeout"""
+        with self._condition:
+            return self._condition.wait_for(lambda: not any(job.state in ('waiting', 'plotting')
+                                                             for job in self.jobs), timeout)
+
+    def close(self):
+        """stops the current job, cancels the rest (and shuts down the pool unless it was given)"""
+        with self._condition:
+            self._closed = True
+            for job in self.jobs:
+                if job.state == 'waiting':
+                    job.future.cancel()
+                    job.state = 'cancelled'
+            if self.current_process is not None:
+                self.current_process.stop()
+            self._condition.notify_all()
+        self._thread.join()
+        if self._owns_executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    def _order(job: PlotJob) -> typing.Tuple[int, int]:
+        return -job.priority, job.id
+
+    def _next_job(self) -> typing.Optional[PlotJob]:
+        waiting = [job for job in self.jobs if job.state == 'waiting']
+        return min(waiting, key=self._order) if waiting else None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._closed or not self._paused and self._next_job() is not None)
+                if self._closed:
+                    return
+                job = self._next_job()
+            try:
+                job.future.result()  # compiled by the pool
+            except BaseException as e:
+                with self._condition:
+                    if job.state == 'waiting':  # not cancelled
+                        job.state = 'failed'
+                        job.error = e
+                        logger.warning("job %d (%s) failed: %r", job.id, job.filename, e)
+                    self._condition.notify_all()
+                continue
+            with self._condition:
+                if job.state != 'waiting' or self._closed or self._paused:
+                    continue
+                if self._next_job() is not job:  # reprioritized while it was compiled
+                    continue
+                self._start(job)
+            self._plot(job)
+
+    def _start(self, job: PlotJob):
+        job.state = 'plotting'
+        job.started = time.monotonic()
+        if self._last_finished is not None:
+            job.idle_before = job.started - max(self._last_finished, job.added)
+            self.idle_times.append(job.idle_before)
+            logger.info("plotter idle for %.3f s before job %d", job.idle_before, job.id)
+        metrics_export = os.path.join(self.metrics_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{job.id}") \
+            if self.metrics_dir is not None else None
+        planner = self.planner_factory() if self.planner_factory is not None else None
+        self.current = job
+        self.current_process = DrawingProcess(self.printer, job.filename, job_cache=self.job_cache,
+                                              planner=planner, metrics_export=metrics_export,
+                                              **self.drawing_options)
+
+    def _plot(self, job: PlotJob):
+        process = self.current_process
+        process.start()
+        process.join()
+        with self._condition:
+            job.finished = self._last_finished = time.monotonic()
+            if process.stop_event.is_set():
+                job.state = 'cancelled'
+            elif process.error is not None:
+                job.state = 'failed'
+                job.error = process.error
+            else:
+                job.state = 'done'
+            logger.info("job %d %s", job.id, job.state)
+            self._condition.notify_all()
@@ -0,0 +1,104 @@
+import concurrent.futures
+import os
+import tempfile
+import unittest
+
+from job_queue import *
+from plotter_simulator import *
+from synthetic_gcode import dense_arcs, pen_lifts, write_gcode
+
+
+class JobQueueTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.executor = concurrent.futures.ProcessPoolExecutor(2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.executor.shutdown()
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        self.device = SimulatedPlotter()
+        self.cache = JobCache(os.path.join(self.tmp, "cache"))
+        self.queue = None
+
+    def tearDown(self):
+        if self.queue is not None:
+            self.queue.close()
+
+    def source(self, name: str, lines, size: int = 3000) -> str:
+        filename = os.path.join(self.tmp, name)
+        write_gcode(filename, lines, size)
+        return filename
+
+    def make_queue(self, executor=None, paused: bool = False) -> JobQueue:
+        self.queue = JobQueue(PrinterCommander(connection=SimulatedSerial(self.device)), self.cache,
+                              executor=executor or self.executor, paused=paused, interpolation_resolution=0.5)
+        return self.queue
+
+    def test_jobs_plotted_by_priority_from_the_precompiled_cache(self):
+        queue = self.make_queue(paused=True)
+        sources = [self.source(f"job{k}.ngc", dense_arcs(k)) for k in range(4)]
+        jobs = [queue.add(source, priority) for source, priority in zip(sources, (0, 0, 5, 1))]
+        concurrent.futures.wait([job.future for job in jobs])
+        self.assertEqual(['ready'] * 4, [status for _, _, status, _ in queue.status()])
+        self.assertEqual([3, 4, 1, 2], [job_id for job_id, _, _, _ in queue.status()])
+        queue.resume()
+        self.assertTrue(queue.join(60))
+
+        self.assertEqual(['done'] * 4, [job.status for job in jobs])
+        self.assertEqual([jobs[2], jobs[3], jobs[0], jobs[1]], sorted(jobs, key=lambda job: job.started))
+        self.assertEqual(4, self.cache.hits)  # compiled by the pool, not by the plotting thread
+        self.assertEqual(0, self.cache.misses)
+        self.assertEqual(3, len(queue.idle_times))
+        self.assertTrue(all(idle >= 0 for idle in queue.idle_times))
+        self.assertFalse(queue.busy)
+
+    def test_cancel_and_reprioritize_before_plotting(self):
+        executor = concurrent.futures.ThreadPoolExecutor(1)
+        gate = threading.Event()
+        executor.submit(gate.wait)  # nothing compiles until the gate opens
+        queue = self.make_queue(executor)
+        first, second, third = (queue.add(self.source(f"job{k}.ngc", pen_lifts(k))) for k in range(3))
+        self.assertEqual('queued', second.status)
+        queue.cancel(second.id)
+        queue.set_priority(third.id, 10)
+        self.assertEqual([(2, 'cancelled'), (3, 'queued'), (1, 'queued')],
+                         [(job_id, status) for job_id, _, status, _ in queue.status()])
+        gate.set()
+        self.assertTrue(queue.join(60))
+        executor.shutdown()
+        self.assertEqual('cancelled', second.status)
+        self.assertIsNone(second.started)
+        self.assertLess(third.started, first.started)
+        self.assertEqual('done', first.status)
+
+    def test_failed_job_reported_and_skipped(self):
+        unreachable = os.path.join(self.tmp, "far.ngc")
+        with open(unreachable, "w") as f:
+            f.write("G00 X10 Y10 Z1\nG01 Z-1\nG01 X500 Y500\n")
+        queue = self.make_queue()
+        failed = queue.add(unreachable, priority=1)
+        done = queue.add(self.source("job.ngc", pen_lifts()))
+        self.assertTrue(queue.join(60))
+        self.assertEqual('failed', failed.status)
+        self.assertIsInstance(failed.future.exception(), UnreachablePointsError)
+        self.assertEqual('done', done.status)
+        self.assertGreater(self.device.moves, 0)
+
+    def test_plotting_job_cancelled(self):
+        queue = self.make_queue()
+        job = queue.add(self.source("big.ngc", dense_arcs(), 200000))
+        job.future.result()
+        while job.status != 'plotting':
+            time.sleep(0.001)
+        queue.cancel(job.id)
+        self.assertTrue(queue.join(60))
+        self.assertEqual('cancelled', job.status)
+
+
+if __name__ == '__main__':
+    unittest.main()
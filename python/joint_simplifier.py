@@ -0,0 +1,140 @@
+import math
+import typing
+from collections import namedtuple
+
+import numpy as np
+
+from kinematics import *
+
+STEP_ANGLE = 360.0 / (32 * 63.68395)  # degrees, stepper.h: STEPS_PER_REV * GEAR_RED steps per output revolution
+JACOBIAN_STEP = 1e-3  # degrees, finite difference of the forward kinematics
+
+Move = typing.Tuple[float, ...]  # x, y, z, alpha1, alpha2[, feed[, index]] (see gcodehandler.FeedPoint)
+
+class SimplificationReport(namedtuple('SimplificationReport', ['points_in', 'points_out'])):
+    __slots__ = ()
+
+    @property
+    def points_removed(self) -> int:
+        return self.points_in - self.points_out
+
+
+def pen_sensitivity(kinematics: TwoArmKinematics, alpha1: np.ndarray, alpha2: np.ndarray) -> np.ndarray:
+    """upper bound of the pen movement in mm per degree of joint movement in any direction (Frobenius norm of the
+    Jacobian of the forward kinematics) at every point"""
+    x, y = kinematics.forward(alpha1, alpha2)
+    x1, y1 = kinematics.forward(alpha1 + JACOBIAN_STEP, alpha2)
+    x2, y2 = kinematics.forward(alpha1, alpha2 + JACOBIAN_STEP)
+    return np.sqrt((x1 - x) ** 2 + (y1 - y) ** 2 + (x2 - x) ** 2 + (y2 - y) ** 2) / JACOBIAN_STEP
+
+
+def angle_tolerance(kinematics: TwoArmKinematics, alpha1: np.ndarray, alpha2: np.ndarray,
+                    cartesian_tolerance: float, step_angle: float = STEP_ANGLE) -> float:
+    """joint space deviation (degrees) allowed along the path
+
+    Within half a step the firmware rounds the targets to the same positions anyway, beyond that the deviation is
+    limited so that the pen stays within `cartesian_tolerance` mm wherever the arms are most sensitive.
+    """
+    sensitivity = np.nanmax(pen_sensitivity(kinematics, alpha1, alpha2), initial=0)
+    cartesian = cartesian_tolerance / sensitivity if sensitivity > 0 else math.inf
+    return max(step_angle / 2, cartesian)
+
+
+def simplify_joint_path(alpha1: np.ndarray, alpha2: np.ndarray, tolerance: float) -> np.ndarray:
+    """Douglas-Peucker in joint space: indices of the points to keep (the first and last ones always are)
+
+    The firmware moves both motors linearly between targets, so the distance of a dropped point from the segment
+    between the kept ones is exactly how far the arms deviate from it.
+    """
+    n = len(alpha1)
+    if n <= 2:
+        return np.arange(n)
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        a1 = alpha1[start + 1:end] - alpha1[start]
+        a2 = alpha2[start + 1:end] - alpha2[start]
+        d1 = alpha1[end] - alpha1[start]
+        d2 = alpha2[end] - alpha2[start]
+        length_sq = d1 * d1 + d2 * d2
+        t = np.clip((a1 * d1 + a2 * d2) / length_sq, 0, 1) if length_sq > 0 else np.zeros(len(a1))
+        distance_sq = (a1 - t * d1) ** 2 + (a2 - t * d2) ** 2
+        farthest = int(np.argmax(distance_sq))
+        if distance_sq[farthest] > tolerance * tolerance:
+            middle = start + 1 + farthest
+            keep[middle] = True
+            stack.append((start, middle))
+            stack.append((middle, end))
+    return np.flatnonzero(keep)
+
+
+class JointPathSimplifier:
+    """Drops the targets a joint-linear move between their neighbours reaches anyway (within tolerance) and the
+    moves that stay within the same motor steps, looking ahead at most `lookahead` points.
+
+    Points where the pen goes up or down or the feed changes are always kept.
+    """
+
+    def __init__(self, kinematics: TwoArmKinematics, cartesian_tolerance: float = 0.05,
+                 step_angle: float = STEP_ANGLE, lookahead: int = 256):
+        self.kinematics = kinematics
+        self.cartesian_tolerance = cartesian_tolerance
+        self.step_angle = step_angle
+        self.lookahead = max(lookahead, 3)
+        self.points_in = 0
+        self.points_out = 0
+        self._last_steps: typing.Optional[typing.Tuple[int, int]] = None  # of the last point given out
+
+    @property
+    def report(self) -> SimplificationReport:
+        return SimplificationReport(self.points_in, self.points_out)
+
+    def steps(self, alpha: float) -> int:
+        return round(alpha / self.step_angle)
+
+    def simplify(self, moves: typing.Iterable[Move]) -> typing.Iterator[Move]:
+        window: typing.List[Move] = []
+        new_pen_state = True  # the window starts with a pen state (sent with its first point)
+        for move in moves:
+            self.points_in += 1
+            if window and (np.sign(move[2]) != np.sign(window[-1][2]) or move[5:6] != window[-1][5:6]):
+                yield from self._flush(window, new_pen_state, keep_last=True)
+                window = []
+                new_pen_state = True
+            window.append(move)
+            if len(window) == self.lookahead:
+                yield from self._flush(window, new_pen_state, keep_last=False)
+                window = window[-1:]  # the end of this window starts the next one
+                new_pen_state = False
+        yield from self._flush(window, new_pen_state, keep_last=True)
+
+    def _flush(self, window: typing.List[Move], new_pen_state: bool, keep_last: bool) -> typing.Iterator[Move]:
+        """kept points of the window, without its last one unless `keep_last`"""
+        if not window:
+            return
+        alpha1 = np.array([move[3] for move in window])
+        alpha2 = np.array([move[4] for move in window])
+        tolerance = angle_tolerance(self.kinematics, alpha1, alpha2, self.cartesian_tolerance, self.step_angle)
+        indices = simplify_joint_path(alpha1, alpha2, tolerance).tolist()
+        if not keep_last:
+            indices = indices[:-1]
+        for k in indices:
+            move = window[k]
+            steps = self.steps(move[3]), self.steps(move[4])
+            if steps == self._last_steps and not (k == 0 and new_pen_state):
+                continue  # the motors would not move
+            self._last_steps = steps
+            self.points_out += 1
+            yield move
+
+
+def simplify_moves(kinematics: TwoArmKinematics, moves: typing.Sequence[Move], cartesian_tolerance: float = 0.05,
+                   step_angle: float = STEP_ANGLE) -> typing.Tuple[typing.List[Move], SimplificationReport]:
+    """simplification of a whole job at once (no lookahead limit)"""
+    simplifier = JointPathSimplifier(kinematics, cartesian_tolerance, step_angle, lookahead=max(len(moves), 3))
+    simplified = list(simplifier.simplify(moves))
+    return simplified, simplifier.report
@@ -0,0 +1,107 @@
+import math
+import os
+import tempfile
+import unittest
+
+from synthetic_gcode import dense_arcs, write_gcode
+
+from drawing_process import *
+from joint_simplifier import *
+from plotter_simulator import *
+
+
+def segment_distance(p, a, b) -> float:
+    d = np.subtract(b, a)
+    length_sq = float(d @ d)
+    t = min(max(float(np.subtract(p, a) @ d) / length_sq, 0), 1) if length_sq > 0 else 0
+    return float(np.hypot(*(np.subtract(p, a) - t * d)))
+
+
+class JointPathSimplifierTest(unittest.TestCase):
+    def setUp(self):
+        self.kinematics = TwoArmKinematics()
+
+    def moves(self, xys, z: float = -1) -> typing.List[Move]:
+        solution = self.kinematics.inverse(xys)
+        return [(x, y, z, a1, a2) for (x, y), a1, a2 in zip(xys, solution.alpha1.tolist(), solution.alpha2.tolist())]
+
+    def circle(self, n: int, z: float = -1) -> typing.List[Move]:
+        phis = np.linspace(0, 2 * math.pi, n)
+        return self.moves(list(zip((40 + 20 * np.cos(phis)).tolist(), (40 + 20 * np.sin(phis)).tolist())), z)
+
+    def test_joint_line_collapses_to_end_points(self):
+        alpha1 = np.linspace(30, 60, 100)
+        alpha2 = np.linspace(50, 20, 100)
+        self.assertEqual([0, 99], simplify_joint_path(alpha1, alpha2, 1e-6).tolist())
+
+    def test_dropped_points_within_tolerance(self):
+        moves = self.circle(2000)
+        alpha1 = np.array([m[3] for m in moves])
+        alpha2 = np.array([m[4] for m in moves])
+        tolerance = angle_tolerance(self.kinematics, alpha1, alpha2, 0.05)
+        self.assertGreaterEqual(tolerance, STEP_ANGLE / 2)
+        kept = simplify_joint_path(alpha1, alpha2, tolerance)
+        self.assertLess(len(kept), len(moves) / 5)
+        for start, end in zip(kept[:-1], kept[1:]):
+            for k in range(start + 1, end):
+                self.assertLessEqual(segment_distance((alpha1[k], alpha2[k]), (alpha1[start], alpha2[start]),
+                                                      (alpha1[end], alpha2[end])), tolerance + 1e-9)
+
+    def test_sub_step_moves_merged(self):
+        a1, a2 = 226 * STEP_ANGLE, 340 * STEP_ANGLE  # at whole steps
+        jitter = [(0, 0, -1, a1 + 0.3 * STEP_ANGLE * math.sin(k), a2 + 0.3 * STEP_ANGLE * math.cos(k))
+                  for k in range(50)]
+        simplified, report = simplify_moves(self.kinematics, jitter)
+        self.assertEqual(1, len(simplified))
+        self.assertEqual(49, report.points_removed)
+
+    def test_pen_changes_kept(self):
+        moves = self.circle(300, -1) + self.circle(300, 1) + self.circle(300, -1)
+        simplified, report = simplify_moves(self.kinematics, moves)
+        self.assertEqual(report.points_out, len(simplified))
+        for k in (0, 300, 600):
+            self.assertIn(moves[k], simplified)
+        self.assertEqual(moves[-1], simplified[-1])
+        self.assertEqual([-1, 1, -1], [z for z, _ in itertools.groupby(m[2] for m in simplified)])
+
+    def test_lookahead_bounded(self):
+        moves = self.circle(3000)
+        consumed = []
+
+        def source():
+            for move in moves:
+                consumed.append(move)
+                yield move
+
+        simplifier = JointPathSimplifier(self.kinematics, lookahead=64)
+        for move in simplifier.simplify(source()):
+            self.assertLessEqual(len(consumed) - moves.index(move), 64)
+        self.assertEqual(len(moves), simplifier.report.points_in)
+        whole, _ = simplify_moves(self.kinematics, moves)
+        self.assertLess(simplifier.report.points_out, 1.5 * len(whole))
+
+    def test_drawing_process_sends_fewer_moves(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "arcs.ngc")
+            write_gcode(filename, dense_arcs(), 5000)
+            self.check_drawing_process_sends_fewer_moves(filename)
+
+    def check_drawing_process_sends_fewer_moves(self, filename: str):
+        def draw(simplify_tolerance):
+            device = SimulatedPlotter()
+            process = DrawingProcess(PrinterCommander(connection=SimulatedSerial(device)), filename,
+                                     simplify_tolerance=simplify_tolerance)
+            process.run()
+            return process, device
+
+        _, direct = draw(None)
+        process, simplified = draw(0.05)
+        report = process.simplifier.report
+        self.assertLess(report.points_out, report.points_in / 5)
+        self.assertEqual(direct.angles, simplified.angles)
+        self.assertEqual(report.points_out, simplified.moves)
+        self.assertLess(simplified.now, direct.now)
+
+
+if __name__ == '__main__':
+    unittest.main()
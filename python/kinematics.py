@@ -0,0 +1,100 @@
+import typing
+from collections import namedtuple
+
+import numpy as np
+
+IKSolution = namedtuple('IKSolution', ['alpha1', 'alpha2', 'unreachable'])
+
+
+class UnreachablePointsError(ValueError):
+    def __init__(self, indices: typing.Sequence[int]):
+        self.indices = list(indices)
+        super().__init__(f"{len(self.indices)} point(s) outside of the reachable workspace, "
+                         f"first one at index {self.indices[0]}")
+
+
+class TwoArmKinematics:
+    """Geometry of the two arm plotter and its (vectorized) inverse kinematics.
+
+    Printer coordinates: the origin is the top left corner of the working area, y grows downwards.
+    """
+
+    def __init__(self):
+        # printer physical parameters (distances in mm):
+        # lego arms attached to metal wheel
+        self.R1 = 99.625 - 3 * 7.97  # 99.625 <- last hole (one hole distance is 7.97mm)
+        self.R2 = 99.625 - 3 * 7.97
+        self.l1 = 159  # left wire length
+        self.l2 = 159
+        self.D = 258.7  # distance of motor axles
+
+        # working area
+        self.width = 80
+        self.height = 80
+        self.x_min = (self.D - self.width) / 2.0
+        self.y_min = 15
+
+    def machine_xy(self, xs: np.ndarray, ys: np.ndarray) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """printer coordinates -> coordinates relative to the left motor axle"""
+        # xs = xs * 0.8  # scaling
+        # ys = ys * 0.8
+        return xs + self.x_min + 10, self.height - ys + self.y_min  # vertical mirroring
+
+    def printer_xy(self, xs: np.ndarray, ys: np.ndarray) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """inverse of machine_xy"""
+        return xs - self.x_min - 10, self.height + self.y_min - ys
+
+    def forward(self, alpha1: np.ndarray, alpha2: np.ndarray) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """arm angles in degrees -> pen position in printer coordinates (NaN where the wires can not meet)
+
+        The pen hangs at the lower intersection of the circles of the wires around the arm ends.
+        """
+        a1 = np.radians(alpha1)
+        a2 = np.radians(alpha2)
+        # arm ends relative to the left motor axle, y grows downwards in machine coordinates too
+        ax1, ay1 = self.R1 * np.cos(a1), -self.R1 * np.sin(a1)
+        ax2, ay2 = self.D - self.R2 * np.cos(a2), -self.R2 * np.sin(a2)
+
+        dx, dy = ax2 - ax1, ay2 - ay1
+        d = np.hypot(dx, dy)
+        along = (self.l1 ** 2 - self.l2 ** 2 + d ** 2) / (2 * d)  # from the left arm end towards the right one
+        with np.errstate(invalid='ignore'):
+            across = np.sqrt(self.l1 ** 2 - along ** 2)
+        x = ax1 + (along * dx - across * dy) / d
+        y = ay1 + (along * dy + across * dx) / d
+        return self.printer_xy(x, y)
+
+    def inverse(self, xys: typing.Union[np.ndarray, typing.Iterable[typing.Sequence[float]]]) -> IKSolution:
+        """xys: N x 2 array of points in printer coordinates, return: arm angles in degrees
+
+        Angles of points that can not be reached are NaN, their indices are listed in `unreachable`.
+        """
+        xys = np.asarray(xys, dtype=float).reshape(-1, 2)
+        x, y = self.machine_xy(xys[:, 0], xys[:, 1])
+
+        # printer physical parameters:
+        R1 = self.R1
+        R2 = self.R2
+        l1 = self.l1
+        l2 = self.l2
+        D = self.D
+
+        r_sq = x ** 2 + y ** 2
+        d_sq = D ** 2 - 2 * D * x + r_sq  # squared distance from the right motor axle
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            # formulae valid for angles in [0, 180deg] (practically meaningful: [0, ~130deg])
+            ca1 = (x * (R1 ** 2 - l1 ** 2 + r_sq) + y * np.sqrt(
+                (-R1 ** 2 + 2 * R1 * l1 - l1 ** 2 + r_sq) * (
+                        R1 ** 2 + 2 * R1 * l1 + l1 ** 2 - r_sq))) / (2 * R1 * r_sq)
+
+            ca2 = (y * np.sqrt((-d_sq + R2 ** 2 + 2 * R2 * l2 + l2 ** 2) * (
+                    d_sq - R2 ** 2 + 2 * R2 * l2 - l2 ** 2)) + (D - x) * (
+                           d_sq + R2 ** 2 - l2 ** 2)) / (2 * R2 * d_sq)
+
+            # atan2(sqrt(1 - c^2), c) == acos(c), NaN outside of [-1, 1]
+            alpha1 = np.degrees(np.arccos(ca1))
+            alpha2 = np.degrees(np.arccos(ca2))  # by our convention positive is up (as opposed to math)
+
+        unreachable = np.flatnonzero(~(np.isfinite(alpha1) & np.isfinite(alpha2)))
+        return IKSolution(alpha1, alpha2, unreachable)
@@ -0,0 +1,59 @@
+import math
+import unittest
+
+from kinematics import *
+
+
+def scalar_alphas(kin: TwoArmKinematics, x: float, y: float) -> typing.Tuple[float, float]:
+    """reference: the original point by point solution"""
+    R1, R2, l1, l2, D = kin.R1, kin.R2, kin.l1, kin.l2, kin.D
+    x = x + kin.x_min + 10
+    y = kin.height - y + kin.y_min
+    ca1 = (x * (R1 ** 2 - l1 ** 2 + x ** 2 + y ** 2) + y * math.sqrt(
+        (-R1 ** 2 + 2 * R1 * l1 - l1 ** 2 + x ** 2 + y ** 2) * (
+                R1 ** 2 + 2 * R1 * l1 + l1 ** 2 - x ** 2 - y ** 2))) / (2 * R1 * (x ** 2 + y ** 2))
+    ca2 = (y * math.sqrt((-D ** 2 + 2 * D * x + R2 ** 2 + 2 * R2 * l2 + l2 ** 2 - x ** 2 - y ** 2) * (
+            D ** 2 - 2 * D * x - R2 ** 2 + 2 * R2 * l2 - l2 ** 2 + x ** 2 + y ** 2)) + (D - x) * (
+                   D ** 2 - 2 * D * x + R2 ** 2 - l2 ** 2 + x ** 2 + y ** 2)) / (
+                  2 * R2 * (D ** 2 - 2 * D * x + x ** 2 + y ** 2))
+    return (math.atan2(math.sqrt(1 - ca1 ** 2), ca1) / math.pi * 180,
+            math.atan2(math.sqrt(1 - ca2 ** 2), ca2) / math.pi * 180)
+
+
+class InverseKinematicsTest(unittest.TestCase):
+    def setUp(self):
+        self.kin = TwoArmKinematics()
+
+    def test_matches_scalar_solution(self):
+        points = [(x, y) for x in range(0, 81, 10) for y in range(0, 81, 10)]
+        solution = self.kin.inverse(points)
+        for index, ((x, y), alpha1, alpha2) in enumerate(zip(points, solution.alpha1, solution.alpha2)):
+            try:
+                expected1, expected2 = scalar_alphas(self.kin, x, y)
+            except ValueError:  # math domain error
+                self.assertIn(index, solution.unreachable)
+                continue
+            self.assertNotIn(index, solution.unreachable)
+            self.assertAlmostEqual(expected1, alpha1, places=9)
+            self.assertAlmostEqual(expected2, alpha2, places=9)
+
+    def test_unreachable_points_reported_by_index(self):
+        solution = self.kin.inverse([(40, 40), (40, 1000), (40, 41), (-500, 40)])
+        self.assertEqual([1, 3], solution.unreachable.tolist())
+        self.assertTrue(math.isnan(solution.alpha1[1]))
+        self.assertFalse(math.isnan(solution.alpha1[2]))
+
+    def test_forward_inverts_inverse(self):
+        xs, ys = np.meshgrid(np.linspace(0, 76, 20), np.linspace(0, 76, 20))
+        solution = self.kin.inverse(np.column_stack((xs.ravel(), ys.ravel())))
+        fx, fy = self.kin.forward(solution.alpha1, solution.alpha2)
+        np.testing.assert_allclose(xs.ravel(), fx, atol=1e-9)
+        np.testing.assert_allclose(ys.ravel(), fy, atol=1e-9)
+
+    def test_single_point(self):
+        solution = self.kin.inverse((40, 40))
+        self.assertEqual((1,), solution.alpha1.shape)
+
+
+if __name__ == '__main__':
+    unittest.main()
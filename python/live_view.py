@@ -0,0 +1,123 @@
+import queue
+import typing
+
+ScreenPoint = typing.Tuple[float, float]
+
+
+class LiveView:
+    """Draws the points reported by a DrawingProcess onto a Tk canvas.
+
+    The queue is drained in bulk, every batch of a stroke (run of points with the same pen state) becomes a single
+    polyline, points closer than `min_distance` pixels to the previous one are skipped. Items of equal numbers of
+    batches are merged (like the digits of a binary counter), so a stroke in progress has O(log batches) items and
+    every point is copied O(log batches) times. A finished stroke is merged into one item.
+    """
+
+    def __init__(self, canvas, to_screen: typing.Callable[[float, float], ScreenPoint],
+                 min_distance: float = 1.0,
+                 pen_down_options: typing.Optional[dict] = None, pen_up_options: typing.Optional[dict] = None):
+        """canvas: tk.Canvas (or anything with create_line, coords and delete)
+        to_screen: printer coordinates -> canvas coordinates"""
+        self.canvas = canvas
+        self.to_screen = to_screen
+        self.min_distance_sq = min_distance ** 2
+        self.pen_down_options = pen_down_options if pen_down_options is not None else {'fill': 'black'}
+        self.pen_up_options = pen_up_options if pen_up_options is not None else {'fill': '#c8c8c8'}
+        self.items: typing.List[int] = []  # of the finished strokes
+        self.points_received = 0
+        self.points_drawn = 0
+        self._reset_stroke(None)
+        self._last: typing.Optional[ScreenPoint] = None  # last point drawn
+        self._skipped: typing.Optional[ScreenPoint] = None  # last point received, if it was not drawn
+
+    def _reset_stroke(self, pen_down: typing.Optional[bool]):
+        self._pen_down = pen_down
+        self._stroke_items: typing.List[int] = []
+        self._stroke_coords: typing.List[typing.List[float]] = []  # flat coordinates per item
+        self._stroke_batches: typing.List[int] = []  # number of batches per item
+        self._batch: typing.List[float] = []
+
+    def update(self, points: queue.Queue):
+        """draws everything in the queue of (x, y, z) points (pen down if z < 0)"""
+        while True:
+            try:
+                x, y, z = points.get_nowait()
+            except queue.Empty:
+                break
+            self.add(x, y, z < 0)
+        self._end_batch()
+
+    def add(self, x: float, y: float, pen_down: bool):
+        self.points_received += 1
+        point = self.to_screen(x, y)
+        if pen_down != self._pen_down:
+            if self._skipped is not None:
+                self._draw(self._skipped)  # the stroke ends exactly where the pen changed
+            self._end_stroke()
+            self._reset_stroke(pen_down)
+            if self._last is not None:
+                self._batch += self._last  # continues from the end of the previous stroke
+            self._draw(point)
+            return
+        last = self._last
+        if last is not None and (point[0] - last[0]) ** 2 + (point[1] - last[1]) ** 2 < self.min_distance_sq:
+            self._skipped = point
+            return
+        self._draw(point)
+
+    def finish(self):
+        """draws the last points and merges the last stroke, call when the job is over"""
+        self._end_batch()
+        self._end_stroke()
+        self._reset_stroke(None)
+
+    def clear(self):
+        self.finish()
+        for item in self.items:
+            self.canvas.delete(item)
+        self.items = []
+        self._last = None
+
+    @property
+    def item_count(self) -> int:
+        return len(self.items) + len(self._stroke_items)
+
+    def _draw(self, point: ScreenPoint):
+        self._batch += point
+        self._last = point
+        self._skipped = None
+        self.points_drawn += 1
+
+    def _end_batch(self):
+        if self._skipped is not None:
+            self._draw(self._skipped)
+        if len(self._batch) >= 4:
+            self._stroke_items.append(self.canvas.create_line(*self._batch, **self._options()))
+            self._stroke_coords.append(self._batch)
+            self._stroke_batches.append(1)
+            self._batch = self._batch[-2:]  # the next batch continues from here
+            while len(self._stroke_batches) >= 2 and self._stroke_batches[-2] <= self._stroke_batches[-1]:
+                self._merge_stroke_items(len(self._stroke_items) - 2)
+
+    def _end_stroke(self):
+        if len(self._batch) >= 4:
+            self._end_batch()
+        if len(self._stroke_items) >= 2:
+            self._merge_stroke_items(0)
+        self.items += self._stroke_items
+        self._reset_stroke(self._pen_down)
+
+    def _merge_stroke_items(self, first: int):
+        """replaces the items of the current stroke from `first` on with one"""
+        coords = self._stroke_coords[first]
+        for batch in self._stroke_coords[first + 1:]:
+            coords += batch[2:]  # the first point repeats the end of the previous item
+        self.canvas.coords(self._stroke_items[first], *coords)
+        for item in self._stroke_items[first + 1:]:
+            self.canvas.delete(item)
+        del self._stroke_items[first + 1:]
+        del self._stroke_coords[first + 1:]
+        self._stroke_batches[first:] = [sum(self._stroke_batches[first:])]
+
+    def _options(self) -> dict:
+        return self.pen_down_options if self._pen_down else self.pen_up_options
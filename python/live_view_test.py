@@ -0,0 +1,107 @@
+import math
+import unittest
+from queue import Queue
+
+from live_view import *
+
+
+class FakeCanvas:
+    """the part of tk.Canvas LiveView uses"""
+
+    def __init__(self):
+        self.lines: typing.Dict[int, typing.List[float]] = {}
+        self.options: typing.Dict[int, dict] = {}
+        self.copied = 0  # coordinates passed in, ~ work done by Tk
+        self._next_item = 1
+
+    def create_line(self, *coords, **options) -> int:
+        item = self._next_item
+        self._next_item += 1
+        self.lines[item] = list(coords)
+        self.options[item] = options
+        self.copied += len(coords)
+        return item
+
+    def coords(self, item: int, *coords):
+        self.lines[item] = list(coords)
+        self.copied += len(coords)
+
+    def delete(self, item: int):
+        del self.lines[item]
+        del self.options[item]
+
+    def points(self, item: int) -> typing.List[ScreenPoint]:
+        coords = self.lines[item]
+        return list(zip(coords[::2], coords[1::2]))
+
+
+class LiveViewTest(unittest.TestCase):
+    def setUp(self):
+        self.canvas = FakeCanvas()
+        self.view = LiveView(self.canvas, lambda x, y: (x * 10, y * 10))
+        self.queue = Queue()
+
+    def put(self, points: typing.Iterable[typing.Tuple[float, float, float]]):
+        for point in points:
+            self.queue.put(point)
+
+    def test_batch_becomes_one_item(self):
+        self.put((k, 0, -1) for k in range(100))
+        self.view.update(self.queue)
+        self.assertTrue(self.queue.empty())
+        self.assertEqual(1, len(self.canvas.lines))
+        self.assertEqual([(k * 10, 0) for k in range(100)], self.canvas.points(next(iter(self.canvas.lines))))
+
+    def test_sub_pixel_points_decimated_but_last_point_kept(self):
+        self.put((k * 0.01, 0, -1) for k in range(1001))  # 0.1 px apart
+        self.view.update(self.queue)
+        self.view.finish()
+        points = self.canvas.points(next(iter(self.canvas.lines)))
+        self.assertLessEqual(len(points), 102)
+        self.assertEqual((0, 0), points[0])
+        self.assertAlmostEqual(100, points[-1][0])
+        for (x0, y0), (x1, y1) in zip(points[:-2], points[1:-1]):
+            self.assertGreaterEqual(math.hypot(x1 - x0, y1 - y0), 1)
+
+    def test_final_points_flushed(self):
+        self.put([(0, 0, -1), (1, 0, -1), (1.01, 0, -1)])
+        self.view.update(self.queue)
+        self.put([(1.02, 0, -1)])  # put by the thread right before it ended
+        self.view.update(self.queue)
+        self.view.finish()
+        points = [p for item in self.canvas.lines for p in self.canvas.points(item)]
+        self.assertAlmostEqual(10.2, points[-1][0])
+
+    def test_strokes_split_by_pen_state_and_merged_when_finished(self):
+        self.put([(0, 0, 1), (5, 5, 1)])
+        for batch in range(10):
+            self.put((5 + batch + k * 0.2, 5, -1) for k in range(5))
+            self.view.update(self.queue)
+        self.put([(20, 20, 1), (30, 30, 1)])
+        self.view.update(self.queue)
+        self.view.finish()
+        self.assertEqual(3, len(self.canvas.lines))
+        up1, stroke, up2 = sorted(self.canvas.lines)
+        self.assertEqual([(0, 0), (50, 50)], self.canvas.points(up1))
+        self.assertEqual(self.view.pen_down_options, self.canvas.options[stroke])
+        self.assertEqual(self.view.pen_up_options, self.canvas.options[up2])
+        drawn = self.canvas.points(stroke)
+        self.assertEqual((50, 50), drawn[0])
+        self.assertEqual(sorted(drawn), drawn)
+        self.assertAlmostEqual(148, drawn[-1][0])
+        self.assertEqual(drawn[-1], self.canvas.points(up2)[0])
+
+    def test_items_and_work_stay_bounded_on_long_stroke(self):
+        batches = 4096
+        for batch in range(batches):
+            self.put((batch + k * 0.25, (batch % 2) * 0.5, -1) for k in range(4))
+            self.view.update(self.queue)
+            self.assertLessEqual(self.view.item_count, math.log2(batch + 1) + 1)
+        points = self.view.points_drawn
+        self.assertLessEqual(self.canvas.copied, 2 * points * (math.log2(batches) + 2))
+        self.view.finish()
+        self.assertEqual(1, len(self.canvas.lines))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,3 +1,5 @@
+import logging
+import os
 import tkinter
 import tkinter as tk
 from tkinter import ttk
@@ -5,11 +7,14 @@ import time
 import typing
 import serial
 import math
+import threading
 
 from printer_commander import *
 from drawing_process import *
+from job_queue import *
+from live_view import *
 
-# todo: refactor logging
+METRICS_DIR = os.path.join(os.path.expanduser("~"), ".cache", "2arm-wire-plotter", "metrics")
 
 
 def linear_map_to(val,
@@ -20,6 +25,8 @@ def linear_map_to(val,
 
 
 class App(tk.Tk):
+    PREFLIGHT_MARKERS = 200  # flagged points marked on the canvas per kind of problem
+
     def __init__(self, canvas_width=650, canvas_height=650):
         super().__init__()
 
@@ -34,10 +41,19 @@ class App(tk.Tk):
         self.current_serial_command = tkinter.StringVar()
 
         self.curr_xy = (0, 0)
-        self.printer = PrinterCommander()
+        self.printer = PrinterCommander(trace=os.environ.get("PLOTTER_TRACE"))  # e.g. PLOTTER_TRACE=session.trace
+        self.job_cache = JobCache()
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        self.job_queue = JobQueue(self.printer, self.job_cache,
+                                  planner_factory=lambda: MotionPlanner(PlannerLimits(start_rpm=200)),
+                                  metrics_dir=METRICS_DIR, interpolation_resolution=0.1, speed=200,
+                                  simplify_tolerance=0.05, checkpoints=CheckpointStore(), resume=True,
+                                  preflight_policy='refuse')
+        self.monitoring = False
 
         self.filename = tkinter.StringVar(value="../gcode/test.gcode")
-        self.drawing_process = DrawingProcess(self.printer, self.filename.get(), 1)
+        self.drawing_process: typing.Optional[DrawingProcess] = None  # the one shown in the live view
+        self.preflight_result = None  # (PreflightReport, flagged points to mark) or the error of the check
 
         self.create_body_frame()
         self.create_command_frame()
@@ -45,23 +61,61 @@ class App(tk.Tk):
         self.protocol("WM_DELETE_WINDOW", self.on_closing)
 
     def on_closing(self):
-        if self.drawing_process.is_alive():
-            self.drawing_process.stop()
-            self.drawing_process.join()
+        self.job_queue.close()
         try:
             self.printer.save_angles()
             self.printer.pen_up()
         finally:
+            self.printer.close()
             self.destroy()
 
     def start_drawing(self):
-        self.drawing_process = DrawingProcess(self.printer, self.filename.get(), interpolation_resolution=0.1, speed=200)
-        self.drawing_process.start()
-        self.monitor_drawing_process()
+        """queues the file, it is compiled in the background and plotted after the jobs before it"""
+        self.job_queue.add(self.filename.get())
+        if not self.monitoring:
+            self.monitoring = True
+            self.monitor_drawing_process()
+
+    def check_drawing(self):
+        """pre-flight check of the file (on a thread, the file is interpolated for it), see show_preflight_result"""
+        settings = self.job_queue.settings
+        process = DrawingProcess(self.printer, self.filename.get(), interpolation_resolution=settings.max_point_dist,
+                                 chord_tolerance=settings.chord_tolerance, reorder_strokes=settings.reorder_strokes)
+        self.preflight_result = None
+        self.preflight_text.set("checking...")
+
+        def check():
+            try:
+                points = process.all_points()
+                report = process.preflight(points)
+                flagged = [(points.x[index], points.y[index], color)
+                           for indices, color in ((report.singular, 'orange'), (report.out_of_limits, 'red'),
+                                                  (report.unreachable, 'red'))
+                           for index in indices[:self.PREFLIGHT_MARKERS]]
+                self.preflight_result = report, flagged
+            except Exception as e:
+                self.preflight_result = e
+
+        threading.Thread(target=check, name="Preflight", daemon=True).start()
+        self.after(100, self.show_preflight_result)
+
+    def show_preflight_result(self):
+        """the summary of the check, the flagged points are marked on the canvas"""
+        result = self.preflight_result
+        if result is None:
+            self.after(100, self.show_preflight_result)
+        elif isinstance(result, Exception):
+            self.preflight_text.set(f"check failed: {result}")
+        else:
+            report, flagged = result
+            self.preflight_text.set(report.summary())
+            for x, y, color in flagged:
+                self.put_marker(*self.screen_xy(x, y), fill=color, outline=color)
 
     def cancel_drawing(self):
-        self.drawing_process.stop()
-        pass
+        current = self.job_queue.current
+        if current is not None:
+            self.job_queue.cancel(current.id)
 
     def target_xy(self, screen_x, screen_y):
         return (
@@ -90,14 +144,14 @@ class App(tk.Tk):
         pass
 
     def reset_head(self):
-        if self.drawing_process.is_alive():
+        if self.job_queue.busy:
             return
         self.printer.pen_up()
         self.printer.move_to_alphas(0.0, 0.0)
         pass
 
     def canvas_click(self, event):
-        if self.drawing_process.is_alive():
+        if self.job_queue.busy:
             return
         self.put_marker(event.x, event.y)
         # self.canvas.create_line(self.curr_xy, event.x, event.y)
@@ -108,6 +162,7 @@ class App(tk.Tk):
                                 width=self.canvas_width,
                                 height=self.canvas_height, borderwidth=0, highlightthickness=0)
         self.canvas.create_rectangle(0, 0, self.canvas_width - 1, self.canvas_height - 1)
+        self.live_view = LiveView(self.canvas, self.screen_xy)
 
         self.canvas.bind('<ButtonPress-1>', self.canvas_click)
         # self.canvas.bind('<Button1-Motion>', self.canvas_click)
@@ -127,7 +182,7 @@ class App(tk.Tk):
                                               width=50)
         self.file_name_entry.pack(fill=tk.X)
 
-        self.start_button = ttk.Button(self.drawing_controls_frame, text='Start')
+        self.start_button = ttk.Button(self.drawing_controls_frame, text='Queue')
         self.start_button['command'] = self.start_drawing
         self.start_button.pack(fill=tk.BOTH, side=tk.RIGHT)
 
@@ -135,6 +190,22 @@ class App(tk.Tk):
         self.cancel_button['command'] = self.cancel_drawing
         self.cancel_button.pack(fill=tk.BOTH, side=tk.RIGHT)
 
+        self.check_button = ttk.Button(self.drawing_controls_frame, text='Check')
+        self.check_button['command'] = self.check_drawing
+        self.check_button.pack(fill=tk.BOTH, side=tk.RIGHT)
+
+        self.metrics_text = tkinter.StringVar()
+        self.metrics_label = ttk.Label(self.drawing_controls_frame, textvariable=self.metrics_text)
+        self.metrics_label.pack(fill=tk.X, side=tk.BOTTOM)
+
+        self.preflight_text = tkinter.StringVar()
+        self.preflight_label = ttk.Label(self.drawing_controls_frame, textvariable=self.preflight_text)
+        self.preflight_label.pack(fill=tk.X, side=tk.BOTTOM)
+
+        self.queue_text = tkinter.StringVar()
+        self.queue_label = ttk.Label(self.drawing_controls_frame, textvariable=self.queue_text)
+        self.queue_label.pack(fill=tk.X, side=tk.BOTTOM)
+
         self.printer_controls_frame = ttk.LabelFrame(self.controls_frame, text="Printer Controls")
         self.printer_controls_frame.grid(column=1, row=0, sticky=tk.NW, padx=10, pady=0)
 
@@ -167,16 +238,27 @@ class App(tk.Tk):
         self.penup_button.pack(side=tk.RIGHT)
 
     def monitor_drawing_process(self):
-        if self.drawing_process.is_alive():
+        process = self.drawing_process
+        alive = False
+        if process is not None:
+            # checked before draining: the points of a thread that is no longer alive are all in the queue
+            alive = process.is_alive()
+            self.live_view.update(process.drawn_points)
+            self.metrics_text.set(self.printer.metrics.summary())
+            if not alive:
+                self.live_view.finish()
+        if not alive:  # not checked again: a thread ended since then is replaced once its last points are drawn
+            self.drawing_process = self.job_queue.current_process  # the next job, if it has started
+        self.queue_text.set(", ".join(f"{name}: {status}" for _, name, status, _ in self.job_queue.status()[-5:])
+                            + f" (idle {self.job_queue.total_idle:.1f} s)")
+        if self.job_queue.busy or self.drawing_process is not process:
             # check the thread every 100ms
-            while not self.drawing_process.drawn_points.empty():
-                point = self.drawing_process.drawn_points.get()
-                self.canvas.create_line(*self.curr_xy, *self.screen_xy(*point))
-                # print("line ", self.curr_xy, self.screen_xy(*point))
-                self.curr_xy = self.screen_xy(*point)
             self.after(100, lambda: self.monitor_drawing_process())
+        else:
+            self.monitoring = False
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
     app = App()
     app.mainloop()
\ No newline at end of file
@@ -0,0 +1,217 @@
+import contextlib
+import csv
+import json
+import math
+import threading
+import time
+import typing
+
+HISTOGRAM_BUCKETS_PER_DECADE = 10
+HISTOGRAM_MIN = 1e-6  # seconds, the first bucket holds everything below
+
+
+class LatencyHistogram:
+    """Durations in logarithmic buckets (HISTOGRAM_BUCKETS_PER_DECADE per decade), percentiles are accurate to
+    a bucket width (~26%)."""
+
+    def __init__(self):
+        self.buckets: typing.Dict[int, int] = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def record(self, seconds: float):
+        index = math.floor(math.log10(seconds / HISTOGRAM_MIN) * HISTOGRAM_BUCKETS_PER_DECADE) \
+            if seconds > HISTOGRAM_MIN else 0
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    @staticmethod
+    def bucket_upper_bound(index: int) -> float:
+        return HISTOGRAM_MIN * 10 ** ((index + 1) / HISTOGRAM_BUCKETS_PER_DECADE)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else math.nan
+
+    def percentile(self, q: float) -> float:
+        """upper bound of the bucket of the q-th percentile (0 < q <= 100), capped by the maximum"""
+        if not self.count:
+            return math.nan
+        rank = math.ceil(q / 100 * self.count)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(self.bucket_upper_bound(index), self.max)
+        return self.max
+
+    def as_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'mean': self.mean,
+            'min': self.min if self.count else math.nan,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': self.max if self.count else math.nan,
+            'buckets': {f"{self.bucket_upper_bound(index):.3g}": n for index, n in sorted(self.buckets.items())},
+        }
+
+
+class Metrics:
+    """Counters, stage times and round-trip latencies of a plotting job.
+
+    Written by the threads of the drawing pipeline (under a lock), read (snapshot) by the GUI thread. Counters: `points`, `commands`,
+    `checksum_retries`, `retransmissions`, `bytes_sent`, `bytes_received`. Stage times: `parse` (including
+    interpolation), `ik`, `serial_wait` (blocked reading the plotter's answers), `pipeline_wait_<stage>` (the next
+    stage of DrawingProcess's pipeline waiting for <stage>).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.monotonic()
+            self.ended: typing.Optional[float] = None
+            self.counters: typing.Dict[str, int] = {}
+            self.stage_times: typing.Dict[str, float] = {}
+            self.latencies: typing.Dict[str, LatencyHistogram] = {}
+
+    def finish(self):
+        with self._lock:
+            self.ended = time.monotonic()
+
+    def count(self, name: str, n: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_time(self, stage: str, seconds: float):
+        with self._lock:
+            self.stage_times[stage] = self.stage_times.get(stage, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def timed(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def timed_iter(self, stage: str, iterable: typing.Iterable) -> typing.Iterator:
+        """the items of `iterable`, the time spent producing them is added to `stage`"""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(stage, time.perf_counter() - start)
+                return
+            self.add_time(stage, time.perf_counter() - start)
+            yield item
+
+    def record_latency(self, command: str, seconds: float):
+        with self._lock:  # the GUI may be iterating over the histograms
+            histogram = self.latencies.get(command)
+            if histogram is None:
+                histogram = self.latencies[command] = LatencyHistogram()
+            histogram.record(seconds)
+
+    @property
+    def elapsed(self) -> float:
+        return (self.ended if self.ended is not None else time.monotonic()) - self.started
+
+    @property
+    def points_per_sec(self) -> float:
+        elapsed = self.elapsed
+        return self.counters.get('points', 0) / elapsed if elapsed > 0 else 0.0
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'elapsed': self.elapsed,
+                'points_per_sec': self.points_per_sec,
+                'counters': dict(self.counters),
+                'stage_times': dict(self.stage_times),
+                'latencies': {command: histogram.as_dict() for command, histogram in list(self.latencies.items())},
+            }
+
+    def summary(self) -> str:
+        """one line for the GUI"""
+        snapshot = self.snapshot()
+        counters = snapshot['counters']
+        rtts = [h for h in snapshot['latencies'].values() if h['count']]
+        rtt = max(rtts, key=lambda h: h['count']) if rtts else None
+        rtt_text = f", RTT p50 {rtt['p50'] * 1000:.1f} ms p99 {rtt['p99'] * 1000:.1f} ms" if rtt else ""
+        return (f"{counters.get('points', 0)} points, {snapshot['points_per_sec']:.0f} points/s{rtt_text}, "
+                f"{counters.get('checksum_retries', 0) + counters.get('retransmissions', 0)} retries, "
+                f"{counters.get('bytes_sent', 0) / 1024:.1f} kB sent")
+
+    def export_json(self, filename: str):
+        with open(filename, "w") as f:
+            json.dump(self.snapshot(), f, indent=1)
+
+    def export_csv(self, filename: str):
+        """one row per metric: kind, name, field, value"""
+        snapshot = self.snapshot()
+        with open(filename, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["kind", "name", "field", "value"])
+            writer.writerow(["job", "", "elapsed", snapshot['elapsed']])
+            writer.writerow(["job", "", "points_per_sec", snapshot['points_per_sec']])
+            for name, value in sorted(snapshot['counters'].items()):
+                writer.writerow(["counter", name, "", value])
+            for name, value in sorted(snapshot['stage_times'].items()):
+                writer.writerow(["stage_time", name, "", value])
+            for command, histogram in sorted(snapshot['latencies'].items()):
+                for field, value in histogram.items():
+                    if field != 'buckets':
+                        writer.writerow(["latency", command, field, value])
+                for bound, n in histogram['buckets'].items():
+                    writer.writerow(["latency", command, f"le_{bound}", n])
+
+
+class MeteredConnection:
+    """serial.Serial-like wrapper counting the bytes on the wire and the time spent waiting for input"""
+
+    def __init__(self, connection, metrics: Metrics):
+        self.connection = connection
+        self.metrics = metrics
+
+    @property
+    def timeout(self):
+        return self.connection.timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self.connection.timeout = value
+
+    @property
+    def in_waiting(self) -> int:
+        return self.connection.in_waiting
+
+    def write(self, data: bytes):
+        self.metrics.count('bytes_sent', len(data))
+        return self.connection.write(data)
+
+    def read(self, size: int = 1) -> bytes:
+        with self.metrics.timed('serial_wait'):
+            data = self.connection.read(size)
+        self.metrics.count('bytes_received', len(data))
+        return data
+
+    def readline(self) -> bytes:
+        with self.metrics.timed('serial_wait'):
+            data = self.connection.readline()
+        self.metrics.count('bytes_received', len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
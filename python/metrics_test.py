@@ -0,0 +1,141 @@
+import csv
+import json
+import logging
+import os
+import tempfile
+import threading
+import unittest
+
+from drawing_process import *
+from metrics import *
+from plotter_simulator import *
+from synthetic_gcode import pen_lifts, write_gcode
+
+
+class LatencyHistogramTest(unittest.TestCase):
+    def test_percentiles_within_a_bucket(self):
+        histogram = LatencyHistogram()
+        for k in range(1, 1001):
+            histogram.record(k * 1e-5)  # 10 us .. 10 ms
+        self.assertEqual(1000, histogram.count)
+        self.assertAlmostEqual(5.005e-3, histogram.mean)
+        for q in (50, 90, 99):
+            exact = q * 1e-5 * 10
+            self.assertGreaterEqual(histogram.percentile(q), exact)
+            self.assertLessEqual(histogram.percentile(q), exact * 10 ** (1 / HISTOGRAM_BUCKETS_PER_DECADE))
+        self.assertEqual(1e-2, histogram.percentile(100))
+
+    def test_tiny_and_empty(self):
+        histogram = LatencyHistogram()
+        self.assertTrue(math.isnan(histogram.percentile(50)))
+        histogram.record(0.0)
+        self.assertEqual(0.0, histogram.percentile(50))
+
+
+class MetricsTest(unittest.TestCase):
+    def test_counted_from_several_threads(self):
+        metrics = Metrics()
+
+        def work():
+            for _ in range(20000):
+                metrics.count('points')
+                metrics.add_time('ik', 1.0)
+                metrics.record_latency('moveto', 0.001)
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(80000, metrics.counters['points'])
+        self.assertEqual(80000.0, metrics.stage_times['ik'])
+        self.assertEqual(80000, metrics.latencies['moveto'].count)
+
+
+class PlotterMetricsTest(unittest.TestCase):
+    def test_commands_and_bytes_counted(self):
+        connection = SimulatedSerial()
+        printer = PrinterCommander(connection=connection)
+        printer.metrics.reset()
+        printer.move_to_alphas(5.0, 6.0)
+        printer.pen_down()
+        snapshot = printer.metrics.snapshot()
+        self.assertEqual(2, snapshot['counters']['commands'])
+        self.assertEqual(1, snapshot['latencies']['moveto']['count'])
+        self.assertEqual(1, snapshot['latencies']['pendown']['count'])
+        printer.metrics.reset()
+        bytes_written, bytes_read = connection.bytes_written, connection.bytes_read
+        printer.pen_up()
+        counters = printer.metrics.counters
+        self.assertEqual(connection.bytes_written - bytes_written, counters['bytes_sent'])
+        self.assertEqual(connection.bytes_read - bytes_read, counters['bytes_received'])
+
+    def test_stream_round_trips_and_retransmissions(self):
+        corrupted = []
+
+        def corrupt(data: bytes) -> bytes:
+            if data[:2] == bytes([FRAME_SYNC, 5]) and not corrupted:
+                corrupted.append(data)
+                return data[:4] + bytes([data[4] ^ 0x01]) + data[5:]
+            return data
+
+        printer = PrinterCommander(connection=SimulatedSerial(corrupt=corrupt))
+        with printer.motion_stream() as stream:
+            for k in range(40):
+                stream.move_to_alphas(10 + k * .1, 20)
+        histogram = printer.metrics.latencies['stream_frame']
+        self.assertEqual(1, printer.metrics.counters['retransmissions'])
+        self.assertGreaterEqual(histogram.count, 39 - stream.frames_retransmitted)
+        self.assertLessEqual(histogram.count, 40)
+
+    def test_debug_logging_gated(self):
+        printer = PrinterCommander(connection=SimulatedSerial())
+        with self.assertLogs('printer_commander', logging.DEBUG) as logs:
+            printer.pen_up()
+        self.assertIn("penup", logs.output[0])
+
+        class Recorder(logging.Handler):
+            records = []
+
+            def emit(self, record):
+                self.records.append(record)
+
+        logger = logging.getLogger('printer_commander')
+        recorder = Recorder()
+        logger.addHandler(recorder)
+        logger.setLevel(logging.INFO)
+        try:
+            printer.pen_up()
+        finally:
+            logger.removeHandler(recorder)
+            logger.setLevel(logging.NOTSET)
+        self.assertEqual([], recorder.records)
+
+
+class JobMetricsTest(unittest.TestCase):
+    def test_job_metrics_exported(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "lifts.ngc")
+            write_gcode(filename, pen_lifts(), 2000)
+            device = SimulatedPlotter()
+            process = DrawingProcess(PrinterCommander(connection=SimulatedSerial(device)), filename,
+                                     metrics_export=os.path.join(tmp, "job"))
+            process.run()
+
+            with open(os.path.join(tmp, "job.json")) as f:
+                exported = json.load(f)
+            self.assertEqual(device.moves, exported['counters']['points'])
+            self.assertGreater(exported['points_per_sec'], 0)
+            for stage in ('parse', 'ik', 'serial_wait'):
+                self.assertGreater(exported['stage_times'][stage], 0)
+            self.assertIn('stream_frame', exported['latencies'])
+
+            with open(os.path.join(tmp, "job.csv")) as f:
+                rows = list(csv.DictReader(f))
+            self.assertIn({'kind': 'counter', 'name': 'points', 'field': '', 'value': str(device.moves)}, rows)
+            self.assertTrue(any(row['kind'] == 'latency' and row['field'] == 'p99' for row in rows))
+            self.assertIn(f"{device.moves} points", process.metrics.summary())
+
+
+if __name__ == '__main__':
+    unittest.main()
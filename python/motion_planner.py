@@ -0,0 +1,159 @@
+import math
+import typing
+from collections import namedtuple
+
+import numpy as np
+
+from gcodehandler import RAPID_FEED
+from joint_simplifier import Move, STEP_ANGLE
+
+STEPS_PER_MOTOR_REV = 32  # stepper.h: STEPS_PER_REV, the speed is set in motor revolutions per minute
+DEG_PER_SEC_PER_RPM = STEPS_PER_MOTOR_REV / 60 * STEP_ANGLE  # arm speed
+
+PlannerLimits = namedtuple('PlannerLimits', [
+    'max_rpm',  # fastest the motors go
+    'min_rpm',  # slowest speed sent
+    'start_rpm',  # the motors start and stop at this speed without ramping (the fixed speed used so far)
+    'joint_acceleration',  # degrees/s^2, speed changes beyond start_rpm are spread over the moves
+    'max_pen_speed',  # mm/s with the pen down
+    'pen_acceleration',  # mm/s^2 of the pen in corners (the pen hangs on wires and swings)
+    'junction_deviation',  # mm, corner rounding allowed by the cornering speed (see Grbl's planner)
+    'rpm_resolution',  # speeds are rounded down to multiples of this, fewer speed changes are sent
+], defaults=[450, 60, 300, 300.0, 50.0, 2000.0, 0.05, 10])
+
+PlannedMove = typing.Tuple[Move, int]  # move, rpm of the move to it
+
+
+def feed_rpm(previous: Move, move: Move, max_rpm: float, current_rpm: float,
+             limits: PlannerLimits = PlannerLimits()) -> float:
+    """speed of the move from `previous` to `move` at the feed of `move` (mm/min), with the arm to pen travel ratio
+    of the exact angles (not rounded to steps, fewer speed changes), rounded down to limits.rpm_resolution and
+    limited to [limits.min_rpm, max_rpm]; `current_rpm` if the pen or the arms do not move"""
+    arm_travel = max(abs(move[3] - previous[3]), abs(move[4] - previous[4]))
+    pen_travel = math.hypot(move[0] - previous[0], move[1] - previous[1])
+    if arm_travel == 0 or pen_travel == 0:
+        return current_rpm
+    rpm = move[5] / 60 * arm_travel / pen_travel / DEG_PER_SEC_PER_RPM
+    rpm = math.floor(rpm / limits.rpm_resolution) * limits.rpm_resolution
+    return min(max(rpm, limits.min_rpm), max_rpm)
+
+
+class MotionPlanner:
+    """Look-ahead speed planning: the stepper speed (rpm) of every move.
+
+    The firmware moves the arms linearly in joint space at the set speed of the motor moving more, without
+    ramping. The speed of a move is limited by
+    - max_rpm;
+    - max_pen_speed with the pen down, converted with the move's ratio of arm travel to pen travel (the IK Jacobian
+      applied to its direction);
+    - the feed of the move (6th value of the moves, mm/min) likewise, if given (neither 0 nor RAPID_FEED);
+    - the cornering speed at both ends, from the angle between consecutive moves;
+    - start_rpm where the pen goes up or down (the motors stop for the servo);
+    - joint_acceleration towards the neighbouring moves, both forwards and backwards (look-ahead).
+    At most `lookahead` moves are buffered. Moves beyond them are assumed to need a stop, so every speed given out
+    is safe whatever follows.
+    """
+
+    def __init__(self, limits: PlannerLimits = PlannerLimits(), lookahead: int = 256):
+        self.limits = limits
+        self.lookahead = max(lookahead, 4)
+        self.estimated_time = 0.0  # seconds of motion of the moves planned, at the planned speeds
+        self._previous: typing.Optional[Move] = None  # last move given out
+        self._entry_speed = self._start_speed  # arm speed (degrees/s) of the last move given out
+
+    @property
+    def _start_speed(self) -> float:
+        return self.limits.start_rpm * DEG_PER_SEC_PER_RPM
+
+    def plan(self, moves: typing.Iterable[Move]) -> typing.Iterator[PlannedMove]:
+        window: typing.List[Move] = []
+        for move in moves:
+            window.append(move)
+            if len(window) == self.lookahead:
+                keep = self.lookahead // 2
+                yield from self._plan_window(window, len(window) - keep)
+                window = window[-keep:]
+        yield from self._plan_window(window, len(window))
+
+    def rpm(self, arm_speed: float) -> int:
+        limits = self.limits
+        rpm = math.floor(arm_speed / DEG_PER_SEC_PER_RPM / limits.rpm_resolution) * limits.rpm_resolution
+        return int(min(max(rpm, limits.min_rpm), limits.max_rpm))
+
+    def _plan_window(self, window: typing.List[Move], count: int) -> typing.Iterator[PlannedMove]:
+        """plans the window (ending with a stop), gives out the first `count` moves"""
+        if not window:
+            return
+        limits = self.limits
+        points = np.array(window, dtype=float)
+        previous = np.array(self._previous if self._previous is not None else window[0], dtype=float)
+        path = np.vstack((previous[:5], points[:, :5]))
+        deltas = np.diff(path, axis=0)
+        pen_travel = np.hypot(deltas[:, 0], deltas[:, 1])
+        steps = np.round(path[:, 3:5] / STEP_ANGLE)  # the firmware moves whole steps
+        arm_travel = np.abs(np.diff(steps, axis=0)).max(axis=1) * STEP_ANGLE  # of the motor moving more
+        pen_down = points[:, 2] < 0
+        feeds = points[:, 5] if points.shape[1] > 5 else np.zeros(len(window))
+
+        moving = np.flatnonzero(arm_travel > 0)
+        speeds = np.full(len(window), self._entry_speed)
+        if len(moving) > 0:
+            previous_pen_down = self._previous is not None and self._previous[2] < 0
+            speeds[moving] = self._plan_speeds(pen_travel[moving], arm_travel[moving], pen_down[moving],
+                                               feeds[moving], deltas[moving, :2], previous_pen_down)
+            # moves that do not move the arms keep the speed of the previous one, no speed change is sent
+            carried = np.maximum.accumulate(np.where(arm_travel > 0, np.arange(len(window)), -1))
+            speeds = np.where(carried >= 0, speeds[np.maximum(carried, 0)], self._entry_speed)
+
+        for k in range(count):
+            rpm = self.rpm(speeds[k])
+            self.estimated_time += arm_travel[k] / (rpm * DEG_PER_SEC_PER_RPM)
+            yield window[k], rpm
+        self._previous = window[count - 1]
+        self._entry_speed = float(speeds[count - 1])
+
+    def _plan_speeds(self, pen_travel: np.ndarray, arm_travel: np.ndarray, pen_down: np.ndarray, feeds: np.ndarray,
+                     directions: np.ndarray, previous_pen_down: bool) -> np.ndarray:
+        """arm speeds (degrees/s) of moves that move the arms"""
+        limits = self.limits
+        start = self._start_speed
+        n = len(arm_travel)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            arm_per_mm = np.where(pen_travel > 0, arm_travel / pen_travel, np.inf)
+        limit = np.full(n, limits.max_rpm * DEG_PER_SEC_PER_RPM)
+        limit[pen_down] = np.minimum(limit[pen_down], limits.max_pen_speed * arm_per_mm[pen_down])
+        fed = (feeds > 0) & (feeds < RAPID_FEED)
+        limit[fed] = np.minimum(limit[fed], feeds[fed] / 60 * arm_per_mm[fed])
+
+        # corners between consecutive pen down moves: v^2 = a * d * cos(turn / 2) / (1 - cos(turn / 2))
+        unit = directions / np.where(pen_travel > 0, pen_travel, 1)[:, None]
+        cos_turn = np.clip(np.einsum('ij,ij->i', unit[:-1], unit[1:]), -1, 1)
+        cos_half = np.sqrt((1 + cos_turn) / 2)
+        with np.errstate(divide='ignore'):
+            corner_speed = np.sqrt(limits.pen_acceleration * limits.junction_deviation * cos_half
+                                   / np.maximum(1 - cos_half, 0))
+        corner = pen_down[:-1] & pen_down[1:]
+        corner_limit = np.where(corner, corner_speed, np.inf)
+        limit[:-1] = np.minimum(limit[:-1], corner_limit * arm_per_mm[:-1])
+        limit[1:] = np.minimum(limit[1:], corner_limit * arm_per_mm[1:])
+
+        # the motors stop while the pen moves
+        pen_change = np.flatnonzero(pen_down[:-1] != pen_down[1:])
+        limit[pen_change] = np.minimum(limit[pen_change], start)
+        limit[pen_change + 1] = np.minimum(limit[pen_change + 1], start)
+        entry = self._entry_speed if bool(pen_down[0]) == previous_pen_down else min(self._entry_speed, start)
+        limit[0] = min(limit[0], max(start, entry))
+        limit[-1] = min(limit[-1], start)  # what follows is unknown: stop
+
+        # acceleration, forwards from the entry speed and backwards from the stop
+        speeds = limit.tolist()
+        travel = arm_travel.tolist()
+        two_a = 2 * limits.joint_acceleration
+        previous_speed = entry
+        for k in range(n):
+            reachable = math.sqrt(previous_speed ** 2 + two_a * (travel[k - 1] if k > 0 else 0.0))
+            speeds[k] = min(speeds[k], max(start, reachable))
+            previous_speed = speeds[k]
+        for k in range(n - 2, -1, -1):
+            speeds[k] = min(speeds[k], max(start, math.sqrt(speeds[k + 1] ** 2 + two_a * travel[k])))
+        return np.array(speeds)
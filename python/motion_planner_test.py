@@ -0,0 +1,183 @@
+import math
+import os
+import tempfile
+import unittest
+
+from drawing_process import *
+from motion_planner import *
+from plotter_simulator import *
+from synthetic_gcode import dense_arcs, write_gcode
+
+
+class MotionPlannerTest(unittest.TestCase):
+    def setUp(self):
+        self.kinematics = TwoArmKinematics()
+        self.limits = PlannerLimits()
+
+    def moves(self, xys, z: float = -1) -> typing.List[Move]:
+        solution = self.kinematics.inverse(xys)
+        return [(x, y, z, a1, a2) for (x, y), a1, a2 in zip(xys, solution.alpha1.tolist(), solution.alpha2.tolist())]
+
+    def line(self, start, end, n: int, z: float = -1) -> typing.List[Move]:
+        return self.moves(list(zip(np.linspace(start[0], end[0], n)[1:].tolist(),
+                                   np.linspace(start[1], end[1], n)[1:].tolist())), z)
+
+    @staticmethod
+    def arm_travel(start: Move, end: Move) -> float:
+        return max(abs(degrees_to_steps(end[k]) - degrees_to_steps(start[k])) for k in (3, 4)) * STEP_ANGLE
+
+    def check_limits(self, moves: typing.List[Move], planned: typing.List[PlannedMove]):
+        self.assertEqual(moves, [move for move, _ in planned])
+        rpms = [rpm for _, rpm in planned]
+        for (previous, _), (move, rpm) in zip(planned[:-1], planned[1:]):
+            self.assertLessEqual(rpm, self.limits.max_rpm)
+            self.assertGreaterEqual(rpm, self.limits.min_rpm)
+            arm_travel = self.arm_travel(previous, move)
+            pen_travel = math.hypot(move[0] - previous[0], move[1] - previous[1])
+            if move[2] < 0 and arm_travel > 0:
+                pen_speed = rpm * DEG_PER_SEC_PER_RPM * pen_travel / arm_travel
+                self.assertLessEqual(pen_speed, self.limits.max_pen_speed + 1e-9)
+        resolution = self.limits.rpm_resolution * DEG_PER_SEC_PER_RPM
+        travels = [self.arm_travel(a, b) for (a, _), (b, _) in zip(planned[:-1], planned[1:])]
+        for k in range(1, len(rpms) - 1):
+            if travels[k - 1] == 0 or travels[k] == 0:
+                continue
+            speed, next_speed = rpms[k] * DEG_PER_SEC_PER_RPM, rpms[k + 1] * DEG_PER_SEC_PER_RPM
+            start = self.limits.start_rpm * DEG_PER_SEC_PER_RPM
+            if max(speed, next_speed) > start + 1e-9:
+                travel = travels[k - 1] if next_speed > speed else travels[k]
+                rounding = 2 * max(speed, next_speed) * resolution + resolution ** 2  # speeds are rounded down
+                self.assertLessEqual(abs(next_speed ** 2 - speed ** 2),
+                                     2 * self.limits.joint_acceleration * travel + rounding)
+
+    def test_speeds_within_limits(self):
+        moves = self.line((10, 10), (60, 30), 400) + self.line((60, 30), (20, 60), 400) \
+            + self.line((20, 60), (60, 60), 50, 1) + self.line((60, 60), (30, 20), 300)
+        planned = list(MotionPlanner(self.limits).plan(moves))
+        self.check_limits(moves, planned)
+        self.assertEqual(self.limits.start_rpm, planned[0][1])
+        self.assertEqual(self.limits.start_rpm, planned[-1][1])
+        self.assertGreater(max(rpm for _, rpm in planned), self.limits.start_rpm)
+
+    def test_sharp_corner_slowed(self):
+        zigzag = []
+        for k in range(20):
+            zigzag += self.line((20 + k, 20 + 10 * (k % 2)), (21 + k, 20 + 10 * ((k + 1) % 2)), 100)
+        straight = self.line((20, 20), (20, 60), 2000)
+        planner = MotionPlanner(self.limits)
+        corner_rpms = [rpm for move, rpm in planner.plan(zigzag) if any(
+            math.isclose(move[0], 21 + k) for k in range(19))]
+        straight_rpms = [rpm for _, rpm in MotionPlanner(self.limits).plan(straight)]
+        self.assertLess(max(corner_rpms), np.median(straight_rpms))
+
+    def test_lookahead_bounded(self):
+        moves = self.line((10, 10), (60, 60), 3000)
+        consumed = []
+
+        def source():
+            for move in moves:
+                consumed.append(move)
+                yield move
+
+        planned = []
+        for move, rpm in MotionPlanner(self.limits, lookahead=64).plan(source()):
+            self.assertLessEqual(len(consumed) - moves.index(move), 64)
+            planned.append((move, rpm))
+        self.check_limits(moves, planned)
+        whole = [rpm for _, rpm in MotionPlanner(self.limits, lookahead=len(moves) + 1).plan(moves)]
+        for windowed_rpm, rpm in zip([rpm for _, rpm in planned], whole):
+            self.assertLessEqual(windowed_rpm, rpm)  # what is beyond the window is assumed to need a stop
+
+    def test_planned_job_on_simulator(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "arcs.ngc")
+            write_gcode(filename, dense_arcs(), 5000)
+
+            def draw(planner):
+                device = SimulatedPlotter()
+                process = DrawingProcess(PrinterCommander(connection=SimulatedSerial(device)), filename,
+                                         speed=self.limits.start_rpm, planner=planner)
+                process.run()
+                return process, device
+
+            _, fixed = draw(None)
+            process, planned = draw(MotionPlanner(self.limits))
+            self.assertEqual(fixed.angles, planned.angles)
+            self.assertEqual(fixed.moves, planned.moves)
+            self.assertGreater(planned.speed_changes, 0)
+            self.assertEqual(process.metrics.counters['speed_changes'], planned.speed_changes)
+            self.assertEqual(self.limits.start_rpm, planned.rpm)
+            first = next(DrawingProcess(process.printer, filename).moves())  # the move to it is not planned
+            first_move_time = self.arm_travel((0, 0, 1, 0, 0), first) / (self.limits.start_rpm * DEG_PER_SEC_PER_RPM)
+            self.assertAlmostEqual(planned.motion_time, process.planner.estimated_time + first_move_time,
+                                   delta=planned.motion_time * .01)
+            self.assertLess(planned.motion_time, fixed.motion_time)
+
+    def test_speed_frames_accepted(self):
+        for binary_frames in (True, False):
+            device = SimulatedPlotter()
+            printer = PrinterCommander(connection=SimulatedSerial(device), binary_frames=binary_frames)
+            self.assertTrue(printer.supports_speed_frames)
+            with printer.motion_stream() as stream:
+                stream.move_to_alphas(20, 30)
+                stream.set_speed(250)
+                stream.move_to_alphas(40, 30)
+            self.assertEqual(250, device.rpm)
+            self.assertEqual(1, device.speed_changes)
+            self.assertEqual(0, device.rejected_frames)
+
+
+class FeedRateTest(unittest.TestCase):
+    GCODE = "G00 X20 Y20 Z1\nG01 Z-1 F600\nG01 X40 Y20\nG00 Z1\nG00 X60 Y60\nG01 Z-1\nG01 X60 Y40 F1200\nG00 Z1\n"
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.filename = os.path.join(tmp.name, "feeds.ngc")
+        with open(self.filename, "w") as f:
+            f.write(self.GCODE)
+
+    def process(self, device: SimulatedPlotter, **kwargs) -> DrawingProcess:
+        return DrawingProcess(PrinterCommander(connection=SimulatedSerial(device)), self.filename, speed=450,
+                              **kwargs)
+
+    def test_feeds_converted_and_rapids_at_rapid_speed(self):
+        process = self.process(SimulatedPlotter(), rapid_speed=400)
+        planned = list(process.feed_speeds(process.moves()))
+        rapids = [(move, rpm) for move, rpm in planned if move[5] == RAPID_FEED]
+        self.assertEqual({400}, {rpm for _, rpm in rapids})
+        self.assertEqual(4, len(rapids))  # not split
+        resolution = PlannerLimits().rpm_resolution
+        converted = 0
+        for (previous, _), (move, rpm) in zip(planned[:-1], planned[1:]):
+            arm_travel = max(abs(move[3] - previous[3]), abs(move[4] - previous[4]))
+            pen_travel = math.hypot(move[0] - previous[0], move[1] - previous[1])
+            if move[5] != RAPID_FEED and pen_travel > 0:
+                pen_speed_per_rpm = DEG_PER_SEC_PER_RPM * pen_travel / arm_travel
+                if rpm > PlannerLimits().min_rpm:
+                    self.assertLessEqual(rpm * pen_speed_per_rpm, move[5] / 60 + 1e-9)
+                    converted += 1
+                self.assertGreater((rpm + resolution) * pen_speed_per_rpm, move[5] / 60)
+        self.assertGreater(converted, 100)
+        self.assertEqual({600, 1200}, {move[5] for move, _ in planned if move[5] != RAPID_FEED})
+
+    def test_speed_changed_only_when_it_changes(self):
+        fixed_device = SimulatedPlotter()
+        self.process(fixed_device, feed_rates=False).run()
+        self.assertEqual(0, fixed_device.speed_changes)
+
+        device = SimulatedPlotter()
+        process = self.process(device, rapid_speed=400)
+        process.run()
+        fresh = self.process(SimulatedPlotter(), rapid_speed=400)
+        rpms = [rpm for _, rpm in fresh.feed_speeds(fresh.moves())]
+        changes = sum(1 for previous, rpm in zip([450] + rpms[:-1], rpms) if rpm != previous)
+        self.assertEqual(changes, device.speed_changes)
+        self.assertEqual(changes, process.metrics.counters['speed_changes'])
+        self.assertLess(changes, device.moves / 2)
+        self.assertEqual(fixed_device.angles, device.angles)
+        self.assertEqual(450, device.rpm)
+
+
+if __name__ == '__main__':
+    unittest.main()
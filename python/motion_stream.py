@@ -0,0 +1,322 @@
+import logging
+import re
+import struct
+import time
+import typing
+from collections import OrderedDict
+
+from metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+
+def _crc8_table() -> typing.List[int]:
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+        table.append(crc)
+    return table
+
+
+CRC8_TABLE = _crc8_table()
+
+
+def crc8(data: bytes, crc: int = 0) -> int:
+    """CRC-8, polynomial 0x07 (same as crc8 in the firmware's utils.h)"""
+    for byte in data:
+        crc = CRC8_TABLE[crc ^ byte]
+    return crc
+
+
+def _crc16_table() -> typing.List[int]:
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) & 0xFFFF if crc & 0x8000 else (crc << 1) & 0xFFFF
+        table.append(crc)
+    return table
+
+
+CRC16_TABLE = _crc16_table()
+
+
+def crc16(data: bytes, crc: int = 0xFFFF) -> int:
+    """CRC-16/CCITT-FALSE, polynomial 0x1021 (same as crc16 in the firmware's utils.h)"""
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFF) ^ CRC16_TABLE[(crc >> 8) ^ byte]
+    return crc
+
+
+PEN_UP_PAYLOAD = "u"
+PEN_DOWN_PAYLOAD = "d"
+SPEED_FRAME_VERSION = 1  # streaminfo: "s<version>", the firmware queues speed changes with the moves
+
+
+def move_payload(alpha1_deg: float, alpha2_deg: float) -> str:
+    return f"l{alpha1_deg:.5f} r{alpha2_deg:.5f}"
+
+
+def speed_payload(rpm: int) -> str:
+    """stepper speed for the following moves"""
+    return f"s{rpm}"
+
+
+def encode_stream_frame(seq: int, payload: str) -> bytes:
+    """q<seq> <payload> *<crc8 of everything up to the '*', hex>"""
+    body = f"q{seq % 256} {payload} *".encode("ascii")
+    return body + f"{crc8(body):02x}\n".encode("ascii")
+
+
+# binary frames, used if the firmware reports support for them (streaminfo: "stream q<size> b<version>")
+# host -> device: <sync> <seq> <kind: l|u|d|s> [<left> <right>: int32 LE, 1e-5 degrees, only for l]
+#                 [<rpm>: uint16 LE, only for s] <crc8>
+# device -> host: <sync> <kind: a|n> <seq> <free> <crc8>, replies to binary frames only
+BINARY_FRAME_VERSION = 1
+FRAME_SYNC = 0xA5  # never sent in the ASCII protocol
+ANGLE_SCALE = 100000  # fixed point units per degree
+_BINARY_MOVE = struct.Struct("<BBcii")
+_BINARY_PEN = struct.Struct("<BBc")
+_BINARY_SPEED = struct.Struct("<BBcH")
+_BINARY_RESPONSE = struct.Struct("<BcBB")
+BINARY_RESPONSE_SIZE = _BINARY_RESPONSE.size + 1
+
+
+def encode_binary_frame(seq: int, kind: str, alpha1_deg: float = 0.0, alpha2_deg: float = 0.0) -> bytes:
+    """kind: l (move, angles in degrees), u (pen up), d (pen down) or an ASCII speed payload (s<rpm>)"""
+    if kind == "l":
+        body = _BINARY_MOVE.pack(FRAME_SYNC, seq % 256, b"l",
+                                 round(alpha1_deg * ANGLE_SCALE), round(alpha2_deg * ANGLE_SCALE))
+    elif kind[0] == "s":
+        body = _BINARY_SPEED.pack(FRAME_SYNC, seq % 256, b"s", int(kind[1:]))
+    else:
+        body = _BINARY_PEN.pack(FRAME_SYNC, seq % 256, kind.encode("ascii"))
+    return body + bytes([crc8(body)])
+
+
+def decode_binary_response(data: bytes) -> typing.Optional[typing.Tuple[str, int, int]]:
+    """(kind, seq, free) of an acknowledgement frame, None if it is corrupted"""
+    if len(data) != BINARY_RESPONSE_SIZE or crc8(data[:-1]) != data[-1]:
+        return None
+    _, kind, seq, free = _BINARY_RESPONSE.unpack(data[:-1])
+    return kind.decode("ascii", errors="replace"), seq, free
+
+
+def encode_binary_response(kind: str, seq: int, free: int) -> bytes:
+    body = _BINARY_RESPONSE.pack(FRAME_SYNC, kind.encode("ascii"), seq % 256, free)
+    return body + bytes([crc8(body)])
+
+
+# delta burst payloads, used if the firmware reports support for them (streaminfo: "d<version>"), announced by
+# "burst s<points> d<version>": <first point: left, right int32 LE, 1e-5 degrees>
+#                                [<each further point: left, right int8, 1/DELTA_SCALE degrees from the point before>]
+#                                <crc16 of the bytes before: uint16 LE>
+DELTA_BURST_VERSION = 1
+DELTA_SCALE = 256  # delta units per degree
+DELTA_LIMITS = (-128, 127)
+DELTA_BURST_HEADER = struct.Struct("<ii")
+
+
+def delta_burst_length(points: int) -> int:
+    return DELTA_BURST_HEADER.size + 2 * (points - 1) + 2
+
+
+_RESPONSE_PATTERN = re.compile(r"([an])(\d+) f(\d+)")
+
+
+class StreamError(RuntimeError):
+    pass
+
+
+class FrameEncoder:
+    """Encodes the frames of a MotionStreamer ahead of sending them (e.g. on another thread).
+
+    The sequence numbers continue from the streamer's next one (see MotionStreamer.frame_encoder), so the frames
+    have to be sent in the order encoded with MotionStreamer.send_frame, with nothing else sent in between.
+    """
+
+    def __init__(self, next_seq: int, binary_frames: bool = False):
+        self.next_seq = next_seq
+        self.binary_frames = binary_frames
+
+    def move_to_alphas(self, alpha1_deg: float, alpha2_deg: float) -> bytes:
+        if self.binary_frames:
+            return self._frame(encode_binary_frame(self.next_seq, "l", alpha1_deg, alpha2_deg))
+        return self._encode(move_payload(alpha1_deg, alpha2_deg))
+
+    def pen_up(self) -> bytes:
+        return self._encode(PEN_UP_PAYLOAD)
+
+    def pen_down(self) -> bytes:
+        return self._encode(PEN_DOWN_PAYLOAD)
+
+    def set_speed(self, rpm: int) -> bytes:
+        return self._encode(speed_payload(rpm))
+
+    def _encode(self, payload: str) -> bytes:
+        """ASCII payload, the pen and speed payloads are also the kinds of the binary frames"""
+        encode = encode_binary_frame if self.binary_frames else encode_stream_frame
+        return self._frame(encode(self.next_seq, payload))
+
+    def _frame(self, frame: bytes) -> bytes:
+        self.next_seq += 1
+        return frame
+
+
+class MotionStreamer:
+    """Streams motion commands to the firmware's motion queue without waiting for each one to be executed.
+
+    Frames carry 8 bit sequence numbers. The firmware acknowledges them cumulatively as they are queued and reports
+    the number of free queue slots (credits); at most that many frames are in flight. Only frames reported missing
+    (or not acknowledged within `ack_timeout`) are sent again.
+
+    With `binary_frames`, frames and acknowledgements are sent in the compact binary format instead of ASCII.
+
+    The connection's read timeout is expected to be `ack_timeout`. Round trips (frame sent -> acknowledged, frames
+    sent more than once are not measured) and retransmissions are recorded in `metrics`.
+    """
+
+    def __init__(self, connection, queue_size: int, max_consecutive_timeouts: int = 20, binary_frames: bool = False,
+                 metrics: typing.Optional[Metrics] = None):
+        self.connection = connection
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.queue_size = queue_size
+        self.free = queue_size
+        self.binary_frames = binary_frames
+        self.max_consecutive_timeouts = max_consecutive_timeouts
+
+        self.next_seq = 0
+        self.unacked: typing.OrderedDict[int, bytes] = OrderedDict()
+        self.sent_at: typing.Dict[int, float] = {}  # of the unacknowledged frames sent once
+        self.last_acked_frame: typing.Optional[bytes] = None
+        self.consecutive_timeouts = 0
+
+        self.frames_sent = 0
+        self.frames_retransmitted = 0
+
+    @property
+    def credits(self) -> int:
+        return self.free - len(self.unacked)
+
+    def move_to_alphas(self, alpha1_deg: float, alpha2_deg: float):
+        self._send_frame(self.frame_encoder().move_to_alphas(alpha1_deg, alpha2_deg))
+
+    def pen_up(self):
+        self._send_frame(self.frame_encoder().pen_up())
+
+    def pen_down(self):
+        self._send_frame(self.frame_encoder().pen_down())
+
+    def set_speed(self, rpm: int):
+        """stepper speed of the following moves, applied by the firmware when it gets to them in the queue
+        (only if it reports SPEED_FRAME_VERSION)"""
+        self._send_frame(self.frame_encoder().set_speed(rpm))
+
+    @property
+    def completed_seq(self) -> int:
+        """sequence number of a frame the firmware has executed for sure (or an earlier one): the acknowledged
+        frames still waiting in its queue (see `free`) and the one being executed are not"""
+        acknowledged = next(iter(self.unacked), self.next_seq) - 1
+        return acknowledged - (self.queue_size - self.free) - 1
+
+    def frame_encoder(self) -> FrameEncoder:
+        """encodes the frames following the ones sent so far, see send_frame"""
+        return FrameEncoder(self.next_seq, self.binary_frames)
+
+    def send_frame(self, frame: bytes):
+        """sends a frame of the frame_encoder, in order"""
+        self._send_frame(frame)
+
+    def flush(self):
+        """waits until every frame sent is acknowledged (queued, not necessarily executed)"""
+        while self.unacked:
+            self._process_response()
+
+    def read_line(self) -> str:
+        """next text line from the plotter (partial on timeout), acknowledgements before it are processed"""
+        while True:
+            response = self._read_response()
+            if response is None:
+                return ""
+            if isinstance(response, str):
+                return response
+            self._handle_response(*response)
+
+    def _send_frame(self, frame: bytes):
+        while self.credits <= 0:
+            self._process_response()
+        self.unacked[self.next_seq] = frame
+        self.sent_at[self.next_seq] = time.perf_counter()
+        self.next_seq += 1
+        self._write(frame)
+        while self.connection.in_waiting:
+            self._process_response()
+
+    def _write(self, frame: bytes):
+        self.connection.write(frame)
+        self.frames_sent += 1
+
+    def _retransmit(self, seq: int):
+        self.frames_retransmitted += 1
+        self.metrics.count('retransmissions')
+        self.sent_at.pop(seq, None)
+        self._write(self.unacked[seq])
+
+    def _unwrap(self, seq8: int) -> int:
+        """8 bit sequence number -> the frame's sequence number (first unacknowledged one - 1 or later)"""
+        lowest = next(iter(self.unacked), self.next_seq) - 1
+        return lowest + (seq8 - lowest) % 256
+
+    def _acknowledge_up_to(self, seq: int):
+        now = time.perf_counter()
+        while self.unacked and next(iter(self.unacked)) <= seq:
+            acked, self.last_acked_frame = self.unacked.popitem(last=False)
+            sent_at = self.sent_at.pop(acked, None)
+            if sent_at is not None:
+                self.metrics.record_latency("stream_frame", now - sent_at)
+
+    def _read_response(self) -> typing.Union[None, str, typing.Tuple[str, int, int]]:
+        """(kind, seq, free) of an acknowledgement, a text line or None on timeout (or a corrupted frame)"""
+        first = self.connection.read(1)
+        if not first:
+            return None
+        if first[0] == FRAME_SYNC:
+            return decode_binary_response(first + self.connection.read(BINARY_RESPONSE_SIZE - 1))
+        line = (first + self.connection.readline()).decode("ascii", errors="replace")
+        if not line.endswith("\n"):
+            return None
+        match = _RESPONSE_PATTERN.match(line)
+        if match is None:
+            return line
+        return match.group(1), int(match.group(2)), int(match.group(3))
+
+    def _process_response(self):
+        response = self._read_response()
+        if response is None:
+            self._on_timeout()
+        elif isinstance(response, str):
+            logger.debug("unexpected response while streaming: %s", response.strip())
+        else:
+            self._handle_response(*response)
+
+    def _handle_response(self, kind: str, seq8: int, free: int):
+        self.consecutive_timeouts = 0
+        seq = self._unwrap(seq8)
+        if kind == "a":
+            self._acknowledge_up_to(seq)
+        else:  # frame `seq` is missing, everything before it arrived
+            self._acknowledge_up_to(seq - 1)
+            if seq in self.unacked:
+                self._retransmit(seq)
+        self.free = free
+
+    def _on_timeout(self):
+        self.consecutive_timeouts += 1
+        if self.consecutive_timeouts > self.max_consecutive_timeouts:
+            raise StreamError(f"no response from the plotter after {self.consecutive_timeouts} attempts")
+        if self.unacked:
+            self._retransmit(next(iter(self.unacked)))
+        elif self.last_acked_frame is not None:
+            self._write(self.last_acked_frame)  # duplicate frame: polls the free queue slots
@@ -0,0 +1,142 @@
+import unittest
+
+from plotter_simulator import *
+from printer_commander import *
+
+
+class RecordingPlotter(SimulatedPlotter):
+    def __init__(self):
+        super().__init__()
+        self.executed = []
+
+    def execute(self, command, then):
+        self.executed.append(command)
+        super().execute(command, then)
+
+
+class MotionStreamTest(unittest.TestCase):
+    BINARY_FRAMES = False
+
+    def setUp(self):
+        self.device = RecordingPlotter()
+        self.targets = [(10 + k * 0.25, 50 - k * 0.125) for k in range(300)]
+
+    def stream_targets(self, connection: SimulatedSerial) -> PrinterCommander:
+        printer = PrinterCommander(connection=connection, binary_frames=self.BINARY_FRAMES)
+        self.assertEqual(self.BINARY_FRAMES, printer.binary_frames)
+        with printer.motion_stream() as stream:
+            stream.pen_down()
+            for alpha1, alpha2 in self.targets:
+                stream.move_to_alphas(alpha1, alpha2)
+            stream.pen_up()
+        self.stream = stream
+        return printer
+
+    def is_frame(self, data: bytes, seq: int) -> bool:
+        if self.BINARY_FRAMES:
+            return data[:2] == bytes([FRAME_SYNC, seq])
+        return data.startswith(f"q{seq} ".encode("ascii"))
+
+    def assertAllExecutedInOrder(self):
+        moves = [command[1:] for command in self.device.executed if command[0] == "l"]
+        self.assertEqual(len(self.targets), len(moves))
+        for expected, actual in zip(self.targets, moves):
+            self.assertAlmostEqual(expected[0], actual[0], places=4)
+            self.assertAlmostEqual(expected[1], actual[1], places=4)
+        self.assertEqual("d", self.device.executed[0][0])
+        self.assertEqual("u", self.device.executed[-1][0])
+
+    def test_streamed_in_order(self):
+        printer = self.stream_targets(SimulatedSerial(self.device))
+        self.assertAllExecutedInOrder()
+        self.assertEqual(0, self.stream.frames_retransmitted)
+        for expected, actual in zip(self.device.angles, printer.current_alphas):
+            self.assertAlmostEqual(expected, actual, places=7)
+
+    def test_commands_in_flight_limited_by_credits(self):
+        self.device.QUEUE_SIZE = 4
+        self.stream_targets(SimulatedSerial(self.device))
+        self.assertAllExecutedInOrder()
+        self.assertLessEqual(self.device.max_queue_fill, 4)
+        self.assertEqual(0, self.device.rejected_frames)
+
+    def test_only_corrupted_frame_retransmitted(self):
+        corrupted = []
+
+        def corrupt(data: bytes) -> bytes:
+            if self.is_frame(data, 7) and not corrupted:
+                corrupted.append(data)
+                return data[:4] + bytes([data[4] ^ 0x01]) + data[5:]
+            return data
+
+        self.stream_targets(SimulatedSerial(self.device, corrupt))
+        self.assertAllExecutedInOrder()
+        self.assertEqual(1, self.stream.frames_retransmitted)
+
+    def test_only_lost_frame_retransmitted(self):
+        lost = []
+
+        def lose(data: bytes) -> bytes:
+            if self.is_frame(data, 3) and not lost:
+                lost.append(data)
+                return b""
+            return data
+
+        self.stream_targets(SimulatedSerial(self.device, lose))
+        self.assertAllExecutedInOrder()
+        self.assertEqual(1, self.stream.frames_retransmitted)
+
+    def test_frame_encoding(self):
+        frame = encode_stream_frame(258, move_payload(1.5, 2.25))
+        self.assertEqual(b"q2 l1.50000 r2.25000 *", frame[:-3])
+        self.assertEqual(crc8(frame[:-3]), int(frame[-3:-1], 16))
+
+
+class BinaryMotionStreamTest(MotionStreamTest):
+    BINARY_FRAMES = True
+
+    def test_frame_encoding(self):
+        frame = encode_binary_frame(258, "l", 1.5, -2.25)
+        self.assertEqual(bytes([FRAME_SYNC, 2]) + b"l" + (150000).to_bytes(4, "little")
+                         + (-225000).to_bytes(4, "little", signed=True), frame[:-1])
+        self.assertEqual(crc8(frame[:-1]), frame[-1])
+        self.assertEqual(4, len(encode_binary_frame(0, "u")))
+
+        response = encode_binary_response("n", 300, 5)
+        self.assertEqual(("n", 44, 5), decode_binary_response(response))
+        self.assertIsNone(decode_binary_response(response[:-1] + bytes([response[-1] ^ 1])))
+
+    def test_fewer_bytes_and_faster_than_ascii(self):
+        def stream(binary_frames: bool) -> SimulatedSerial:
+            connection = SimulatedSerial(SimulatedPlotter())
+            printer = PrinterCommander(connection=connection, binary_frames=binary_frames)
+            start, written, read = connection.now, connection.bytes_written, connection.bytes_read
+            with printer.motion_stream() as stream:
+                for alpha1, alpha2 in self.targets:
+                    stream.move_to_alphas(alpha1 / 100, alpha2 / 100)  # tiny moves: limited by the link
+            return connection.now - start, connection.bytes_written - written, connection.bytes_read - read
+
+        ascii_time, ascii_written, ascii_read = stream(False)
+        binary_time, binary_written, binary_read = stream(True)
+        self.assertLess(binary_written, 0.5 * ascii_written)
+        self.assertLess(binary_read, ascii_read)
+        self.assertLess(binary_time, 0.6 * ascii_time)
+
+    def test_ascii_fallback_for_older_firmware(self):
+        class AsciiOnlyPlotter(RecordingPlotter):
+            def handle_command(self, command):
+                if command.startswith("streaminfo"):
+                    self.println(f"stream q{self.QUEUE_SIZE}")
+                else:
+                    super().handle_command(command)
+
+        self.device = AsciiOnlyPlotter()
+        printer = PrinterCommander(connection=SimulatedSerial(self.device))
+        self.assertFalse(printer.binary_frames)
+        with printer.motion_stream() as stream:
+            stream.move_to_alphas(1.0, 2.0)
+        self.assertEqual([("l", 1.0, 2.0)], self.device.executed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import itertools
+import logging
+import threading
+import time
+import typing
+from queue import Queue, Full, Empty
+
+from metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+T = typing.TypeVar('T')
+
+_END = object()  # put by a stage after its last item (with the exception that ended it, if any)
+
+
+def growing_chunks(iterable: typing.Iterable[T], max_size: int) -> typing.Iterator[typing.List[T]]:
+    """the items in lists of 1, 2, 4, ... up to `max_size` items: the first ones are passed on right away, the
+    later ones with less overhead"""
+    iterator = iter(iterable)
+    size = 1
+    while chunk := list(itertools.islice(iterator, size)):
+        yield chunk
+        size = min(2 * size, max_size)
+
+
+class Pipeline:
+    """Stages running on threads of their own, connected by bounded queues.
+
+    A stage is an iterable (typically a generator pulling from the stage before it) iterated by its own thread. The
+    items it produces are put into a queue of `queue_size` items, so no stage gets more than that far ahead of the
+    one consuming it (backpressure). An exception ending a stage is raised in the consumer of the stage, after the
+    items produced before it.
+
+    Setting `stop_event` or closing the pipeline stops every stage: the consumers see the end of their stage and the
+    threads finish at their next item. The time the consumer of a stage waits for its items is added to the stage
+    time `pipeline_wait_<stage>` of `metrics`.
+    """
+
+    POLL_INTERVAL = 0.05  # seconds, how often blocked stages check for a stop
+
+    def __init__(self, stop_event: typing.Optional[threading.Event] = None, queue_size: int = 4,
+                 metrics: typing.Optional[Metrics] = None):
+        self.stop_event = stop_event if stop_event is not None else threading.Event()
+        self.queue_size = queue_size
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.items: typing.Dict[str, int] = {}  # produced by the stages
+        self.finished: typing.Set[str] = set()  # stages whose source ran out (or raised)
+        self._closed = threading.Event()
+        self._threads: typing.List[threading.Thread] = []
+
+    @property
+    def stopped(self) -> bool:
+        return self._closed.is_set() or self.stop_event.is_set()
+
+    def stage(self, name: str, source: typing.Iterable[T]) -> typing.Iterator[T]:
+        """starts iterating `source` on a new thread, returns its items"""
+        queue = Queue(self.queue_size)
+        self.items[name] = 0
+        thread = threading.Thread(target=self._produce, args=(name, source, queue), name=f"pipeline-{name}",
+                                  daemon=True)
+        self._threads.append(thread)
+        thread.start()
+        return self._consume(name, queue)
+
+    def close(self):
+        """stops the stages and waits for their threads"""
+        self._closed.set()
+        for thread in self._threads:
+            thread.join()
+
+    @property
+    def alive(self) -> bool:
+        return any(thread.is_alive() for thread in self._threads)
+
+    def __enter__(self) -> 'Pipeline':
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _produce(self, name: str, source: typing.Iterable, queue: Queue):
+        try:
+            for item in source:
+                if not self._put(queue, (item, None)):
+                    logger.debug("pipeline stage %s stopped", name)
+                    return
+                self.items[name] += 1
+        except BaseException as e:
+            self.finished.add(name)
+            self._put(queue, (_END, e))
+            return
+        self.finished.add(name)
+        self._put(queue, (_END, None))
+
+    def _put(self, queue: Queue, entry) -> bool:
+        while not self.stopped:
+            try:
+                queue.put(entry, timeout=self.POLL_INTERVAL)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _consume(self, name: str, queue: Queue) -> typing.Iterator:
+        wait = f"pipeline_wait_{name}"
+        while True:
+            start = time.perf_counter()
+            try:
+                item, error = queue.get(timeout=self.POLL_INTERVAL)
+            except Empty:
+                self.metrics.add_time(wait, time.perf_counter() - start)
+                if self.stopped:
+                    return
+                continue
+            self.metrics.add_time(wait, time.perf_counter() - start)
+            if item is _END:
+                if error is not None:
+                    raise error
+                return
+            yield item
@@ -0,0 +1,98 @@
+import os
+import tempfile
+import threading
+import unittest
+
+from drawing_process import *
+from pipeline import *
+from plotter_simulator import *
+from synthetic_gcode import dense_arcs, write_gcode
+
+
+class PipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.pipeline = Pipeline(queue_size=2)
+        self.addCleanup(self.pipeline.close)
+
+    def test_stages_in_order(self):
+        squares = self.pipeline.stage('square', (k * k for k in self.pipeline.stage('count', range(1000))))
+        self.assertEqual([k * k for k in range(1000)], list(squares))
+        self.assertEqual({'count', 'square'}, self.pipeline.finished)
+        self.assertEqual(1000, self.pipeline.items['square'])
+
+    def test_backpressure(self):
+        produced = []
+
+        def source():
+            for k in itertools.count():
+                produced.append(k)
+                yield k
+
+        items = self.pipeline.stage('count', source())
+        for k in range(10):
+            self.assertEqual(k, next(items))
+            # in the queue, just put and being put
+            self.assertLessEqual(len(produced) - k - 1, self.pipeline.queue_size + 2)
+        self.pipeline.close()
+        self.assertFalse(self.pipeline.alive)
+
+    def test_error_raised_after_items(self):
+        def failing():
+            yield 1
+            yield 2
+            raise ValueError("bad input")
+
+        items = self.pipeline.stage('double', (2 * k for k in self.pipeline.stage('fail', failing())))
+        self.assertEqual(2, next(items))
+        self.assertEqual(4, next(items))
+        with self.assertRaisesRegex(ValueError, "bad input"):
+            next(items)
+
+    def test_stop_ends_every_stage(self):
+        stop = threading.Event()
+        pipeline = Pipeline(stop, queue_size=2)
+        items = pipeline.stage('square', (k * k for k in pipeline.stage('count', itertools.count())))
+        self.assertEqual([0, 1, 4], [next(items) for _ in range(3)])
+        stop.set()
+        list(items)  # the consumer sees the end
+        pipeline.close()
+        self.assertFalse(pipeline.alive)
+        self.assertEqual(set(), pipeline.finished)
+
+    def test_growing_chunks(self):
+        self.assertEqual([1, 2, 4, 8, 8, 8, 1], [len(chunk) for chunk in growing_chunks(range(32), 8)])
+
+
+class DrawingPipelineTest(unittest.TestCase):
+    def test_stopped_before_the_file_is_interpolated(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "big.ngc")
+            write_gcode(filename, dense_arcs(), 3000000)
+            process = DrawingProcess(PrinterCommander(connection=SimulatedSerial(SimulatedPlotter())), filename,
+                                     interpolation_resolution=0.5)
+            process.start()
+            process.drawn_points.get(timeout=30)  # the first move, long before the file is parsed
+            process.stop()
+            process.join(30)
+            self.assertFalse(process.is_alive())
+            self.assertIsNone(process.error)
+            self.assertFalse(process.pipeline.alive)
+            self.assertNotIn('parse', process.pipeline.finished)
+            self.assertLess(process.pipeline.items['interpolate'], 50)  # held back by the full queues
+            self.assertEqual({'parse', 'interpolate', 'ik', 'plan', 'encode'}, set(process.pipeline.items))
+
+    def test_stage_error_ends_the_job(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "far.ngc")
+            with open(filename, "w") as f:
+                f.write("G00 X10 Y10 Z1\nG01 Z-1\nG01 X500 Y500\n")
+            device = SimulatedPlotter()
+            process = DrawingProcess(PrinterCommander(connection=SimulatedSerial(device)), filename)
+            with self.assertRaises(UnreachablePointsError):
+                process.run()
+            self.assertIsInstance(process.error, UnreachablePointsError)
+            self.assertFalse(process.pipeline.alive)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,589 @@
+import math
+import os
+import threading
+import time
+import typing
+from collections import deque
+
+from motion_stream import crc8, crc16, encode_binary_response, FRAME_SYNC, ANGLE_SCALE, BINARY_FRAME_VERSION, \
+    SPEED_FRAME_VERSION, DELTA_BURST_VERSION, DELTA_SCALE, DELTA_BURST_HEADER, delta_burst_length
+
+STEPS_PER_REV = 32  # see stepper.h
+GEAR_RED = 63.68395
+STEPS_PER_OUT_REV = STEPS_PER_REV * GEAR_RED
+
+SERVO_DELAY = 0.1  # seconds, Actuators::servoDelayMs
+BURST_ATTEMPTS = 5
+BINARY_FRAME_LENGTHS = {ord("l"): 12, ord("u"): 4, ord("d"): 4, ord("s"): 6}  # by kind, see motion_stream.py
+
+
+def degrees_to_steps(degrees: float) -> int:
+    return round(degrees * STEPS_PER_OUT_REV / 360.0)
+
+
+def steps_to_degrees(steps: int) -> float:
+    return steps / STEPS_PER_OUT_REV * 360.0
+
+
+def burst_checksum_ok(payload: bytes) -> bool:
+    words = [int.from_bytes(payload[k:k + 4], byteorder='big') for k in range(0, len(payload), 4)]
+    return sum(words[:-1]) % 0x100000000 == words[-1]
+
+
+def decode_burst(payload: bytes, delta: bool) -> typing.Optional[typing.List[typing.Tuple[float, float]]]:
+    """target angles of a burst payload (see PrinterCommander.burst), None if it is corrupted"""
+    if not delta:
+        if not burst_checksum_ok(payload):
+            return None
+        return [(payload[k] + payload[k + 1] / 255.0, payload[k + 2] + payload[k + 3] / 255.0)
+                for k in range(0, len(payload) - 4, 4)]
+    if crc16(payload[:-2]) != int.from_bytes(payload[-2:], byteorder='little'):
+        return None
+    first_l, first_r = (value / ANGLE_SCALE for value in DELTA_BURST_HEADER.unpack_from(payload))
+    targets = [(first_l, first_r)]
+    offset_l = offset_r = 0
+    for k in range(DELTA_BURST_HEADER.size, len(payload) - 2, 2):
+        offset_l += int.from_bytes(payload[k:k + 1], byteorder='little', signed=True)
+        offset_r += int.from_bytes(payload[k + 1:k + 2], byteorder='little', signed=True)
+        targets.append((first_l + offset_l / DELTA_SCALE, first_r + offset_r / DELTA_SCALE))
+    return targets
+
+
+class SimulatedPlotter:
+    """Device side of the serial protocol of the firmware (app_main.h), with a timing model.
+
+    Time is simulated: bytes take 10 bit times to transfer in each direction, moves take one stepper step delay per
+    step of the motor moving more (steps of the two motors are interleaved), pen moves take SERVO_DELAY.
+    Incoming bytes are handled at their arrival time, even during a move (the firmware polls the serial port between
+    steps), but regular commands only after the motion queue is empty.
+    """
+
+    QUEUE_SIZE = 16
+
+    def __init__(self, baud_rate: float = 115200, rpm: float = 200):
+        self.byte_time = 10 / baud_rate  # start + 8 data + stop bits
+        self.rpm = rpm
+
+        self.steps_l = 0
+        self.steps_r = 0
+        self.pen_is_down = False
+        self.autocal_offsets = (13.9556, 15.7222)
+        self.saved_angles = (0.0, 0.0)  # NVM
+
+        self.now = 0.0
+        self.busy_until = 0.0
+        self.on_busy_done: typing.Optional[typing.Callable[[], None]] = None
+        self.inbox: typing.Deque[typing.Tuple[float, bytes]] = deque()  # (arrival time, data)
+        self.rx_line_free = 0.0  # host -> device
+        self.tx_line_free = 0.0  # device -> host
+        self.output: typing.Deque[typing.Tuple[float, bytes]] = deque()  # (time fully transmitted, data)
+
+        self.input = bytearray()
+        self.pending_command: typing.Optional[str] = None
+        self.burst_size: typing.Optional[int] = None  # waiting for the payload of a burst
+        self.burst_delta = False  # the payload is delta encoded
+        self.burst_attempt = 0
+
+        # motion queue, see motion_queue.h
+        self.queue: typing.Dict[int, typing.Tuple[str, float, float]] = {}
+        self.head = 0
+        self.expected = 0
+        self.advertised_free = self.QUEUE_SIZE
+        self.naked_seq: typing.Optional[int] = None
+        self.binary_replies = False  # format of the last stream frame
+
+        # statistics
+        self.motion_time = 0.0
+        self.moves = 0
+        self.speed_changes = 0
+        self.burst_checksum_errors = 0
+        self.max_queue_fill = 0
+        self.rejected_frames = 0
+
+        self.println("Plotter ready")
+
+    @property
+    def angles(self) -> typing.Tuple[float, float]:
+        return steps_to_degrees(self.steps_l), steps_to_degrees(self.steps_r)
+
+    @property
+    def step_delay(self) -> float:
+        return 60.0 / STEPS_PER_REV / int(self.rpm + 0.5)  # Stepper::setSpeed
+
+    # serial port ------------------------------------------------------------------------
+
+    def receive(self, data: bytes, sent_at: float):
+        start = max(sent_at, self.rx_line_free)
+        self.rx_line_free = start + len(data) * self.byte_time
+        self.inbox.append((self.rx_line_free, bytes(data)))
+
+    def print(self, text: str):
+        self.write(text.encode("ascii"))
+
+    def println(self, text: str):
+        self.print(text + "\r\n")
+
+    def write(self, data: bytes):
+        start = max(self.now, self.tx_line_free)
+        self.tx_line_free = start + len(data) * self.byte_time
+        self.output.append((self.tx_line_free, data))
+
+    # main loop --------------------------------------------------------------------------
+
+    @property
+    def busy(self) -> bool:
+        return self.busy_until > self.now or self.on_busy_done is not None
+
+    def advance(self, until: float = math.inf, stop_on_output: bool = False) -> bool:
+        """Simulates the device up to `until` (at most), return: whether anything happened."""
+        progressed = False
+        while True:
+            if not self.busy and self._start_action():
+                progressed = True
+                if stop_on_output and self.output:
+                    return progressed
+                continue
+
+            next_event = min(self.inbox[0][0] if self.inbox else math.inf,
+                             self.busy_until if self.busy else math.inf)
+            if next_event > until or next_event == math.inf:
+                return progressed
+            self.now = max(self.now, next_event)
+            progressed = True
+
+            while self.inbox and self.inbox[0][0] <= self.now:
+                self.input += self.inbox.popleft()[1]
+            self.poll_serial()
+
+            if self.on_busy_done is not None and self.now >= self.busy_until:
+                on_busy_done, self.on_busy_done = self.on_busy_done, None
+                on_busy_done()
+            if stop_on_output and self.output:
+                return progressed
+
+    def run_for(self, duration: float, then: typing.Optional[typing.Callable[[], None]] = None):
+        self.busy_until = self.now + duration
+        self.on_busy_done = then if then is not None else (lambda: None)
+
+    def poll_serial(self):
+        while self.pending_command is None and self.burst_size is None and self.input:
+            if self.input[0] == FRAME_SYNC:
+                if len(self.input) < 3:
+                    return
+                length = BINARY_FRAME_LENGTHS.get(self.input[2])
+                if length is None:  # corrupted, resynchronizes at the next sync byte
+                    del self.input[:3]
+                    self.binary_replies = True
+                    self.rejected_frames += 1
+                    self.send_nak()
+                    continue
+                if len(self.input) < length:
+                    return
+                frame = bytes(self.input[:length])
+                del self.input[:length]
+                self.handle_binary_frame(frame)
+                continue
+
+            # a sync byte ends a text line (garbage left over from a corrupted binary frame)
+            end = min((index for index in (self.input.find(b"\n"), self.input.find(bytes([FRAME_SYNC])))
+                       if index >= 0), default=-1)
+            if end < 0:
+                return
+            complete = self.input[end] == ord("\n")
+            line = bytes(self.input[:end])
+            del self.input[:end + 1 if complete else end]
+            if not complete or any(byte >= 0x80 for byte in line):
+                continue
+            line = line.decode("ascii", errors="replace")
+            if line.startswith("q"):
+                self.handle_stream_frame(line)
+            else:
+                self.pending_command = line
+
+    def _can_start_action(self) -> bool:
+        if self.burst_size is not None:
+            return len(self.input) >= self.burst_length
+        return self.head != self.expected or self.pending_command is not None
+
+    def _start_action(self) -> bool:
+        if not self._can_start_action():
+            return False
+        if self.burst_size is not None:
+            self.handle_burst_payload()
+        elif self.head != self.expected:
+            command = self.queue.pop(self.head)
+            self.head = (self.head + 1) % 256
+            self.execute(command, then=self._after_queued_command)
+        else:
+            command, self.pending_command = self.pending_command, None
+            self.handle_command(command)
+        self.poll_serial()
+        return True
+
+    def _after_queued_command(self):
+        if self.advertised_free == 0:
+            self.send_ack()  # the host may be waiting for credits
+
+    def execute(self, command: typing.Tuple[str, float, float], then: typing.Callable[[], None]):
+        kind, l_deg, r_deg = command
+        if kind == "l":
+            self.move_to_degs(l_deg, r_deg, then)
+        elif kind == "d":
+            self.pen_down(then)
+        elif kind == "s":
+            self.speed_changes += 1
+            self.rpm = l_deg  # takes no time
+            self.run_for(0, then)
+        else:
+            self.pen_up(then)
+
+    def move_to_degs(self, l_deg: float, r_deg: float, then: typing.Optional[typing.Callable[[], None]] = None):
+        new_steps_l, new_steps_r = degrees_to_steps(l_deg), degrees_to_steps(r_deg)
+        duration = max(abs(new_steps_l - self.steps_l), abs(new_steps_r - self.steps_r)) * self.step_delay
+        self.steps_l, self.steps_r = new_steps_l, new_steps_r
+        self.motion_time += duration
+        self.moves += 1
+        self.run_for(duration, then)
+
+    def pen_up(self, then: typing.Optional[typing.Callable[[], None]] = None):
+        self.pen_is_down = False
+        self.run_for(SERVO_DELAY, then)
+
+    def pen_down(self, then: typing.Optional[typing.Callable[[], None]] = None):
+        self.pen_is_down = True
+        self.run_for(SERVO_DELAY, then)
+
+    # stream frames ----------------------------------------------------------------------
+
+    @property
+    def free(self) -> int:
+        return self.QUEUE_SIZE - (self.expected - self.head) % 256
+
+    def send_stream_response(self, kind: str, seq: int):
+        if self.binary_replies:
+            self.write(encode_binary_response(kind, seq, self.advertised_free))
+        else:
+            self.println(f"{kind}{seq} f{self.advertised_free}")
+
+    def send_ack(self):
+        self.advertised_free = self.free
+        self.naked_seq = None
+        self.send_stream_response("a", (self.expected - 1) % 256)
+
+    def send_nak(self, force: bool = False):
+        if not force and self.naked_seq == self.expected:
+            return
+        self.naked_seq = self.expected
+        self.advertised_free = self.free
+        self.send_stream_response("n", self.expected)
+
+    def handle_binary_frame(self, frame: bytes):
+        self.binary_replies = True
+        if crc8(frame[:-1]) != frame[-1]:
+            self.rejected_frames += 1
+            self.send_nak()
+            return
+        seq, kind = frame[1], chr(frame[2])
+        if kind == "l":
+            l_units, r_units = (int.from_bytes(frame[k:k + 4], byteorder="little", signed=True) for k in (3, 7))
+            self.queue_stream_command(seq, ("l", l_units / ANGLE_SCALE, r_units / ANGLE_SCALE))
+        elif kind == "s":
+            self.queue_stream_command(seq, ("s", int.from_bytes(frame[3:5], byteorder="little"), 0.0))
+        else:
+            self.queue_stream_command(seq, (kind, 0.0, 0.0))
+
+    def handle_stream_frame(self, frame: str):
+        self.binary_replies = False
+        body, star, crc = frame.rpartition("*")
+        try:
+            intact = star == "*" and crc8((body + star).encode("ascii")) == int(crc, 16)
+            seq_text, payload = body.split(" ", 1)
+            seq = int(seq_text[1:]) % 256
+        except ValueError:
+            intact = False
+        if not intact or not payload or payload[0] not in "luds":
+            self.rejected_frames += 1
+            self.send_nak()
+            return
+
+        if payload[0] == "l":
+            words = {word[0]: float(word[1:]) for word in payload.split()}
+            command = ("l", words["l"], words["r"])
+        elif payload[0] == "s":
+            command = ("s", int(float(payload[1:])), 0.0)
+        else:
+            command = (payload[0], 0.0, 0.0)
+        self.queue_stream_command(seq, command)
+
+    def queue_stream_command(self, seq: int, command: typing.Tuple[str, float, float]):
+        if 0 < (self.expected - seq) % 256 < 128:
+            self.send_ack()  # duplicate
+            return
+        if (seq - self.head) % 256 >= self.QUEUE_SIZE:
+            self.rejected_frames += 1
+            self.send_nak(force=True)
+            return
+        self.queue[seq] = command
+        while (self.expected - self.head) % 256 < self.QUEUE_SIZE and self.expected in self.queue:
+            self.expected = (self.expected + 1) % 256
+        self.max_queue_fill = max(self.max_queue_fill, len(self.queue))
+        if 0 < (self.expected - seq) % 256 < 128:
+            self.send_ack()
+        else:
+            self.send_nak()  # received out of order
+
+    # regular commands -------------------------------------------------------------------
+
+    def print_current_angles(self):
+        l_deg, r_deg = self.angles
+        self.println(f"ok {l_deg:.8f} {r_deg:.8f}")
+
+    def handle_command(self, command: str):
+        words = command.split()
+        params = {}
+        for word in words[1:]:
+            try:
+                params[word[0]] = float(word[1:])
+            except ValueError:
+                pass
+
+        if command.startswith("setspeed"):
+            speed = int(float(command[len("setSpeed") + 1:] or 0))
+            self.rpm = speed
+            self.println(f"s{speed:.8f}")
+        elif command.startswith("zeroangles"):
+            self.steps_l = self.steps_r = 0
+            self.println("Position zeroed")
+        elif command.startswith("getautocaloffs"):
+            self.println(f"{self.autocal_offsets[0]:.8f} {self.autocal_offsets[1]:.8f}")
+        elif command.startswith("autocal"):
+            self.autocal_offsets = (params.get("l", self.autocal_offsets[0]), params.get("r", self.autocal_offsets[1]))
+            self.autocalibrate(then=self.print_current_angles)
+        elif command.startswith("getcurrangles"):
+            self.print_current_angles()
+        elif command.startswith("saveangles"):
+            self.saved_angles = self.angles
+            self.print_current_angles()
+        elif command.startswith("streaminfo"):
+            self.println(f"stream q{self.QUEUE_SIZE} b{BINARY_FRAME_VERSION} s{SPEED_FRAME_VERSION} "
+                         f"d{DELTA_BURST_VERSION}")
+        elif command.startswith("burst"):
+            self.println("entered burst mode")
+            self.burst_size = int(params.get("s", 15))
+            self.burst_delta = params.get("d", 0) == DELTA_BURST_VERSION
+            self.burst_attempt = 0
+            if self.burst_delta and self.burst_size == 0:  # no first point
+                self.burst_size = None
+                self.print_current_angles()
+        elif command.startswith("move ") or command.startswith("moveto"):
+            l_deg, r_deg = self.angles
+            self.move_to_degs(params.get("l", l_deg), params.get("r", r_deg), then=self.print_current_angles)
+        elif command.startswith("moveby"):
+            l_deg, r_deg = self.angles
+            self.move_to_degs(l_deg + params.get("l", 0.0), r_deg + params.get("r", 0.0),
+                              then=self.print_current_angles)
+        elif command.startswith("penup"):
+            self.pen_up(then=lambda: self.println("pen is up"))
+        elif command.startswith("pendown"):
+            self.pen_down(then=lambda: self.println("pen is down"))
+        else:
+            self.println(f"Invalid command: {command}")
+
+    def autocalibrate(self, then: typing.Callable[[], None]):
+        """arms move down to the switches and up by the calibration offsets twice (Actuators::autoCalibrate)"""
+        offset_steps = max(degrees_to_steps(offset) for offset in self.autocal_offsets)
+        down_steps = max(abs(self.steps_l), abs(self.steps_r)) + offset_steps
+        step_delays = [60.0 / STEPS_PER_REV / speed for speed in (250, 100)]
+        duration = sum((down_steps + offset_steps) * step_delay for step_delay in step_delays)
+        self.steps_l = self.steps_r = 0
+        self.motion_time += duration
+        self.run_for(duration, then)
+
+    @property
+    def burst_length(self) -> int:
+        return delta_burst_length(self.burst_size) if self.burst_delta else self.burst_size * 4 + 4
+
+    def handle_burst_payload(self):
+        length = self.burst_length
+        payload, self.input = bytes(self.input[:length]), self.input[length:]
+        self.burst_attempt += 1
+        targets = decode_burst(payload, self.burst_delta)
+        if targets is None:
+            self.burst_checksum_errors += 1
+            self.println("checksum error")  # the host resends the payload
+            if self.burst_attempt >= BURST_ATTEMPTS:
+                self.burst_size = None
+            return
+
+        self.burst_size = None
+        targets = deque(targets)
+
+        def next_move():
+            if targets:
+                self.move_to_degs(*targets.popleft(), then=next_move)
+            else:
+                self.print_current_angles()
+
+        next_move()
+
+
+class SimulatedSerial:
+    """Stand-in for serial.Serial, connected to a SimulatedPlotter in simulated time.
+
+    Host time only passes while waiting for responses, unless `include_host_time` is set, in which case the real time
+    spent in host code between serial calls is added as well (for end-to-end throughput measurements).
+    `corrupt` may modify written chunks to simulate transmission errors.
+    """
+
+    def __init__(self,
+                 device: typing.Optional[SimulatedPlotter] = None,
+                 corrupt: typing.Optional[typing.Callable[[bytes], bytes]] = None,
+                 timeout: typing.Optional[float] = None,
+                 include_host_time: bool = False):
+        self.device = device if device is not None else SimulatedPlotter()
+        self.corrupt = corrupt
+        self.timeout = timeout
+        self.include_host_time = include_host_time
+
+        self.now = 0.0  # host time
+        self.rx_buffer = bytearray()
+        self.bytes_written = 0
+        self.bytes_read = 0
+        self._last_call = time.perf_counter()
+
+    def _host_time_passes(self):
+        if self.include_host_time:
+            self.now += time.perf_counter() - self._last_call
+
+    def _call_done(self):
+        self._last_call = time.perf_counter()
+
+    @property
+    def in_waiting(self) -> int:
+        self._host_time_passes()
+        self.device.advance(self.now)
+        self._collect(self.now)
+        self._call_done()
+        return len(self.rx_buffer)
+
+    def write(self, data: bytes) -> int:
+        self._host_time_passes()
+        self.bytes_written += len(data)
+        if self.corrupt is not None:
+            data = self.corrupt(data)
+        self.device.receive(data, self.now)
+        self._call_done()
+        return len(data)
+
+    def read(self, size: int = 1) -> bytes:
+        self._host_time_passes()
+        self._wait_for(lambda: len(self.rx_buffer) >= size)
+        data = self._take(min(size, len(self.rx_buffer)))
+        self._call_done()
+        return data
+
+    def readline(self) -> bytes:
+        self._host_time_passes()
+        self._wait_for(lambda: b"\n" in self.rx_buffer)
+        end = self.rx_buffer.find(b"\n") + 1
+        data = self._take(end if end > 0 else len(self.rx_buffer))
+        self._call_done()
+        return data
+
+    def _collect(self, until: float):
+        while self.device.output and self.device.output[0][0] <= until:
+            arrived_at, data = self.device.output.popleft()
+            self.now = max(self.now, arrived_at)
+            self.rx_buffer += data
+
+    def _wait_for(self, condition: typing.Callable[[], bool]):
+        deadline = self.now + self.timeout if self.timeout is not None else math.inf
+        self._collect(self.now)
+        while not condition():
+            if self.device.output and self.device.output[0][0] <= deadline:
+                self._collect(self.device.output[0][0])
+            elif not self.device.advance(deadline, stop_on_output=True):
+                self.now = max(self.now, deadline) if deadline != math.inf else self.now
+                return  # timeout
+
+    def _take(self, size: int) -> bytes:
+        data = bytes(self.rx_buffer[:size])
+        del self.rx_buffer[:size]
+        self.bytes_read += size
+        return data
+
+
+class PtyPlotterSimulator:
+    """Runs a SimulatedPlotter behind a pseudo-terminal in real time (scaled by `speedup`).
+
+    `port` can be opened like the real device, e.g. PrinterCommander(port=simulator.port). The device starts
+    `boot_time` seconds (real time) after `start`, like an Arduino after its bootloader: opening the port flushes
+    its input, a greeting sent before that would be lost.
+    """
+
+    def __init__(self, device: typing.Optional[SimulatedPlotter] = None, speedup: float = 1.0,
+                 boot_time: float = 0.5):
+        import tty  # POSIX only
+
+        self.device = device if device is not None else SimulatedPlotter()
+        self.speedup = speedup
+        self.boot_time = boot_time
+        self.master_fd, self.slave_fd = os.openpty()
+        tty.setraw(self.slave_fd)
+        self.port = os.ttyname(self.slave_fd)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self) -> 'PtyPlotterSimulator':
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        self._start_time = time.monotonic() + self.boot_time
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        os.close(self.master_fd)
+        os.close(self.slave_fd)
+
+    def _device_time(self) -> float:
+        return (time.monotonic() - self._start_time) * self.speedup
+
+    def _run(self):
+        import select
+
+        self._stop.wait(self.boot_time)
+        while not self._stop.is_set():
+            now = self._device_time()
+            self.device.advance(now)
+            while self.device.output and self.device.output[0][0] <= now:
+                os.write(self.master_fd, self.device.output.popleft()[1])
+
+            next_event = min(self.device.output[0][0] if self.device.output else math.inf,
+                             self.device.busy_until if self.device.busy else math.inf,
+                             self.device.inbox[0][0] if self.device.inbox else math.inf)
+            wait = min(max(next_event - now, 0) / self.speedup, 0.05)
+            readable, _, _ = select.select([self.master_fd], [], [], wait)
+            if readable:
+                self.device.receive(os.read(self.master_fd, 4096), self._device_time())
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Simulated plotter firmware on a pseudo-terminal")
+    parser.add_argument("--speedup", type=float, default=1.0)
+    args = parser.parse_args()
+
+    with PtyPlotterSimulator(speedup=args.speedup) as simulator:
+        print(f"Simulated plotter on {simulator.port}, Ctrl+C to stop")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,193 @@
+import os
+import tempfile
+import unittest
+
+from drawing_process import *
+from plotter_simulator import *
+from printer_commander import *
+
+
+class SimulatedPlotterTest(unittest.TestCase):
+    def setUp(self):
+        self.device = SimulatedPlotter()
+        self.connection = SimulatedSerial(self.device)
+        self.printer = PrinterCommander(connection=self.connection)
+
+    def test_moveto_answers_with_step_quantized_angles(self):
+        self.printer.move_to_alphas(10.0, 20.0)
+        self.assertAlmostEqual(steps_to_degrees(degrees_to_steps(10.0)), self.printer.curr_alpha1, places=7)
+        self.assertAlmostEqual(steps_to_degrees(degrees_to_steps(20.0)), self.printer.curr_alpha2, places=7)
+
+    def test_motion_time(self):
+        start = self.connection.now
+        self.printer.move_to_alphas(0.0, 90.0)
+        step_delay = 60.0 / STEPS_PER_REV / 200
+        self.assertAlmostEqual(degrees_to_steps(90.0) * step_delay, self.connection.now - start, delta=0.01)
+
+        self.printer.set_rpm(400)
+        start = self.connection.now
+        self.printer.move_to_alphas(0.0, 0.0)
+        self.assertAlmostEqual(degrees_to_steps(90.0) * step_delay / 2, self.connection.now - start, delta=0.01)
+
+    def test_serial_transfer_time(self):
+        start = self.connection.now
+        response = self.printer.send_serial_command("getcurrangles")
+        expected = (len("getcurrangles\n") + len(response)) * 10 / 115200
+        self.assertAlmostEqual(expected, self.connection.now - start, places=6)
+
+    def test_pen_and_calibration_commands(self):
+        self.assertEqual("pen is down", self.printer.send_serial_command("pendown").strip())
+        self.assertTrue(self.device.pen_is_down)
+        self.assertEqual("pen is up", self.printer.send_serial_command("penup").strip())
+        self.printer.move_to_alphas(30.0, 30.0)
+        self.printer.autocalibrate()
+        self.assertEqual((0.0, 0.0), self.printer.current_alphas)
+        self.printer.move_to_alphas(30.0, 30.0)
+        self.printer.save_angles()
+        self.assertAlmostEqual(30.0, self.device.saved_angles[0], delta=0.1)
+
+    def test_burst_checksum_retry(self):
+        corrupted = []
+
+        def corrupt(data: bytes) -> bytes:
+            if not data.endswith(b"\n") and not corrupted:  # binary payload
+                corrupted.append(data)
+                return bytes([data[0] ^ 1]) + data[1:]
+            return data
+
+        self.connection.corrupt = corrupt
+        self.printer.burst([(40, 40), (41, 40), (42, 41)])
+        self.assertEqual(1, self.device.burst_checksum_errors)
+        self.assertEqual(3, self.device.moves)
+        expected = self.printer.get_alphas_batch([(42, 41)])
+        self.assertAlmostEqual(expected.alpha1[0], self.printer.curr_alpha1, delta=0.2)  # step resolution
+
+    def test_delta_bursts_carry_more_points_per_round_trip(self):
+        xys = [(30 + k * 0.1, 40) for k in range(28)]
+        self.assertEqual(28, self.printer.burst_size)
+        written = self.connection.bytes_written
+        self.printer.burst(xys)
+        delta_bytes = self.connection.bytes_written - written
+        self.assertEqual(28, self.device.moves)
+        self.assertEqual(1, self.printer.metrics.latencies['burst_payload'].count)
+        expected = self.printer.get_alphas_batch(xys[-1:])
+        self.assertAlmostEqual(expected.alpha1[0], self.printer.curr_alpha1, delta=0.2)  # step resolution
+
+        device = SimulatedPlotter()
+        connection = SimulatedSerial(device)
+        printer = PrinterCommander(connection=connection, delta_bursts=False)
+        written = connection.bytes_written
+        for k in range(0, len(xys), printer.burst_size):
+            printer.burst(xys[k:k + printer.burst_size])
+        self.assertEqual(28, device.moves)
+        self.assertEqual(2, printer.metrics.latencies['burst_payload'].count)
+        self.assertLess(delta_bytes, 0.6 * (connection.bytes_written - written))
+
+    def test_delta_burst_split_at_jumps(self):
+        self.printer.burst([(30, 40), (30.1, 40), (60, 20), (60.1, 20)])
+        self.assertEqual(4, self.device.moves)
+        self.assertEqual(2, self.printer.metrics.latencies['burst_payload'].count)
+
+    def test_bursts_for_older_firmware(self):
+        class LegacyPlotter(SimulatedPlotter):
+            def handle_command(self, command):
+                if command.startswith("streaminfo"):
+                    self.println(f"stream q{self.QUEUE_SIZE} b{BINARY_FRAME_VERSION} s{SPEED_FRAME_VERSION}")
+                else:
+                    super().handle_command(command)
+
+        device = LegacyPlotter()
+        printer = PrinterCommander(connection=SimulatedSerial(device))
+        self.assertFalse(printer.delta_bursts)
+        self.assertEqual(15, printer.burst_size)
+        printer.burst([(40, 40), (41, 40)])
+        self.assertEqual(2, device.moves)
+
+    def test_streaming_is_faster_than_stop_and_wait(self):
+        targets = [(40 + k * 0.01, 40 - k * 0.01) for k in range(200)]
+
+        start = self.connection.now
+        for alpha1, alpha2 in targets:
+            self.printer.move_to_alphas(alpha1, alpha2)
+        stop_and_wait_time = self.connection.now - start
+
+        self.printer.move_to_alphas(0.0, 0.0)
+        with self.printer.motion_stream() as stream:
+            stream.move_to_alphas(*targets[0])
+        start = self.connection.now
+        with self.printer.motion_stream() as stream:
+            for alpha1, alpha2 in targets[1:]:
+                stream.move_to_alphas(alpha1, alpha2)
+        streaming_time = self.connection.now - start
+
+        self.assertLess(streaming_time, 0.8 * stop_and_wait_time)
+
+
+@unittest.skipUnless(hasattr(os, "openpty"), "needs a pseudo-terminal")
+class BurstPrintingTest(unittest.TestCase):
+    class NonStreamingPlotter(SimulatedPlotter):
+        def __init__(self):
+            super().__init__()
+            self.pen_changes = []
+
+        def handle_command(self, command):
+            if command.startswith("streaminfo"):
+                self.println(f"Invalid command: {command}")
+                return
+            if command.startswith("pen"):
+                self.pen_changes.append((command, self.moves))
+            super().handle_command(command)
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.filename = os.path.join(self.tmp.name, "strokes.ngc")
+        with open(self.filename, "w") as f:
+            f.write("G00 X10 Y10 Z1\nG01 Z-1\nG01 X40 Y10\nG00 Z1\nG00 X40 Y40\nG01 Z-1\nG01 X10 Y40\nG00 Z1\n")
+
+    def plot(self, **options) -> typing.Tuple[DrawingProcess, PrinterCommander, NonStreamingPlotter]:
+        device = self.NonStreamingPlotter()
+        printer = PrinterCommander(connection=SimulatedSerial(device))
+        process = DrawingProcess(printer, self.filename, interpolation_resolution=1, bursts=True, **options)
+        process.run()
+        return process, printer, device
+
+    def test_every_point_sent_in_bursts(self):
+        points = DrawingProcess(PrinterCommander(connection=SimulatedSerial(self.NonStreamingPlotter())),
+                                self.filename, interpolation_resolution=1).all_points()
+        process, printer, device = self.plot()
+
+        self.assertEqual(len(points), device.moves)
+        self.assertEqual(len(points), process.drawn_points.qsize())
+        # the pen changes after the points before them, the point reached with the pen down is not dropped
+        pen_downs = [index for index, (a, b) in enumerate(zip(points.z, points.z[1:]), 1) if a > 0 > b]
+        self.assertEqual([("pendown", index) for index in pen_downs],
+                         [change for change in device.pen_changes if change[0] == "pendown"])
+        bursts = printer.metrics.latencies['burst_payload'].count
+        self.assertLess(bursts, len(points) / 5)
+        expected = printer.get_alphas_batch([tuple(points[-1][:2])])
+        self.assertAlmostEqual(expected.alpha1[0], printer.curr_alpha1, delta=0.2)  # the last partial burst
+        self.assertAlmostEqual(expected.alpha2[0], printer.curr_alpha2, delta=0.2)
+
+    def test_bursts_from_the_job_cache(self):
+        cache = JobCache(os.path.join(self.tmp.name, "cache"))
+        _, _, uncached = self.plot()
+        for hits in (0, 1):  # compiled on the first run, read from the cache on the second
+            process, printer, device = self.plot(job_cache=cache)
+            self.assertEqual(hits, cache.hits)
+            self.assertEqual(uncached.moves, device.moves)
+            self.assertEqual(uncached.moves, printer.metrics.counters['points'])
+            self.assertEqual(uncached.pen_changes, device.pen_changes)
+
+
+class PtyPlotterSimulatorTest(unittest.TestCase):
+    def test_printer_commander_over_pty(self):
+        with PtyPlotterSimulator(speedup=100) as simulator:
+            printer = PrinterCommander(port=simulator.port)
+            printer.move_to_alphas(5.0, 6.0)
+            self.assertAlmostEqual(5.0, printer.curr_alpha1, delta=0.2)
+            printer.serial.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
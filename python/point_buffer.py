@@ -0,0 +1,171 @@
+import itertools
+import typing
+from collections.abc import Sequence
+
+import numpy as np
+
+DEFAULT_COLUMNS = ('x', 'y', 'z')
+
+
+class PointBuffer(Sequence):
+    """Points stored as contiguous float64 columns (x, y, z, and e.g. feed, alpha1, alpha2) instead of a list of
+    tuples of floats: 8 bytes per coordinate instead of ~40.
+
+    Indexing gives a point as a tuple of floats in the order of the columns, slicing gives a PointBuffer of views of
+    the columns (no copy). The columns are numpy arrays, accessible by name (`buffer.x`, `buffer['x']`); they
+    export their memory with the buffer protocol (memoryview(buffer.x)). np.asarray(buffer) stacks them (N x k).
+
+    Arrays the buffer did not allocate (slices, float64 arrays passed in) are never written to: remove_duplicates
+    copies them instead of compacting them in place, unless the buffer was made with `adopt`.
+    """
+
+    ITER_CHUNK_SIZE = 65536  # points converted to tuples at once while iterating
+
+    def __init__(self, **columns: typing.Union[np.ndarray, typing.Sequence[float]]):
+        """columns: name -> values, all of the same length (arrays of float64 are not copied)"""
+        self._columns: typing.Dict[str, np.ndarray] = {}
+        self._owned: typing.Set[str] = set()  # columns allocated for this buffer, free to be modified in place
+        for name, values in columns.items():
+            array = np.asarray(values, dtype=float)
+            self._columns[name] = array
+            if array is not values and array.base is None:  # converted, e.g. from a list
+                self._owned.add(name)
+        lengths = {len(values) for values in self._columns.values()}
+        if len(lengths) > 1:
+            raise ValueError(f"columns of different lengths: {sorted(lengths)}")
+        self._length = lengths.pop() if lengths else 0
+
+    @classmethod
+    def adopt(cls, **columns: np.ndarray) -> 'PointBuffer':
+        """buffer taking over freshly allocated arrays (not referenced elsewhere), which it may modify in place"""
+        buffer = cls(**columns)
+        buffer._owned.update(buffer.names)
+        return buffer
+
+    @classmethod
+    def from_points(cls, points: typing.Iterable[typing.Sequence[float]],
+                    names: typing.Sequence[str] = DEFAULT_COLUMNS) -> 'PointBuffer':
+        """buffer of points given as tuples, converted without a list of them"""
+        values = np.fromiter(itertools.chain.from_iterable(points), dtype=float).reshape(-1, len(names))
+        return cls.adopt(**{name: values[:, k].copy() for k, name in enumerate(names)})
+
+    @classmethod
+    def concatenate(cls, buffers: typing.Iterable['PointBuffer']) -> 'PointBuffer':
+        buffers = list(buffers)
+        if not buffers:
+            return cls()
+        return cls.adopt(**{name: np.concatenate([buffer[name] for buffer in buffers])
+                            for name in buffers[0].names})
+
+    @property
+    def names(self) -> typing.Tuple[str, ...]:
+        return tuple(self._columns)
+
+    @property
+    def columns(self) -> typing.Tuple[np.ndarray, ...]:
+        return tuple(self._columns.values())
+
+    @property
+    def xy(self) -> np.ndarray:
+        """N x 2 array of the x, y columns (a copy), e.g. for TwoArmKinematics.inverse"""
+        return np.column_stack((self._columns['x'], self._columns['y']))
+
+    @property
+    def nbytes(self) -> int:
+        return sum(values.nbytes for values in self._columns.values())
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __getattr__(self, name: str) -> np.ndarray:
+        columns = self.__dict__.get('_columns', {})
+        if name in columns:
+            return columns[name]
+        raise AttributeError(name)
+
+    @typing.overload
+    def __getitem__(self, index: int) -> typing.Tuple[float, ...]: ...
+
+    @typing.overload
+    def __getitem__(self, index: slice) -> 'PointBuffer': ...
+
+    @typing.overload
+    def __getitem__(self, index: str) -> np.ndarray: ...
+
+    def __getitem__(self, index):
+        if isinstance(index, str):
+            return self._columns[index]
+        if isinstance(index, slice):
+            return PointBuffer(**{name: values[index] for name, values in self._columns.items()})
+        if not -self._length <= index < self._length:
+            raise IndexError("point index out of range")
+        return tuple(values[index].item() for values in self._columns.values())
+
+    def __iter__(self) -> typing.Iterator[typing.Tuple[float, ...]]:
+        for start in range(0, self._length, self.ITER_CHUNK_SIZE):
+            end = start + self.ITER_CHUNK_SIZE
+            yield from zip(*(values[start:end].tolist() for values in self._columns.values()))
+
+    def __array__(self, dtype=None) -> np.ndarray:
+        return np.column_stack(self.columns).reshape(self._length, len(self._columns)).astype(dtype or float,
+                                                                                            copy=False)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, PointBuffer):
+            return self.names == other.names and all(np.array_equal(a, b) for a, b in zip(self.columns,
+                                                                                          other.columns))
+        if isinstance(other, Sequence) and not isinstance(other, str):
+            return len(self) == len(other) and all(a == tuple(b) for a, b in zip(self, other))
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"PointBuffer({self._length} points: {', '.join(self.names)})"
+
+    def tolist(self) -> typing.List[typing.Tuple[float, ...]]:
+        return list(self)
+
+    def select(self, *names: str) -> 'PointBuffer':
+        """the given columns in the given order (not copied)"""
+        return PointBuffer(**{name: self._columns[name] for name in names})
+
+    def with_columns(self, **columns: typing.Union[np.ndarray, typing.Sequence[float]]) -> 'PointBuffer':
+        """a buffer with further columns (or replaced ones), sharing the others"""
+        return PointBuffer(**{**self._columns, **columns})
+
+    def remove_duplicates(self, previous_point: typing.Optional[typing.Sequence[float]] = None,
+                          names: typing.Sequence[str] = DEFAULT_COLUMNS) -> 'PointBuffer':
+        """Drops the points equal to the one before them in the `names` columns (the first point if it equals
+        `previous_point`). Columns owned by the buffer are compacted within their own memory, shared ones (slices,
+        arrays passed in) are copied, leaving the data of their owners as it was. Returns self."""
+        compared = [self._columns[name] for name in names]
+        keep = np.ones(self._length, dtype=bool)
+        if self._length > 1:
+            keep[1:] = np.logical_or.reduce([values[1:] != values[:-1] for values in compared])
+        if previous_point is not None and self._length > 0:
+            keep[0] = tuple(values[0].item() for values in compared) != tuple(previous_point[:len(names)])
+        kept = np.flatnonzero(keep)
+        if len(kept) == self._length:
+            return self
+        for name, values in self._columns.items():
+            if name in self._owned and values.flags.writeable:
+                values[:len(kept)] = values[kept]
+                self._columns[name] = values[:len(kept)]
+            else:  # copy on write
+                self._columns[name] = values[kept]
+                self._owned.add(name)
+        self._length = len(kept)
+        return self
+
+
+def rechunk(buffers: typing.Iterable[PointBuffer], max_size: int) -> typing.Iterator[PointBuffer]:
+    """the points of the buffers in slices of 1, 2, 4, ... up to `max_size` points (see pipeline.growing_chunks),
+    without copying them"""
+    size = 1
+    for buffer in buffers:
+        start = 0
+        while start < len(buffer):
+            yield buffer[start:start + size]
+            start += size
+            size = min(2 * size, max_size)
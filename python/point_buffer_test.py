@@ -0,0 +1,145 @@
+import random
+import tracemalloc
+import unittest
+
+from gcodehandler import *
+from point_buffer import *
+from motion_stream import DELTA_SCALE, delta_burst_length
+from plotter_simulator import decode_burst
+from printer_commander import serialize_burst, serialize_delta_burst
+
+
+class PointBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.buffer = PointBuffer(x=[0, 1, 1, 2, 2], y=[0, 0, 0, 1, 1], z=[1, 1, 1, -1, 1])
+
+    def test_points_as_tuples(self):
+        self.assertEqual(5, len(self.buffer))
+        self.assertEqual((1.0, 0.0, 1.0), self.buffer[1])
+        self.assertEqual((2.0, 1.0, 1.0), self.buffer[-1])
+        self.assertEqual([(0, 0, 1), (1, 0, 1), (1, 0, 1), (2, 1, -1), (2, 1, 1)], self.buffer.tolist())
+        self.assertEqual(self.buffer, list(self.buffer))
+        self.assertNotEqual(self.buffer, list(self.buffer)[1:])
+        with self.assertRaises(IndexError):
+            self.buffer[5]
+
+    def test_slices_share_the_columns(self):
+        part = self.buffer[1:4]
+        self.assertEqual([(1, 0, 1), (1, 0, 1), (2, 1, -1)], part.tolist())
+        self.assertTrue(np.shares_memory(part.x, self.buffer.x))
+        self.assertIs(self.buffer['y'], self.buffer.y)
+        with self.assertRaises(AttributeError):
+            self.buffer.alpha1
+
+    def test_buffer_protocol(self):
+        view = memoryview(self.buffer.x)
+        self.assertEqual(('d', 5), (view.format, len(view)))
+        self.assertEqual((5, 3), np.asarray(self.buffer).shape)
+        self.assertEqual([0, 0], self.buffer.xy[0].tolist())
+
+    def test_remove_duplicates_in_place(self):
+        xs = self.buffer.x
+        self.assertIs(self.buffer, self.buffer.remove_duplicates(previous_point=(0, 0, 1, 600)))
+        self.assertEqual([(1, 0, 1), (2, 1, -1), (2, 1, 1)], self.buffer.tolist())
+        self.assertTrue(np.shares_memory(self.buffer.x, xs))
+
+    def test_remove_duplicates_of_read_only_columns(self):
+        xs = np.array([1., 1., 2.])
+        xs.flags.writeable = False
+        buffer = PointBuffer(x=xs, y=[0, 0, 0], z=[0, 0, 0]).remove_duplicates()
+        self.assertEqual([1, 2], buffer.x.tolist())
+        self.assertEqual([1, 1, 2], xs.tolist())
+
+    def test_remove_duplicates_of_a_slice(self):
+        xs = np.array([1., 1., 2., 3., 3., 4.])
+        buffer = PointBuffer(x=xs, y=np.zeros(6), z=np.zeros(6))
+        part = buffer[0:4].remove_duplicates()
+        self.assertEqual([1, 2, 3], part.x.tolist())
+        self.assertEqual([1, 1, 2, 3, 3, 4], buffer.x.tolist())
+        self.assertEqual([1, 1, 2, 3, 3, 4], xs.tolist())
+
+        borrowed = PointBuffer(x=xs, y=np.zeros(6), z=np.zeros(6)).remove_duplicates()
+        self.assertEqual([1, 2, 3, 4], borrowed.x.tolist())
+        self.assertEqual([1, 1, 2, 3, 3, 4], xs.tolist())
+        adopted = PointBuffer.adopt(x=xs, y=np.zeros(6), z=np.zeros(6)).remove_duplicates()
+        self.assertTrue(np.shares_memory(adopted.x, xs))
+
+    def test_columns_added_and_selected(self):
+        moves = self.buffer.with_columns(alpha1=np.arange(5), alpha2=np.arange(5) * 2)
+        self.assertEqual(('x', 'y', 'z', 'alpha1', 'alpha2'), moves.names)
+        self.assertIs(moves.x, self.buffer.x)
+        self.assertEqual((4.0, 8.0, 2.0), moves.select('alpha1', 'alpha2', 'x')[4])
+        with self.assertRaises(ValueError):
+            self.buffer.with_columns(feed=[1, 2])
+
+    def test_from_points_and_concatenate(self):
+        buffer = PointBuffer.from_points(iter(self.buffer))
+        self.assertEqual(self.buffer, buffer)
+        both = PointBuffer.concatenate([buffer, self.buffer[:2]])
+        self.assertEqual(self.buffer.tolist() + self.buffer[:2].tolist(), both.tolist())
+        self.assertEqual(0, len(PointBuffer.concatenate([])))
+
+    def test_rechunk(self):
+        chunks = list(rechunk([self.buffer, PointBuffer(x=range(20), y=range(20), z=range(20))], 8))
+        self.assertEqual([1, 2, 2, 8, 8, 4], [len(chunk) for chunk in chunks])
+        self.assertTrue(np.shares_memory(chunks[1].x, self.buffer.x))
+
+    def test_smaller_than_a_list_of_tuples(self):
+        program = MotionProgram.parse(["G00 X10 Y10 Z1\n", "G01 Z-1\n", "G01 X70 Y70\n", "G02 X10 Y70 I-30 J0\n"])
+        xs, ys, zs = program.resample(0.001)
+
+        def allocated(build):
+            tracemalloc.start()
+            result = build()
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            return result, size
+
+        points, list_size = allocated(lambda: list(zip(xs.tolist(), ys.tolist(), zs.tolist())))
+        buffer, buffer_size = allocated(lambda: PointBuffer(x=xs.copy(), y=ys.copy(), z=zs.copy()))
+        self.assertGreater(len(buffer), 100000)
+        self.assertEqual(buffer, points)
+        self.assertGreater(list_size, 4 * buffer_size)
+        self.assertEqual(buffer, program.points(0.001))
+
+    def test_burst_payload(self):
+        def reference(pairs) -> bytes:  # the former serialization, point by point
+            def number(value: float) -> bytes:
+                return bytes([int(value), int(value % 1 * 255 + .5)])
+
+            payload, checksum = bytearray(), 0
+            for a, b in pairs:
+                payload += number(a) + number(b)
+                checksum = (checksum + int.from_bytes(number(a), 'big') * 0x10000
+                            + int.from_bytes(number(b), 'big')) % 0x100000000
+            return bytes(payload) + checksum.to_bytes(4, 'big')
+
+        rnd = random.Random(0)
+        pairs = [(rnd.uniform(0, 255.999), rnd.uniform(0, 255.999)) for _ in range(15)] + [(0, 255.999)]
+        angles = PointBuffer(alpha1=[a for a, _ in pairs], alpha2=[b for _, b in pairs])
+        self.assertEqual(reference(pairs), serialize_burst(pairs))
+        self.assertEqual(reference(pairs), serialize_burst(angles))
+        with self.assertRaises(ValueError):
+            serialize_burst([(256.5, 0)])
+
+    def test_delta_burst_payload(self):
+        rnd = random.Random(0)
+        angles = [(-20.123456, 300.5)]
+        for _ in range(40):
+            angles.append((angles[-1][0] + rnd.uniform(-0.4, 0.4), angles[-1][1] + rnd.uniform(-0.4, 0.4)))
+        payload, count = serialize_delta_burst(angles[:28])
+        self.assertEqual((64, 28), (len(payload), count))
+        for expected, actual in zip(angles, decode_burst(payload, delta=True)):
+            self.assertAlmostEqual(expected[0], actual[0], delta=0.5 / DELTA_SCALE + 1e-5)  # no accumulated error
+            self.assertAlmostEqual(expected[1], actual[1], delta=0.5 / DELTA_SCALE + 1e-5)
+        self.assertIsNone(decode_burst(payload[:20] + bytes([payload[20] ^ 4]) + payload[21:], delta=True))
+
+        angles[5] = (angles[4][0] + 1, angles[4][1])  # too far for a delta
+        payload, count = serialize_delta_burst(PointBuffer(alpha1=[a for a, _ in angles[:28]],
+                                                           alpha2=[b for _, b in angles[:28]]))
+        self.assertEqual(5, count)
+        self.assertEqual(delta_burst_length(5), len(payload))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import typing
+from collections import namedtuple
+
+import numpy as np
+
+from joint_simplifier import *
+from point_buffer import *
+
+ALPHA_LIMITS = (0.0, 130.0)  # degrees, the range of arm angles the plotter can practically use
+SINGULARITY_MARGIN = 5.0  # degrees, closer than this to a singular configuration is flagged
+
+class PreflightReport(namedtuple('PreflightReport', ['points', 'unreachable', 'out_of_limits', 'singular',
+                                                     'max_error', 'max_error_index', 'alpha1_range',
+                                                     'alpha2_range'])):
+    """unreachable, out_of_limits, singular: indices of the points, max_error: mm between the point and the pen
+    position the motors reach (the angles rounded to motor steps; inf if the wires do not meet there), NaN if no
+    point is reachable"""
+    __slots__ = ()
+
+    @property
+    def ok(self) -> bool:
+        return len(self.unreachable) == 0 and len(self.out_of_limits) == 0
+
+    def summary(self) -> str:
+        problems = [f"{len(indices)} {name} (first at point {indices[0]})"
+                    for name, indices in (('unreachable', self.unreachable),
+                                          ('outside of the angle limits', self.out_of_limits),
+                                          ('near singular', self.singular)) if len(indices) > 0]
+        error = "no reachable point" if np.isnan(self.max_error) else f"max error {self.max_error:.3f} mm"
+        return f"{self.points} points: " + ", ".join(problems + [error])
+
+
+class PreflightError(ValueError):
+    """a job refused by its pre-flight check"""
+
+    def __init__(self, filename: str, report: PreflightReport):
+        super().__init__(f"pre-flight check of {filename} failed: {report.summary()}")
+        self.report = report
+
+
+def singularity_distances(kinematics: TwoArmKinematics, xs: np.ndarray, ys: np.ndarray, alpha1: np.ndarray,
+                          alpha2: np.ndarray) -> np.ndarray:
+    """degrees from the nearest singular configuration at every point (printer coordinates and their arm angles)
+
+    The arms lose control of the pen where an arm is in line with its wire (the edge of the workspace) and where
+    the two wires are in line with each other (the pen position is undetermined).
+    """
+    x, y = kinematics.machine_xy(xs, ys)
+    a1, a2 = np.radians(alpha1), np.radians(alpha2)
+    # arm ends relative to their motor axles (see TwoArmKinematics.forward), wires from the arm ends to the pen
+    arm1_x, arm1_y = kinematics.R1 * np.cos(a1), -kinematics.R1 * np.sin(a1)
+    arm2_x, arm2_y = -kinematics.R2 * np.cos(a2), -kinematics.R2 * np.sin(a2)
+    wire1_x, wire1_y = x - arm1_x, y - arm1_y
+    wire2_x, wire2_y = x - kinematics.D - arm2_x, y - arm2_y
+
+    def sine(ax, ay, bx, by, length):
+        return np.minimum(np.abs(ax * by - ay * bx) / length, 1)
+
+    sines = np.minimum.reduce([sine(arm1_x, arm1_y, wire1_x, wire1_y, kinematics.R1 * kinematics.l1),
+                               sine(arm2_x, arm2_y, wire2_x, wire2_y, kinematics.R2 * kinematics.l2),
+                               sine(wire1_x, wire1_y, wire2_x, wire2_y, kinematics.l1 * kinematics.l2)])
+    return np.degrees(np.arcsin(sines))
+
+
+def preflight_check(kinematics: TwoArmKinematics,
+                    points: typing.Union[PointBuffer, np.ndarray],
+                    alphas: typing.Optional[typing.Tuple[np.ndarray, np.ndarray]] = None,
+                    alpha_limits: typing.Tuple[float, float] = ALPHA_LIMITS,
+                    singularity_margin: float = SINGULARITY_MARGIN,
+                    step_angle: float = STEP_ANGLE) -> PreflightReport:
+    """Checks every point of a job before it is plotted, vectorized over all of them: whether the arms can reach it,
+    within `alpha_limits`, and away from singular configurations. The forward kinematics of the angles rounded to
+    motor steps gives the error of the pen position against the intended path.
+
+    points: the x, y columns of a PointBuffer or an N x 2 array (printer coordinates)
+    alphas: the angles to be sent (e.g. of a compiled job), solved from the points if not given
+    """
+    xys = points.xy if isinstance(points, PointBuffer) else np.asarray(points, dtype=float).reshape(-1, 2)
+    xs, ys = xys[:, 0], xys[:, 1]
+    if alphas is None:
+        solution = kinematics.inverse(xys)
+        alpha1, alpha2 = solution.alpha1, solution.alpha2
+    else:
+        alpha1, alpha2 = (np.asarray(values, dtype=float) for values in alphas)
+    reachable = np.isfinite(alpha1) & np.isfinite(alpha2)
+    low, high = alpha_limits
+    with np.errstate(invalid='ignore'):
+        out_of_limits = reachable & ((alpha1 < low) | (alpha1 > high) | (alpha2 < low) | (alpha2 > high))
+        singular = reachable & (singularity_distances(kinematics, xs, ys, alpha1, alpha2) < singularity_margin)
+
+        fx, fy = kinematics.forward(np.round(alpha1 / step_angle) * step_angle,
+                                    np.round(alpha2 / step_angle) * step_angle)
+        errors = np.where(reachable, np.hypot(fx - xs, fy - ys), -np.inf)
+    errors[np.isnan(errors)] = np.inf  # the wires can not meet at the rounded angles
+    max_error_index = int(np.argmax(errors)) if reachable.any() else -1
+    max_error = float(errors[max_error_index]) if max_error_index >= 0 else float('nan')
+
+    def angle_range(alpha):
+        return (float(alpha[reachable].min()), float(alpha[reachable].max())) if reachable.any() else None
+
+    return PreflightReport(len(xys), np.flatnonzero(~reachable), np.flatnonzero(out_of_limits),
+                           np.flatnonzero(singular), max_error, max_error_index, angle_range(alpha1),
+                           angle_range(alpha2))
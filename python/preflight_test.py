@@ -0,0 +1,172 @@
+import math
+import os
+import tempfile
+import time
+import unittest
+
+from drawing_process import *
+from plotter_simulator import *
+from preflight import *
+from synthetic_gcode import *
+
+
+class PreflightCheckTest(unittest.TestCase):
+    def setUp(self):
+        self.kin = TwoArmKinematics()
+
+    def test_points_flagged_by_index(self):
+        report = preflight_check(self.kin, [(40, 40), (40, 1000), (76, 76), (10, 10), (-500, 40)])
+        self.assertEqual(5, report.points)
+        self.assertEqual([1, 4], report.unreachable.tolist())
+        self.assertEqual([2], report.out_of_limits.tolist())  # the right arm above 130 degrees
+        self.assertGreater(report.alpha2_range[1], 130)
+        self.assertFalse(report.ok)
+        self.assertIn("2 unreachable (first at point 1)", report.summary())
+        self.assertTrue(preflight_check(self.kin, [(40, 40), (10, 10)]).ok)
+
+    def test_singular_configurations(self):
+        # the left arm folded back along its wire: the pen as close to the motor axle as the wire allows
+        reach = self.kin.l1 - self.kin.R1
+        x = 40
+        xs, ys = self.kin.printer_xy(np.array([x]), np.array([math.sqrt(reach ** 2 - x ** 2) + 1e-9]))
+        solution = self.kin.inverse(np.column_stack((xs, ys)))
+        self.assertLess(singularity_distances(self.kin, xs, ys, solution.alpha1, solution.alpha2)[0], 0.01)
+        report = preflight_check(self.kin, np.column_stack((xs, ys)))
+        self.assertEqual([0], report.singular.tolist())
+
+        center = np.array([40.]), np.array([40.])
+        solution = self.kin.inverse(np.column_stack(center))
+        self.assertGreater(singularity_distances(self.kin, *center, solution.alpha1, solution.alpha2)[0],
+                           SINGULARITY_MARGIN)
+
+    def test_error_of_the_motor_steps(self):
+        xs, ys = np.meshgrid(np.linspace(2, 76, 50), np.linspace(2, 60, 50))
+        points = np.column_stack((xs.ravel(), ys.ravel()))
+        report = preflight_check(self.kin, points)
+        self.assertTrue(0.01 < report.max_error < 0.3)  # half a step times the sensitivity of the arms
+        self.assertLess(preflight_check(self.kin, points, step_angle=1e-9).max_error, 1e-6)
+
+        solution = self.kin.inverse(points)
+        shifted = preflight_check(self.kin, points, (solution.alpha1, solution.alpha2 + 1))
+        self.assertGreater(shifted.max_error, 1)
+
+    def test_nothing_reachable(self):
+        report = preflight_check(self.kin, [(40, 1000)])
+        self.assertTrue(math.isnan(report.max_error))
+        self.assertIsNone(report.alpha1_range)
+        self.assertIn("no reachable point", report.summary())
+
+    def test_million_points_in_well_under_a_second(self):
+        points = PointBuffer(**dict(zip('xy', np.random.default_rng(0).uniform(2, 76, (2, 1000000)))))
+        times = []
+        for _ in range(3):
+            start = time.perf_counter()
+            report = preflight_check(self.kin, points)
+            times.append(time.perf_counter() - start)
+        self.assertEqual(1000000, report.points)
+        self.assertLess(min(times), 1.0)
+
+    def test_synthetic_gcode_within_reach(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "synthetic.ngc")
+            for generator in (dense_arcs, long_polylines, pen_lifts):
+                write_gcode(filename, generator(), 300000)
+                report = preflight_check(self.kin, MotionProgram.from_file(filename).points(0.1))
+                self.assertTrue(report.ok, f"{generator.__name__}: {report.summary()}")
+
+
+class DrawingProcessPreflightTest(unittest.TestCase):
+    def test_whole_file_checked_before_start(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "far.ngc")
+            with open(filename, "w") as f:
+                f.write("G00 X10 Y10 Z1\nG01 Z-1\nG01 X40 Y40\nG01 X40 Y500\nG01 X10 Y10\n")
+            device = SimulatedPlotter()
+            process = DrawingProcess(PrinterCommander(connection=SimulatedSerial(device)), filename,
+                                     interpolation_resolution=1)
+            report = process.preflight()
+            self.assertEqual(len(list(process.points())), report.points)
+            self.assertGreater(len(report.unreachable), 0)
+            self.assertEqual(0, device.moves)
+
+    def test_file_still_plotted_after_the_check(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "square.ngc")
+            with open(filename, "w") as f:
+                f.write("G00 X10 Y10 Z1\nG01 Z-1\nG01 X40 Y10\nG01 X40 Y40\nG01 X10 Y40\nG01 X10 Y10\n")
+            device = SimulatedPlotter()
+            process = DrawingProcess(PrinterCommander(connection=SimulatedSerial(device)), filename,
+                                     interpolation_resolution=1)
+            report = process.preflight()
+            self.assertTrue(report.ok)
+            self.assertLess(report.max_error, 0.3)
+            process.run()
+            self.assertEqual(report.points, device.moves)
+
+    def test_job_refused_before_plotting(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "corner.ngc")
+            with open(filename, "w") as f:
+                f.write("G00 X40 Y40 Z1\nG01 Z-1\nG01 X76 Y76\nG00 Z1\n")  # the corner is outside of the limits
+            device = SimulatedPlotter()
+            printer = PrinterCommander(connection=SimulatedSerial(device))
+            process = DrawingProcess(printer, filename, interpolation_resolution=1, preflight_policy='refuse')
+            with self.assertRaises(PreflightError) as raised:
+                process.run()
+            self.assertIs(raised.exception, process.error)
+            self.assertIs(process.preflight_report, raised.exception.report)
+            self.assertEqual(0, device.moves)
+
+            process = DrawingProcess(printer, filename, interpolation_resolution=1, preflight_policy='warn')
+            with self.assertLogs('drawing_process', 'WARNING'):
+                process.run()
+            self.assertFalse(process.preflight_report.ok)
+            self.assertEqual(process.preflight_report.points, device.moves)
+
+    def test_compiled_job_checked_without_parsing_the_file(self):
+        class CachedOnly(DrawingProcess):
+            def all_points(self):
+                raise AssertionError("the file is parsed again")
+
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = JobCache(os.path.join(tmp, "cache"))
+            square = os.path.join(tmp, "square.ngc")
+            with open(square, "w") as f:
+                f.write("G00 X10 Y10 Z1\nG01 Z-1\nG01 X40 Y10\nG01 X40 Y40\nG01 X10 Y40\nG01 X10 Y10\n")
+            corner = os.path.join(tmp, "corner.ngc")
+            with open(corner, "w") as f:
+                f.write("G00 X40 Y40 Z1\nG01 Z-1\nG01 X76 Y76\nG00 Z1\n")
+            device = SimulatedPlotter()
+            printer = PrinterCommander(connection=SimulatedSerial(device))
+            reports = []
+            for _ in range(2):  # compiled, then read from the cache
+                process = CachedOnly(printer, square, interpolation_resolution=1, job_cache=cache,
+                                     preflight_policy='refuse')
+                process.run()
+                reports.append(process.preflight_report)
+            self.assertEqual(1, cache.hits)
+            self.assertTrue(all(report.ok for report in reports))
+            self.assertEqual(reports[0].points, reports[1].points)
+            self.assertLess(reports[1].max_error, 0.3)
+
+            moves = device.moves
+            process = CachedOnly(printer, corner, interpolation_resolution=1, job_cache=cache,
+                                 preflight_policy='refuse')
+            with self.assertRaises(PreflightError):
+                process.run()
+            self.assertGreater(len(process.preflight_report.out_of_limits), 0)
+            self.assertEqual(moves, device.moves)
+
+            far = os.path.join(tmp, "far.ngc")
+            with open(far, "w") as f:
+                f.write("G00 X10 Y10 Z1\nG01 Z-1\nG01 X40 Y500\n")
+            process = DrawingProcess(printer, far, interpolation_resolution=1, job_cache=cache,
+                                     preflight_policy='refuse')
+            with self.assertRaises(PreflightError):  # the job can not be compiled
+                process.run()
+            self.assertGreater(len(process.preflight_report.unreachable), 0)
+            self.assertEqual(moves, device.moves)
+
+
+if __name__ == '__main__':
+    unittest.main()
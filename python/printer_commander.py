@@ -1,44 +1,105 @@
+import contextlib
+import logging
+import time
 import typing
 import serial
 import math
 
+import numpy as np
+
+from kinematics import *
+from motion_stream import *
+from metrics import *
+from point_buffer import *
+from serial_trace import TraceWriter, TracingConnection
+
+logger = logging.getLogger(__name__)
+
+
+def serialize_burst(point_list: typing.Union[PointBuffer, np.ndarray, typing.Collection[typing.Tuple[float, float]]]) \
+        -> bytes:
+    """burst payload: each angle as integer degrees and 1/255 fraction bytes, then a 4 byte checksum
+    point_list: (alpha1, alpha2) pairs, or a PointBuffer with alpha1 and alpha2 columns"""
+    if isinstance(point_list, PointBuffer):
+        angles = np.column_stack((point_list.alpha1, point_list.alpha2))
+    else:
+        angles = np.asarray(point_list, dtype=float).reshape(-1, 2)
+    degrees = np.trunc(angles)
+    fractions = np.floor(angles % 1 * 255 + .5)
+    if np.any((degrees < 0) | (degrees > 255) | (fractions > 255)):
+        raise ValueError("burst angles must be in range(0, 256)")
+    numbers = (degrees.astype(np.int64) << 8) + fractions.astype(np.int64)  # big endian 16 bits
+    checksum = int(np.sum((numbers[:, 0] << 16) + numbers[:, 1])) % 0x100000000
+    return numbers.astype(">u2").tobytes() + checksum.to_bytes(4, byteorder="big", signed=False)
+
+
+def serialize_delta_burst(point_list: typing.Union[PointBuffer, np.ndarray,
+                                                   typing.Collection[typing.Tuple[float, float]]]) \
+        -> typing.Tuple[bytes, int]:
+    """delta burst payload (see motion_stream.py) of the longest prefix of the points whose steps fit in the deltas,
+    and the number of points in it. The deltas are rounded from the offsets to the first point, so the rounding
+    errors do not add up (at most half a delta unit per angle).
+    point_list: (alpha1, alpha2) pairs, or a PointBuffer with alpha1 and alpha2 columns, at least one"""
+    if isinstance(point_list, PointBuffer):
+        angles = np.column_stack((point_list.alpha1, point_list.alpha2))
+    else:
+        angles = np.asarray(point_list, dtype=float).reshape(-1, 2)
+    first = np.round(angles[0] * ANGLE_SCALE).astype(np.int64)
+    offsets = np.round((angles[1:] - first / ANGLE_SCALE) * DELTA_SCALE).astype(np.int64)
+    deltas = np.diff(offsets, axis=0, prepend=np.zeros((1, 2), dtype=np.int64))
+    low, high = DELTA_LIMITS
+    too_large = np.flatnonzero(np.any((deltas < low) | (deltas > high), axis=1))
+    count = int(too_large[0]) if len(too_large) else len(deltas)
+    body = DELTA_BURST_HEADER.pack(*first.tolist()) + deltas[:count].astype(np.int8).tobytes()
+    return body + crc16(body).to_bytes(2, byteorder="little"), count + 1
+
 
 class PrinterCommander:
     BURST_SIZE = 15  # each point is 2 bytes -> 15*2*2+4(checksum) = 64 = Arduino serial buffer size
+    DELTA_BURST_SIZE = 28  # 8 (first point) + 27*2 (deltas) + 2 (crc16) = 64
+
+    STREAM_ACK_TIMEOUT = 0.5  # seconds
 
-    def __init__(self):
-        # printer physical parameters (distances in mm):
-        # lego arms attached to metal wheel
-        self.R1 = 99.625 - 3 * 7.97  # 99.625 <- last hole (one hole distance is 7.97mm)
-        self.R2 = 99.625 - 3 * 7.97
-        self.l1 = 159  # left wire length
-        self.l2 = 159
-        self.D = 258.7  # distance of motor axles
-
-        # working area
-        self.width = 80
-        self.height = 80
-        self.x_min = (self.D - self.width) / 2.0
-        self.y_min = 15
+    def __init__(self, port: str = 'COM5', connection=None, binary_frames: bool = True,
+                 trace: typing.Optional[str] = None, delta_bursts: bool = True):
+        """connection: serial.Serial-like object (write, read, readline, in_waiting, timeout), `port` is opened if
+        not given. binary_frames: stream in the binary frame format if the firmware supports it, ASCII otherwise
+        delta_bursts: send bursts in the delta encoding if the firmware supports it
+        trace: file to record the session to (see serial_trace)"""
+        self.kinematics = TwoArmKinematics()
+        self.metrics = Metrics()
 
         self.curr_alpha1 = 0.0
         self.curr_alpha2 = 0.0
 
-        self.serial = serial.Serial('COM5', 115200, timeout=1000, parity=serial.PARITY_NONE)
+        metadata = {}
+        if connection is None:
+            connection = serial.Serial(port, 115200, timeout=1000, parity=serial.PARITY_NONE)
+            metadata['port'] = port
+        self.trace: typing.Optional[TracingConnection] = None
+        if trace is not None:
+            metadata['timeout'] = connection.timeout
+            self.trace = connection = TracingConnection(connection, TraceWriter(trace, metadata))
+        self.serial = MeteredConnection(connection, self.metrics)
         startup_response = self.serial.readline().decode("ascii")
-        print(startup_response)
+        logger.info("Plotter: %s", startup_response.strip())
 
         response = self.send_serial_command("getcurrangles")
         self.__parse_anlges_response(response)
-        pass
+
+        self.stream_queue_size, binary_frame_version, speed_frame_version, delta_burst_version = \
+            self.__query_stream_info()
+        self.binary_frames = binary_frames and binary_frame_version == BINARY_FRAME_VERSION
+        self.delta_bursts = delta_bursts and delta_burst_version == DELTA_BURST_VERSION
+        self.supports_speed_frames = self.stream_queue_size > 0 and speed_frame_version == SPEED_FRAME_VERSION
 
     @property
     def workspace_width(self):
-        return self.width
+        return self.kinematics.width
 
     @property
     def workspace_height(self):
-        return self.height
+        return self.kinematics.height
 
     @property
     def current_alphas(self) -> typing.Tuple[float, float]:
@@ -51,14 +112,25 @@ class PrinterCommander:
         self.send_serial_command("pendown")
 
     def move_to_alphas(self, alpha1_deg: float, alpha2_deg: float):
-        print(f'requested\t l{alpha1_deg}r{alpha2_deg}')
-
+        logger.debug("requested l%s r%s", alpha1_deg, alpha2_deg)
         response = self.send_serial_command(f'moveto l{alpha1_deg} r{alpha2_deg}')
         self.__parse_anlges_response(response)
 
     def move_to_xy(self, x: float, y: float):
-        alphas = self.__getAlphas(x, y)
-        self.move_to_alphas(*alphas)
+        alphas = self.get_alphas_batch([(x, y)])
+        self.move_to_alphas(float(alphas.alpha1[0]), float(alphas.alpha2[0]))
+
+    def get_alphas_batch(self, xys: typing.Union[PointBuffer, np.ndarray, typing.Iterable[typing.Sequence[float]]],
+                         raise_if_unreachable: bool = True) -> IKSolution:
+        """xys in printer coordinates (N x 2, or the x, y columns of a PointBuffer), return: arrays of arm angles in
+        degrees
+
+        If `raise_if_unreachable` is False, the indices of unreachable points are returned in the solution instead.
+        """
+        solution = self.kinematics.inverse(xys.xy if isinstance(xys, PointBuffer) else xys)
+        if raise_if_unreachable and len(solution.unreachable) > 0:
+            raise UnreachablePointsError(solution.unreachable)
+        return solution
 
     def reset_head(self):
         self.move_to_alphas(0, 0)
@@ -78,81 +150,96 @@ class PrinterCommander:
     def zero_position(self):
         self.send_serial_command(f'zeroangles')
 
+    def close(self):
+        """closes the trace file (the connection is left open)"""
+        if self.trace is not None:
+            self.trace.close_trace()
+
     def save_angles(self):
         self.send_serial_command(f'saveangles')
 
     def send_serial_command(self, command: str, terminator="\n") -> str:
+        start = time.perf_counter()
         self.serial.write((command + terminator).encode('ascii'))
         response = self.serial.readline().decode("ascii")
-        print("Plotter response: ", response)
+        self.metrics.record_latency(command.partition(" ")[0], time.perf_counter() - start)
+        self.metrics.count('commands')
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s -> %s", command, response.strip())
         return response
 
-    def burst(self, xys: typing.Collection[typing.Tuple[float, float]]):
-        assert len(xys) <= self.__class__.BURST_SIZE
+    def __query_stream_info(self) -> typing.Tuple[int, int, int, int]:
+        """(motion queue size, binary frame version, speed frame version, delta burst version) of the firmware, 0 for
+        unsupported features"""
+        response = self.send_serial_command("streaminfo")
+        if not response.startswith("stream "):
+            return 0, 0, 0, 0
+        words = {word[0]: int(word[1:]) for word in response.split()[1:]}
+        return words.get("q", 0), words.get("b", 0), words.get("s", 0), words.get("d", 0)
 
-        alphass = [self.__getAlphas(x, y) for x, y in xys]  # has to be evaluated eagerly, so as the get exception here
-
-        def serializedNumber(number: float) -> bytes:
-            fraction = int(number % 1 * 255 + .5)
-            return bytes([int(number), fraction])
-
-        def serializedPointList(point_list: typing.Collection[typing.Tuple[float, float]]):
-            res = bytearray()
-            checksum = 0
-            for a, b in point_list:
-                res += serializedNumber(a)
-                res += serializedNumber(b)
-                checksum = (checksum + int.from_bytes(serializedNumber(a), byteorder='big') * 0x10000 +
-                            int.from_bytes(serializedNumber(b), byteorder='big')) % 0x100000000
-            return res + checksum.to_bytes(4, byteorder="big", signed=False)
-
-        self.send_serial_command(f"burst s{len(xys)}")
+    @property
+    def supports_streaming(self) -> bool:
+        return self.stream_queue_size > 0
+
+    @contextlib.contextmanager
+    def motion_stream(self) -> typing.Iterator[MotionStreamer]:
+        """Moves and pen changes sent through the yielded streamer are queued by the firmware without waiting
+        for the previous ones to finish. On exit, waits until the queue is executed."""
+        streamer = MotionStreamer(self.serial, self.stream_queue_size, binary_frames=self.binary_frames,
+                                  metrics=self.metrics)
+        previous_timeout = self.serial.timeout
+        self.serial.timeout = self.STREAM_ACK_TIMEOUT
+        try:
+            yield streamer
+            streamer.flush()
+        finally:
+            self.serial.timeout = previous_timeout
+        # answered once the queue is empty, late credit updates may precede the answer
+        self.serial.write("getcurrangles\n".encode('ascii'))
+        response = streamer.read_line()
+        while not response.startswith("ok "):
+            response = streamer.read_line()
+        self.__parse_anlges_response(response)
 
-        self.serial.write(serializedPointList(alphass))
+    @property
+    def burst_size(self) -> int:
+        """most points of a burst (a burst of delta encoded points may be sent in parts, if the angles jump)"""
+        return self.DELTA_BURST_SIZE if self.delta_bursts else self.BURST_SIZE
+
+    def burst(self, xys: typing.Union[PointBuffer, typing.Collection[typing.Tuple[float, float]]]):
+        assert len(xys) <= self.burst_size
+
+        alphas = self.get_alphas_batch(xys)  # has to be evaluated eagerly, so as the get exception here
+        self.burst_alphas(np.column_stack((alphas.alpha1, alphas.alpha2)))
+
+    def burst_alphas(self, angles: typing.Union[np.ndarray, typing.Collection[typing.Tuple[float, float]]]):
+        """burst of moves to already solved (alpha1, alpha2) pairs"""
+        angles = np.asarray(angles, dtype=float).reshape(-1, 2)
+        assert len(angles) <= self.burst_size
+
+        if self.delta_bursts:
+            while len(angles):
+                payload, count = serialize_delta_burst(angles)
+                self.__send_burst(f"burst s{count} d{DELTA_BURST_VERSION}", payload)
+                angles = angles[count:]
+        else:
+            self.__send_burst(f"burst s{len(angles)}", serialize_burst(angles))
+        logger.debug("actual l%s r%s", self.curr_alpha1, self.curr_alpha2)
+
+    def __send_burst(self, command: str, payload: bytes):
+        self.send_serial_command(command)
+
+        start = time.perf_counter()
+        self.serial.write(payload)
         text = self.serial.readline().decode("ascii")
         while not text.startswith("ok "):
-            print("Plotter response: ", text)
-            self.serial.write(serializedPointList(alphass))
+            logger.info("burst rejected (%s), resending", text.strip())
+            self.metrics.count('checksum_retries')
+            self.serial.write(payload)
             text = self.serial.readline().decode("ascii")
+        self.metrics.record_latency("burst_payload", time.perf_counter() - start)
 
-        print("Plotter response: ", text)
         self.__parse_anlges_response(text)
-        print(f'actual\t\t l{self.curr_alpha1}r{self.curr_alpha2}')
-
-    def __getAlphas(self, x: float, y: float) -> typing.Tuple[float, float]:
-        """x,y in printer coordinates, return: degrees"""
-
-        # printer physical parameters:
-        R1 = self.R1
-        R2 = self.R2
-        l1 = self.l1
-        l2 = self.l2
-        D = self.D
-
-        # x = x * 0.8  # scaling
-        # y = y * 0.8
-
-        x = x + self.x_min + 10
-        y = self.height - y + self.y_min  # vertical mirroring
-
-        print(f"x,y: {x:3.5f} {y:3.5f}", end=' ')
-
-        # formulae valid for angles in [0, 180deg] (practically meaningful: [0, ~130deg])
-        ca1 = (x * (R1 ** 2 - l1 ** 2 + x ** 2 + y ** 2) + y * math.sqrt(
-            (-R1 ** 2 + 2 * R1 * l1 - l1 ** 2 + x ** 2 + y ** 2) * (
-                    R1 ** 2 + 2 * R1 * l1 + l1 ** 2 - x ** 2 - y ** 2))) / (2 * R1 * (x ** 2 + y ** 2))
-        sa1 = math.sqrt(1 - ca1 ** 2)
-
-        ca2 = (y * math.sqrt((-D ** 2 + 2 * D * x + R2 ** 2 + 2 * R2 * l2 + l2 ** 2 - x ** 2 - y ** 2) * (
-                D ** 2 - 2 * D * x - R2 ** 2 + 2 * R2 * l2 - l2 ** 2 + x ** 2 + y ** 2)) + (D - x) * (
-                       D ** 2 - 2 * D * x + R2 ** 2 - l2 ** 2 + x ** 2 + y ** 2)) / (
-                      2 * R2 * (D ** 2 - 2 * D * x + x ** 2 + y ** 2))
-        sa2 = math.sqrt(1 - ca2 ** 2)
-
-        alpha1 = math.atan2(sa1, ca1) / math.pi * 180
-        alpha2 = math.atan2(sa2, ca2) / math.pi * 180  # by our convention positive is up (as opposed to math)
-        print(f"alpha1: {alpha1:.5f} alpha2: {alpha2:.5f}")
-        return alpha1, alpha2
 
     def __parse_anlges_response(self, text):
         self.curr_alpha1, self.curr_alpha2 = map(float, text.split()[1:])
\ No newline at end of file
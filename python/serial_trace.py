@@ -0,0 +1,469 @@
+"""Capture and replay of serial sessions with the plotter.
+
+    PLOTTER_TRACE=session.trace python main.py               # capture (or PrinterCommander(trace=...))
+    python serial_trace.py report session.trace              # latencies, idle gaps, retransmissions
+    python serial_trace.py replay session.trace --simulate   # the recorded writes to a stand-in device
+    python serial_trace.py host session.trace drawing.ngc    # the host stack against the recorded answers
+
+Trace file: <magic> <header length: u32 LE> <header: JSON> then records of <kind: u8> <time: f64 LE, seconds since
+the start of the trace (monotonic clock)> <length: u32 LE> <data>. Writes are recorded as they are made, reads when
+they return (TIMED_OUT: with less data than asked for).
+"""
+import argparse
+import collections
+import json
+import logging
+import math
+import re
+import struct
+import sys
+import time
+import typing
+from collections import namedtuple
+
+from metrics import LatencyHistogram
+from motion_stream import BINARY_RESPONSE_SIZE, FRAME_SYNC, decode_binary_response
+
+logger = logging.getLogger(__name__)
+
+TRACE_MAGIC = b"PLOTTRC1"
+_HEADER_LENGTH = struct.Struct("<I")
+_RECORD = struct.Struct("<BdI")
+
+SENT = 1
+RECEIVED = 2
+TIMED_OUT = 3  # a read returning less than asked for (the data it did return)
+NOTE = 4  # text added by the host, e.g. the start of a job
+
+TraceRecord = namedtuple('TraceRecord', ['kind', 'time', 'data'])
+
+IDLE_GAP = 0.05  # seconds without traffic reported as an idle gap
+_FRAME_PATTERN = re.compile(rb"q(\d+) ")
+_ACK_PATTERN = re.compile(r"([an])(\d+) f(\d+)")
+
+
+class TraceWriter:
+    """Appends records to a trace file (kept in `records` instead if `filename` is None). Received data is flushed
+    to the file at once, so that a trace survives a crash up to the last answer of the plotter."""
+
+    def __init__(self, filename: typing.Optional[str] = None, metadata: typing.Optional[dict] = None,
+                 clock: typing.Callable[[], float] = time.monotonic):
+        self.filename = filename
+        self.clock = clock
+        self.start = clock()
+        self.records: typing.List[TraceRecord] = []
+        self.file = None
+        if filename is not None:
+            header = json.dumps(dict(metadata or {}, started=time.time()), sort_keys=True).encode("utf-8")
+            self.file = open(filename, "wb")
+            self.file.write(TRACE_MAGIC + _HEADER_LENGTH.pack(len(header)) + header)
+
+    def record(self, kind: int, data: bytes = b""):
+        seconds = self.clock() - self.start
+        if self.file is None:
+            self.records.append(TraceRecord(kind, seconds, bytes(data)))
+            return
+        self.file.write(_RECORD.pack(kind, seconds, len(data)) + data)
+        if kind != SENT:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self) -> 'TraceWriter':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_trace(filename: str) -> typing.Tuple[dict, typing.List[TraceRecord]]:
+    """header and records of a trace file (a record cut short by a crash is left out)"""
+    with open(filename, "rb") as f:
+        data = f.read()
+    if data[:len(TRACE_MAGIC)] != TRACE_MAGIC:
+        raise ValueError(f"{filename} is not a serial trace")
+    position = len(TRACE_MAGIC)
+    header_length, = _HEADER_LENGTH.unpack_from(data, position)
+    position += _HEADER_LENGTH.size
+    header = json.loads(data[position:position + header_length].decode("utf-8"))
+    position += header_length
+    records = []
+    while position + _RECORD.size <= len(data):
+        kind, seconds, length = _RECORD.unpack_from(data, position)
+        position += _RECORD.size
+        if position + length > len(data):
+            break
+        records.append(TraceRecord(kind, seconds, data[position:position + length]))
+        position += length
+    return header, records
+
+
+class TracingConnection:
+    """serial.Serial-like wrapper recording every write and read to a TraceWriter (see MeteredConnection)"""
+
+    def __init__(self, connection, writer: TraceWriter):
+        self.connection = connection
+        self.writer = writer
+
+    @property
+    def timeout(self):
+        return self.connection.timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self.connection.timeout = value
+
+    @property
+    def in_waiting(self) -> int:
+        return self.connection.in_waiting
+
+    def write(self, data: bytes):
+        result = self.connection.write(data)
+        self.writer.record(SENT, data)
+        return result
+
+    def read(self, size: int = 1) -> bytes:
+        data = self.connection.read(size)
+        self.writer.record(RECEIVED if len(data) == size else TIMED_OUT, data)
+        return data
+
+    def readline(self) -> bytes:
+        data = self.connection.readline()
+        self.writer.record(RECEIVED if data.endswith(b"\n") else TIMED_OUT, data)
+        return data
+
+    def note(self, text: str):
+        self.writer.record(NOTE, text.encode("utf-8"))
+
+    def close_trace(self):
+        self.writer.close()
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+# --- analysis
+
+TraceReport = namedtuple('TraceReport', [
+    'duration', 'bytes_sent', 'bytes_received',
+    'round_trips',  # name -> LatencyHistogram: commands by their first word, burst payloads, stream frames
+    'host_gaps',  # LatencyHistogram of the time from an answer to the next write (the host preparing it)
+    'idle_gaps',  # (time, seconds, the record after the gap) of the gaps longer than IDLE_GAP, longest first
+    'retransmissions', 'retransmitted_bytes',  # stream frames and burst payloads sent again
+    'polls',  # stream frames already acknowledged, sent again to poll the free queue slots
+    'nacks', 'timeouts', 'timeout_wait',  # reads timed out, and the time spent in them
+])
+
+
+def _sent_kind(data: bytes) -> typing.Tuple[str, typing.Optional[int]]:
+    """('frame', seq), ('command', None) or ('payload', None) of written data"""
+    if data[:1] == bytes([FRAME_SYNC]) and len(data) > 1:
+        return 'frame', data[1]
+    match = _FRAME_PATTERN.match(data)
+    if match is not None:
+        return 'frame', int(match.group(1)) % 256
+    if data.endswith(b"\n") and data.isascii():
+        return 'command', None
+    return 'payload', None
+
+
+def _messages(records: typing.Sequence[TraceRecord]) -> typing.Iterator[typing.Tuple[int, float, object]]:
+    """the records with the received data split into messages: (SENT, time, data), (RECEIVED, time, line or
+    (kind, seq, free) of an acknowledgement), (TIMED_OUT, time, waited seconds), NOTE records are left out"""
+    buffer = bytearray()
+    previous_time = 0.0
+    for kind, seconds, data in records:
+        if kind == SENT:
+            yield SENT, seconds, data
+        elif kind in (RECEIVED, TIMED_OUT):
+            buffer += data
+            while buffer:
+                if buffer[0] == FRAME_SYNC:
+                    if len(buffer) < BINARY_RESPONSE_SIZE:
+                        break
+                    ack = decode_binary_response(bytes(buffer[:BINARY_RESPONSE_SIZE]))
+                    del buffer[:BINARY_RESPONSE_SIZE]
+                    if ack is not None:
+                        yield RECEIVED, seconds, ack
+                    continue
+                end = buffer.find(b"\n")
+                if end < 0:
+                    break
+                line = buffer[:end + 1].decode("ascii", errors="replace")
+                del buffer[:end + 1]
+                match = _ACK_PATTERN.match(line)
+                yield RECEIVED, seconds, (match.group(1), int(match.group(2)), int(match.group(3))) \
+                    if match is not None else line
+            if kind == TIMED_OUT:
+                yield TIMED_OUT, seconds, seconds - previous_time
+        previous_time = seconds
+
+
+def analyze_trace(records: typing.Sequence[TraceRecord], idle_gap: float = IDLE_GAP) -> TraceReport:
+    """Round trips: a command (or burst payload) to the next text line received, a stream frame to the first
+    acknowledgement covering its sequence number (frames sent again are not measured, like in MotionStreamer)."""
+    round_trips: typing.Dict[str, LatencyHistogram] = collections.defaultdict(LatencyHistogram)
+    host_gaps = LatencyHistogram()
+    idle_gaps = []
+    outstanding: typing.OrderedDict[int, typing.Tuple[float, bool]] = collections.OrderedDict()  # seq -> sent, again
+    acknowledged: typing.Deque[int] = collections.deque(maxlen=8)  # the last sequence numbers acknowledged
+    waiting: typing.Optional[typing.Tuple[str, float]] = None  # command waiting for its answer
+    last_payload = None
+    retransmissions = retransmitted_bytes = polls = nacks = timeouts = 0
+    timeout_wait = 0.0
+    last_time = 0.0
+    last_received: typing.Optional[float] = None
+
+    def acknowledge_up_to(seq: int, seconds: float):
+        if seq not in outstanding:
+            return
+        while outstanding:
+            first, (sent, again) = outstanding.popitem(last=False)
+            acknowledged.append(first)
+            if not again:
+                round_trips['stream_frame'].record(seconds - sent)
+            if first == seq:
+                return
+
+    for kind, seconds, message in _messages(records):
+        if seconds - last_time > idle_gap:
+            idle_gaps.append((last_time, seconds - last_time, kind))
+        last_time = seconds
+        if kind == SENT:
+            if last_received is not None:
+                host_gaps.record(seconds - last_received)
+                last_received = None
+            sent_kind, seq = _sent_kind(message)
+            if sent_kind == 'frame':
+                if seq in outstanding:
+                    retransmissions += 1
+                    retransmitted_bytes += len(message)
+                    outstanding[seq] = (outstanding[seq][0], True)
+                elif seq in acknowledged:
+                    polls += 1
+                else:
+                    outstanding[seq] = (seconds, False)
+            elif sent_kind == 'payload':
+                if message == last_payload:
+                    retransmissions += 1
+                    retransmitted_bytes += len(message)
+                last_payload = message
+                waiting = ('burst_payload', seconds)
+            else:
+                name = message.split()[0].decode("ascii") if message.strip() else "empty"
+                last_payload = None if name == "burst" else last_payload
+                waiting = (name, seconds)
+        elif kind == RECEIVED:
+            last_received = seconds
+            if isinstance(message, tuple):
+                ack_kind, seq, _ = message
+                if ack_kind == "n":
+                    nacks += 1
+                    seq = (seq - 1) % 256
+                acknowledge_up_to(seq, seconds)
+            elif waiting is not None:
+                round_trips[waiting[0]].record(seconds - waiting[1])
+                waiting = None
+        else:
+            timeouts += 1
+            timeout_wait += message
+    idle_gaps.sort(key=lambda gap: -gap[1])
+    return TraceReport(records[-1].time if records else 0.0,
+                       sum(len(r.data) for r in records if r.kind == SENT),
+                       sum(len(r.data) for r in records if r.kind in (RECEIVED, TIMED_OUT)),
+                       dict(round_trips), host_gaps, idle_gaps, retransmissions, retransmitted_bytes, polls, nacks,
+                       timeouts, timeout_wait)
+
+
+_KIND_NAMES = {SENT: "write", RECEIVED: "answer", TIMED_OUT: "timeout"}
+
+
+def format_report(report: TraceReport, gaps: int = 5) -> str:
+    def ms(seconds: float) -> str:
+        return f"{seconds * 1000:.2f}"
+
+    lines = [f"{report.duration:.3f} s, {report.bytes_sent} bytes sent, {report.bytes_received} bytes received",
+             f"{'round trip [ms]':<20}{'count':>8}{'mean':>10}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}"]
+    for name, histogram in sorted(report.round_trips.items(), key=lambda item: -item[1].total) + \
+            [("(host gaps)", report.host_gaps)]:
+        if histogram.count:
+            lines.append(f"{name:<20}{histogram.count:>8}{ms(histogram.mean):>10}{ms(histogram.percentile(50)):>10}"
+                         f"{ms(histogram.percentile(90)):>10}{ms(histogram.percentile(99)):>10}"
+                         f"{ms(histogram.max):>10}")
+    share = report.retransmitted_bytes / report.bytes_sent if report.bytes_sent else 0.0
+    lines.append(f"retransmissions: {report.retransmissions} ({report.retransmitted_bytes} bytes, {share:.1%} of the "
+                 f"bytes sent), nacks: {report.nacks}, polls: {report.polls}, timeouts: {report.timeouts} "
+                 f"({report.timeout_wait:.3f} s waited)")
+    idle = sum(seconds for _, seconds, _ in report.idle_gaps)
+    lines.append(f"idle gaps over {ms(IDLE_GAP)} ms: {len(report.idle_gaps)}, {idle:.3f} s in total")
+    for at, seconds, kind in report.idle_gaps[:gaps]:
+        lines.append(f"  at {at:10.3f} s: {ms(seconds)} ms before the next {_KIND_NAMES[kind]}")
+    return "\n".join(lines)
+
+
+# --- replay
+
+class ReplayConnection:
+    """serial.Serial-like stand-in answering with the data received in a trace, for running the host stack offline.
+
+    The answers recorded after the n-th write become readable after the n-th write here. A read that timed out in
+    the trace times out here too. Written data differing from the recorded one is counted in `divergences` (logged
+    once), or raises ValueError if `strict`. With a finite `speed`, answers are not given before their recorded
+    time (divided by `speed`) since the start of the replay.
+    """
+
+    def __init__(self, records: typing.Sequence[TraceRecord], speed: float = math.inf, strict: bool = False,
+                 clock: typing.Callable[[], float] = time.monotonic, sleep: typing.Callable[[float], None] = time.sleep):
+        self.records = [record for record in records if record.kind != NOTE]
+        self.speed = speed
+        self.strict = strict
+        self.clock = clock
+        self.sleep = sleep
+        self.timeout = None
+        self.divergences = 0
+        self.writes = 0
+        self.start = clock()
+        self._position = 0
+        self._pending: typing.Deque[TraceRecord] = collections.deque()  # answers readable now, in order
+        self._buffer = bytearray()
+        self._release_answers()
+
+    def _release_answers(self):
+        while self._position < len(self.records) and self.records[self._position].kind != SENT:
+            self._pending.append(self.records[self._position])
+            self._position += 1
+
+    def _take_record(self) -> typing.Optional[TraceRecord]:
+        """moves the next answer into the buffer, None at a recorded timeout (the timed-out data is buffered)"""
+        record = self._pending.popleft()
+        if self.speed != math.inf:
+            delay = record.time / self.speed - (self.clock() - self.start)
+            if delay > 0:
+                self.sleep(delay)
+        self._buffer += record.data
+        return None if record.kind == TIMED_OUT else record
+
+    @property
+    def in_waiting(self) -> int:
+        return len(self._buffer) + sum(len(record.data) for record in self._pending)
+
+    def write(self, data: bytes) -> int:
+        self.writes += 1
+        if self._position < len(self.records):
+            recorded = self.records[self._position].data
+            self._position += 1
+        else:
+            recorded = None
+        if recorded != data:
+            if self.strict:
+                raise ValueError(f"write {self.writes} differs from the trace: {data[:40]!r} != {recorded!r:.40}")
+            if self.divergences == 0:
+                logger.warning("the host diverged from the trace at write %d: %r != %r", self.writes, data[:40],
+                               (recorded or b"")[:40])
+            self.divergences += 1
+        self._release_answers()
+        return len(data)
+
+    def read(self, size: int = 1) -> bytes:
+        while len(self._buffer) < size and self._pending and self._take_record() is not None:
+            pass
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def readline(self) -> bytes:
+        while b"\n" not in self._buffer and self._pending and self._take_record() is not None:
+            pass
+        end = self._buffer.find(b"\n") + 1
+        data = bytes(self._buffer[:end if end > 0 else len(self._buffer)])
+        del self._buffer[:len(data)]
+        return data
+
+
+def replay_to_device(records: typing.Sequence[TraceRecord], connection, writer: TraceWriter,
+                     speed: float = math.inf, sleep: typing.Callable[[float], None] = time.sleep) -> TraceWriter:
+    """Sends the recorded writes to a device (a real port, a SimulatedSerial, ...) and reads as many bytes after each
+    as the trace received, traced into `writer` (compare the analyses of the two traces). With a finite `speed`,
+    writes are not made before their recorded time (divided by `speed`)."""
+    traced = TracingConnection(connection, writer)
+    start = writer.clock()
+    exchanges = []  # (write, bytes received after it)
+    received_first = 0
+    for record in records:
+        if record.kind == SENT:
+            exchanges.append([record, 0])
+        elif record.kind in (RECEIVED, TIMED_OUT):
+            if exchanges:
+                exchanges[-1][1] += len(record.data)
+            else:
+                received_first += len(record.data)
+    if received_first:
+        traced.read(received_first)
+    for record, answer_size in exchanges:
+        if speed != math.inf:
+            delay = record.time / speed - (writer.clock() - start)
+            if delay > 0:
+                sleep(delay)
+        traced.write(record.data)
+        if answer_size:
+            traced.read(answer_size)
+    return writer
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    report = commands.add_parser("report", help="round trips, idle gaps and retransmissions of a trace")
+    report.add_argument("trace")
+    report.add_argument("--idle-gap", type=float, default=IDLE_GAP, help="seconds, the shortest idle gap reported")
+    replay = commands.add_parser("replay", help="send the recorded writes to a device, trace its answers")
+    replay.add_argument("trace")
+    device = replay.add_mutually_exclusive_group(required=True)
+    device.add_argument("--port", help="serial port of the plotter")
+    device.add_argument("--simulate", action="store_true", help="a simulated plotter (simulated time)")
+    replay.add_argument("--speed", type=float, default=1.0, help="of the recorded timing, inf: no waiting")
+    replay.add_argument("--output", help="trace file of the replay")
+    host = commands.add_parser("host", help="plot a file against the recorded answers")
+    host.add_argument("trace")
+    host.add_argument("gcode")
+    host.add_argument("--resolution", type=float, default=.1, help="interpolation resolution in mm")
+    host.add_argument("--speed", type=float, default=math.inf, help="of the recorded timing, inf: no waiting")
+    args = parser.parse_args(argv)
+
+    header, records = read_trace(args.trace)
+    if args.command == "report":
+        print(format_report(analyze_trace(records, args.idle_gap)))
+    elif args.command == "replay":
+        if args.simulate:
+            from plotter_simulator import SimulatedSerial
+            connection = SimulatedSerial(timeout=header.get('timeout'))
+            writer = TraceWriter(args.output, {'replay_of': args.trace}, clock=lambda: connection.now)
+            speed = math.inf  # simulated time only passes while waiting for answers
+        else:
+            import serial
+            connection = serial.Serial(args.port, 115200, timeout=1, parity=serial.PARITY_NONE)
+            writer = TraceWriter(args.output, {'replay_of': args.trace, 'port': args.port})
+            speed = args.speed
+        with writer:
+            replay_to_device(records, connection, writer, speed)
+        if args.output is None:
+            print(format_report(analyze_trace(writer.records)))
+        else:
+            print(format_report(analyze_trace(read_trace(args.output)[1])))
+    else:
+        from drawing_process import DrawingProcess, PrinterCommander
+        connection = ReplayConnection(records, args.speed)
+        printer = PrinterCommander(connection=connection)
+        start = time.perf_counter()
+        DrawingProcess(printer, args.gcode, interpolation_resolution=args.resolution).run()
+        print(f"{time.perf_counter() - start:.3f} s, {connection.writes} writes, {connection.divergences} differing "
+              f"from the trace")
+        print(printer.metrics.summary())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
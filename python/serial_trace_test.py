@@ -0,0 +1,210 @@
+import io
+import os
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+
+from drawing_process import *
+from plotter_simulator import *
+from serial_trace import *
+
+
+def traced_connection(device: typing.Optional[SimulatedPlotter] = None, corrupt=None, filename=None) \
+        -> TracingConnection:
+    """a SimulatedSerial traced in simulated time"""
+    connection = SimulatedSerial(device, corrupt)
+    return TracingConnection(connection, TraceWriter(filename, clock=lambda: connection.now))
+
+
+def stream_moves(printer: PrinterCommander, count: int = 200):
+    with printer.motion_stream() as stream:
+        stream.pen_down()
+        for k in range(count):
+            stream.move_to_alphas(10 + k * 0.25, 50 - k * 0.125)
+        stream.pen_up()
+
+
+class TraceFileTest(unittest.TestCase):
+    def test_written_and_read_back(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "session.trace")
+            with TraceWriter(filename, {'port': 'COM5'}) as writer:
+                writer.record(SENT, b"getcurrangles\n")
+                writer.record(RECEIVED, b"ok 1.0 2.0\n")
+                writer.record(TIMED_OUT, b"")
+                writer.record(NOTE, b"job started")
+            with open(filename, "ab") as f:
+                f.write(b"\x01\x00")  # cut short by a crash
+            header, records = read_trace(filename)
+        self.assertEqual('COM5', header['port'])
+        self.assertEqual([SENT, RECEIVED, TIMED_OUT, NOTE], [record.kind for record in records])
+        self.assertEqual(b"ok 1.0 2.0\n", records[1].data)
+        self.assertTrue(all(a.time <= b.time for a, b in zip(records, records[1:])))
+
+    def test_not_a_trace(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "drawing.ngc")
+            with open(filename, "w") as f:
+                f.write("G00 X0 Y0\n")
+            with self.assertRaises(ValueError):
+                read_trace(filename)
+
+
+class AnalyzeTraceTest(unittest.TestCase):
+    def test_command_round_trips(self):
+        records = [TraceRecord(SENT, 0.0, b"getcurrangles\n"), TraceRecord(RECEIVED, 0.01, b"ok 1 2\n"),
+                   TraceRecord(SENT, 0.5, b"penup\n"), TraceRecord(TIMED_OUT, 1.5, b""),
+                   TraceRecord(RECEIVED, 1.52, b"ok\n")]
+        report = analyze_trace(records)
+        self.assertAlmostEqual(0.01, report.round_trips['getcurrangles'].max)
+        self.assertAlmostEqual(1.02, report.round_trips['penup'].max)
+        self.assertEqual(1, report.timeouts)
+        self.assertAlmostEqual(1.0, report.timeout_wait)
+        self.assertAlmostEqual(0.49, report.host_gaps.max)
+        self.assertEqual([0.49, 1.0], sorted(round(seconds, 6) for _, seconds, _ in report.idle_gaps))
+        self.assertEqual(len(b"getcurrangles\npenup\n"), report.bytes_sent)
+
+    def test_stream_frames_acknowledged_cumulatively(self):
+        records = [TraceRecord(SENT, 0.0, encode_stream_frame(1, "d")),
+                   TraceRecord(SENT, 0.001, encode_stream_frame(2, "u")),
+                   TraceRecord(RECEIVED, 0.01, encode_binary_response("a", 2, 30)),
+                   TraceRecord(SENT, 0.02, encode_stream_frame(3, "d")),
+                   TraceRecord(RECEIVED, 0.03, b"n3 f30\n"),
+                   TraceRecord(SENT, 0.04, encode_stream_frame(3, "d")),
+                   TraceRecord(RECEIVED, 0.05, b"a3 f31\n"),
+                   TraceRecord(SENT, 0.06, encode_stream_frame(3, "d")),
+                   TraceRecord(RECEIVED, 0.07, b"a3 f32\n")]
+        report = analyze_trace(records)
+        self.assertEqual(2, report.round_trips['stream_frame'].count)  # the resent frame is not measured
+        self.assertEqual(1, report.retransmissions)
+        self.assertEqual(len(encode_stream_frame(3, "d")), report.retransmitted_bytes)
+        self.assertEqual(1, report.nacks)
+        self.assertEqual(1, report.polls)
+
+
+class CaptureTest(unittest.TestCase):
+    def test_commands_and_stream_captured(self):
+        device = SimulatedPlotter()
+        connection = traced_connection(device)
+        printer = PrinterCommander(connection=connection)
+        printer.pen_up()
+        stream_moves(printer)
+        records = connection.writer.records
+        report = analyze_trace(records)
+        self.assertEqual(printer.metrics.counters['bytes_sent'], report.bytes_sent)
+        self.assertEqual(printer.metrics.counters['bytes_received'], report.bytes_received)
+        self.assertEqual(1, report.round_trips['penup'].count)
+        self.assertEqual(202, report.round_trips['stream_frame'].count)
+        self.assertEqual(0, report.retransmissions)
+        self.assertGreater(report.duration, 0)
+        self.assertIn("stream_frame", format_report(report))
+
+    def test_retransmission_cost_reported(self):
+        corrupted = []
+
+        def corrupt(data: bytes) -> bytes:
+            if data[:1] == bytes([FRAME_SYNC]) and data[1] in (7, 40) and data[1] not in corrupted:
+                corrupted.append(data[1])
+                return data[:4] + bytes([data[4] ^ 0x01]) + data[5:]
+            return data
+
+        connection = traced_connection(corrupt=corrupt)
+        printer = PrinterCommander(connection=connection)
+        stream_moves(printer)
+        report = analyze_trace(connection.writer.records)
+        self.assertEqual([7, 40], corrupted)
+        self.assertEqual(2, report.retransmissions)
+        self.assertEqual(2, report.nacks)
+        self.assertIn("retransmissions: 2", format_report(report))
+
+    def test_trace_of_printer_commander(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "session.trace")
+            printer = PrinterCommander(connection=SimulatedSerial(), trace=filename)
+            printer.pen_down()
+            printer.close()
+            header, records = read_trace(filename)
+        self.assertIsNone(header['timeout'])
+        self.assertEqual(b"pendown\n", records[-2].data)
+        self.assertEqual(RECEIVED, records[-1].kind)
+
+
+class ReplayTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.filename = os.path.join(tmp.name, "square.ngc")
+        with open(self.filename, "w") as f:
+            f.write("G00 X10 Y10 Z1\nG01 Z-1\nG01 X40 Y10\nG01 X40 Y40\nG01 X10 Y40\nG01 X10 Y10\nG00 Z1\n")
+
+    def draw(self, connection) -> PrinterCommander:
+        printer = PrinterCommander(connection=connection)
+        DrawingProcess(printer, self.filename, interpolation_resolution=1).run()
+        return printer
+
+    def test_host_stack_run_against_the_trace(self):
+        device = SimulatedPlotter()
+        connection = traced_connection(device)
+        recorded = self.draw(connection)
+        replay = ReplayConnection(connection.writer.records, strict=True)
+        printer = self.draw(replay)
+        self.assertEqual(0, replay.divergences)
+        self.assertEqual(len([r for r in connection.writer.records if r.kind == SENT]), replay.writes)
+        self.assertEqual(recorded.current_alphas, printer.current_alphas)
+
+    def test_divergence_detected(self):
+        connection = traced_connection()
+        PrinterCommander(connection=connection).pen_up()
+        replay = ReplayConnection(connection.writer.records)
+        printer = PrinterCommander(connection=replay)
+        with self.assertLogs('serial_trace', 'WARNING'):
+            printer.pen_down()
+        self.assertEqual(1, replay.divergences)
+        with self.assertRaises(ValueError):
+            PrinterCommander(connection=ReplayConnection(connection.writer.records, strict=True)).pen_down()
+
+    def test_recorded_speed(self):
+        records = [TraceRecord(SENT, 0.0, b"penup\n"), TraceRecord(RECEIVED, 2.0, b"ok\n")]
+        now, sleeps = [0.0], []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            now[0] += seconds
+
+        replay = ReplayConnection(records, speed=4, clock=lambda: now[0], sleep=sleep)
+        replay.write(b"penup\n")
+        self.assertEqual(b"ok\n", replay.readline())
+        self.assertEqual([0.5], sleeps)
+
+    def test_writes_replayed_to_a_device(self):
+        connection = traced_connection()
+        self.draw(connection)
+        device = SimulatedPlotter()
+        serial_connection = SimulatedSerial(device)
+        writer = replay_to_device(connection.writer.records, serial_connection,
+                                  TraceWriter(clock=lambda: serial_connection.now))
+        self.assertEqual([r.data for r in connection.writer.records if r.kind == SENT],
+                         [r.data for r in writer.records if r.kind == SENT])
+        self.assertEqual(b"".join(r.data for r in connection.writer.records if r.kind != SENT),
+                         b"".join(r.data for r in writer.records if r.kind != SENT))
+        self.assertGreater(device.moves, 50)
+        original, replayed = analyze_trace(connection.writer.records), analyze_trace(writer.records)
+        self.assertEqual(original.round_trips.keys(), replayed.round_trips.keys())
+
+    def test_command_line(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            trace = os.path.join(tmp, "session.trace")
+            connection = traced_connection(filename=trace)
+            self.draw(connection)
+            connection.writer.close()
+            output = io.StringIO()
+            with redirect_stdout(output):
+                main(["report", trace])
+                main(["replay", trace, "--simulate", "--output", os.path.join(tmp, "replay.trace")])
+                main(["host", trace, self.filename, "--resolution", "1"])
+        self.assertIn("0 differing from the trace", output.getvalue())
+        self.assertEqual(2, output.getvalue().count("stream_frame"))
+
+
+if __name__ == '__main__':
+    unittest.main()
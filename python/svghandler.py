@@ -0,0 +1,365 @@
+import logging
+import math
+import re
+import typing
+import xml.etree.ElementTree as ElementTree
+
+import numpy as np
+
+from gcodehandler import *
+from gcodehandler import _local_indices
+
+logger = logging.getLogger(__name__)
+
+SVG_TOLERANCE = 0.01  # mm, the flattened curves stay this close to the curves of the drawing
+PEN_UP_Z = 1.0
+PEN_DOWN_Z = -1.0
+
+# mm per unit, a user unit is a px (1/96 in)
+_UNITS = {'': 25.4 / 96, 'px': 25.4 / 96, 'mm': 1.0, 'cm': 10.0, 'in': 25.4, 'pt': 25.4 / 72, 'pc': 25.4 / 6,
+          'q': 0.25}
+_NUMBER = r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?"
+_PATH_TOKEN = re.compile(rf"[MmLlHhVvCcSsQqTtAaZz]|{_NUMBER}")
+_NUMBER_PATTERN = re.compile(_NUMBER)
+_LENGTH_PATTERN = re.compile(rf"\s*({_NUMBER})\s*([a-zA-Z%]*)\s*$")
+_TRANSFORM_PATTERN = re.compile(r"(matrix|translate|scale|rotate|skewX|skewY)\s*\(([^)]*)\)")
+_NOT_RENDERED = {'defs', 'clipPath', 'mask', 'symbol', 'marker', 'pattern', 'metadata', 'title', 'desc', 'style',
+                 'script'}
+
+Cubic = typing.Tuple[float, float, float, float, float, float, float, float]  # x0, y0, x1, y1, x2, y2, x3, y3
+
+
+def is_svg_file(filename: str) -> bool:
+    return filename.lower().endswith(".svg")
+
+
+def read_program(filename: str, processes: int = 1) -> MotionProgram:
+    """the motion program of a G-code or an SVG file (by its extension)"""
+    if is_svg_file(filename):
+        return MotionProgram(svg_segments(filename))
+    return MotionProgram.from_file(filename, processes)
+
+
+def parse_transform(text: typing.Optional[str]) -> np.ndarray:
+    """3 x 3 matrix of an SVG transform attribute (the identity if there is none)"""
+    matrix = np.eye(3)
+    for name, arguments in _TRANSFORM_PATTERN.findall(text or ""):
+        values = [float(value) for value in _NUMBER_PATTERN.findall(arguments)]
+        if name == 'matrix':
+            a, b, c, d, e, f = values
+            step = [[a, c, e], [b, d, f], [0, 0, 1]]
+        elif name == 'translate':
+            tx, ty = (values + [0.0])[:2]
+            step = [[1, 0, tx], [0, 1, ty], [0, 0, 1]]
+        elif name == 'scale':
+            sx, sy = (values + values)[:2]
+            step = [[sx, 0, 0], [0, sy, 0], [0, 0, 1]]
+        elif name == 'rotate':
+            angle, cx, cy = (values + [0.0, 0.0])[:3]
+            cos, sin = math.cos(math.radians(angle)), math.sin(math.radians(angle))
+            step = [[cos, -sin, cx - cos * cx + sin * cy], [sin, cos, cy - sin * cx - cos * cy], [0, 0, 1]]
+        elif name == 'skewX':
+            step = [[1, math.tan(math.radians(values[0])), 0], [0, 1, 0], [0, 0, 1]]
+        else:
+            step = [[1, 0, 0], [math.tan(math.radians(values[0])), 1, 0], [0, 0, 1]]
+        matrix = matrix @ np.array(step, dtype=float)
+    return matrix
+
+
+def parse_length(text: typing.Optional[str]) -> typing.Optional[float]:
+    """an SVG length in mm, None if not given or relative (%, em)"""
+    match = _LENGTH_PATTERN.match(text or "")
+    if match is None or match.group(2).lower() not in _UNITS:
+        return None
+    return float(match.group(1)) * _UNITS[match.group(2).lower()]
+
+
+def _line(x0: float, y0: float, x1: float, y1: float) -> Cubic:
+    return x0, y0, x0 + (x1 - x0) / 3, y0 + (y1 - y0) / 3, x0 + 2 * (x1 - x0) / 3, y0 + 2 * (y1 - y0) / 3, x1, y1
+
+
+def _quadratic(x0: float, y0: float, qx: float, qy: float, x1: float, y1: float) -> Cubic:
+    return x0, y0, x0 + 2 * (qx - x0) / 3, y0 + 2 * (qy - y0) / 3, x1 + 2 * (qx - x1) / 3, y1 + 2 * (qy - y1) / 3, \
+        x1, y1
+
+
+def _arc_error(sweep: float) -> float:
+    """deviation of the cubic approximating an arc of the unit circle"""
+    return 4 / 27 * math.sin(sweep / 4) ** 6 / math.cos(sweep / 4) ** 2
+
+
+def _arc(x0: float, y0: float, rx: float, ry: float, rotation: float, large_arc: bool, sweep: bool, x1: float,
+         y1: float, tolerance: float) -> typing.List[Cubic]:
+    """cubics of an SVG elliptical arc within `tolerance` (endpoint to center parameterization: SVG 1.1 F.6.5)"""
+    if (x0, y0) == (x1, y1):
+        return []
+    rx, ry = abs(rx), abs(ry)
+    if rx == 0 or ry == 0:
+        return [_line(x0, y0, x1, y1)]
+    cos, sin = math.cos(math.radians(rotation)), math.sin(math.radians(rotation))
+    hx, hy = (x0 - x1) / 2, (y0 - y1) / 2
+    x0p, y0p = cos * hx + sin * hy, -sin * hx + cos * hy
+    scale = x0p ** 2 / rx ** 2 + y0p ** 2 / ry ** 2
+    if scale > 1:  # the radii are scaled up until the ellipse reaches the end point
+        rx, ry = rx * math.sqrt(scale), ry * math.sqrt(scale)
+    numerator = rx ** 2 * ry ** 2 - rx ** 2 * y0p ** 2 - ry ** 2 * x0p ** 2
+    coefficient = math.sqrt(max(0.0, numerator / (rx ** 2 * y0p ** 2 + ry ** 2 * x0p ** 2)))
+    if large_arc == sweep:
+        coefficient = -coefficient
+    cxp, cyp = coefficient * rx * y0p / ry, -coefficient * ry * x0p / rx
+    cx, cy = cos * cxp - sin * cyp + (x0 + x1) / 2, sin * cxp + cos * cyp + (y0 + y1) / 2
+    start = math.atan2((y0p - cyp) / ry, (x0p - cxp) / rx)
+    delta = (math.atan2((-y0p - cyp) / ry, (-x0p - cxp) / rx) - start) % (2 * math.pi)
+    if not sweep and delta > 0:
+        delta -= 2 * math.pi
+
+    pieces = max(math.ceil(abs(delta) / (math.pi / 2) - 1e-9), 1)
+    while max(rx, ry) * _arc_error(abs(delta) / pieces) > tolerance:
+        pieces *= 2
+    angles = start + delta * np.arange(pieces + 1) / pieces
+    k = 4 / 3 * math.tan(delta / pieces / 4)
+    u, v = np.cos(angles), np.sin(angles)
+    # on the unit circle, then scaled to the radii, rotated and moved to the center
+    unit = np.column_stack((u[:-1], v[:-1], u[:-1] - k * v[:-1], v[:-1] + k * u[:-1],
+                            u[1:] + k * v[1:], v[1:] - k * u[1:], u[1:], v[1:]))
+    xs, ys = unit[:, 0::2] * rx, unit[:, 1::2] * ry
+    cubics = np.empty_like(unit)
+    cubics[:, 0::2] = cx + cos * xs - sin * ys
+    cubics[:, 1::2] = cy + sin * xs + cos * ys
+    cubics[0, :2] = x0, y0
+    cubics[-1, 6:] = x1, y1
+    return [tuple(cubic) for cubic in cubics.tolist()]
+
+
+def parse_path(d: str, tolerance: float = SVG_TOLERANCE) -> typing.List[np.ndarray]:
+    """The subpaths of SVG path data (M/L/H/V/C/S/Q/T/A/Z, absolute and relative) as cubic Bezier curves: an
+    n x 8 array (see Cubic) per subpath, in the units of the path. Lines and quadratic curves are exact cubics,
+    elliptical arcs are approximated within `tolerance`. Subpaths drawing nothing are left out.
+    """
+    tokens = _PATH_TOKEN.findall(d)
+    position = 0
+
+    def number() -> float:
+        nonlocal position
+        value = float(tokens[position])
+        position += 1
+        return value
+
+    def flag() -> bool:  # may be written together with what follows it: "a10 10 0 0110 20"
+        nonlocal position
+        token = tokens[position]
+        if len(token) > 1 and token[0] in "01":
+            tokens[position] = token[1:]
+        else:
+            position += 1
+        return token[0] == "1"
+
+    subpaths: typing.List[typing.List[Cubic]] = []
+    current: typing.List[Cubic] = []
+    x = y = start_x = start_y = 0.0
+    control_x = control_y = 0.0  # the last control point, reflected by S and T
+    command = previous = None
+    try:
+        while position < len(tokens):
+            if tokens[position].isalpha():
+                command = tokens[position]
+                position += 1
+            elif command is None or command in "Zz":
+                raise ValueError(f"number without a command: {tokens[position]}")
+            upper = command.upper()
+            dx, dy = (x, y) if command.islower() else (0.0, 0.0)
+            if upper == "Z":
+                if (x, y) != (start_x, start_y):
+                    current.append(_line(x, y, start_x, start_y))
+                x, y = start_x, start_y
+                subpaths.append(current)
+                current = []
+            elif upper == "M":
+                subpaths.append(current)
+                current = []
+                x, y = start_x, start_y = dx + number(), dy + number()
+                command = "l" if command == "m" else "L"  # the coordinate pairs after the first one
+            elif upper in "LHV":
+                new_x = dx + number() if upper != "V" else x
+                new_y = dy + number() if upper != "H" else y
+                current.append(_line(x, y, new_x, new_y))
+                x, y = new_x, new_y
+            elif upper in "CS":
+                if upper == "C":
+                    x1, y1 = dx + number(), dy + number()
+                else:
+                    x1, y1 = (2 * x - control_x, 2 * y - control_y) if previous in ("C", "S") else (x, y)
+                control_x, control_y = dx + number(), dy + number()
+                new_x, new_y = dx + number(), dy + number()
+                current.append((x, y, x1, y1, control_x, control_y, new_x, new_y))
+                x, y = new_x, new_y
+            elif upper in "QT":
+                if upper == "Q":
+                    control_x, control_y = dx + number(), dy + number()
+                else:
+                    control_x, control_y = (2 * x - control_x, 2 * y - control_y) if previous in ("Q", "T") \
+                        else (x, y)
+                new_x, new_y = dx + number(), dy + number()
+                current.append(_quadratic(x, y, control_x, control_y, new_x, new_y))
+                x, y = new_x, new_y
+            else:  # A
+                rx, ry, rotation = number(), number(), number()
+                large_arc, sweep = flag(), flag()
+                new_x, new_y = dx + number(), dy + number()
+                current.extend(_arc(x, y, rx, ry, rotation, large_arc, sweep, new_x, new_y, tolerance))
+                x, y = new_x, new_y
+            previous = upper
+    except (IndexError, ValueError) as e:  # rendering stops at the first error of the path data (SVG 1.1 F.2)
+        logger.warning("path data error after %d tokens (%r), the rest of the path is left out: %.40s", position, e,
+                       d)
+    subpaths.append(current)
+    return [np.array(cubics, dtype=float) for cubics in subpaths if cubics]
+
+
+def flatten_cubics(cubics: np.ndarray, tolerance: float) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Points along cubic Bezier curves (n x 8, see Cubic), all of them at once: every curve is cut into as many equal
+    parameter steps as Wang's formula needs for the polyline to stay within `tolerance` of it (lines stay a single
+    step). The start points of the curves are left out, their end points are exact.
+    return: xs, ys, number of points of every curve
+    """
+    p0, p1, p2, p3 = cubics[:, 0:2], cubics[:, 2:4], cubics[:, 4:6], cubics[:, 6:8]
+    second_differences = np.maximum(np.hypot(*(p0 - 2 * p1 + p2).T), np.hypot(*(p1 - 2 * p2 + p3).T))
+    counts = np.maximum(np.ceil(np.sqrt(0.75 * second_differences / tolerance)), 1).astype(np.int64)
+    curve = np.repeat(np.arange(len(cubics)), counts)
+    t = (_local_indices(counts) + 1) / counts[curve]
+    s = 1 - t
+    weights = (s ** 3, 3 * s ** 2 * t, 3 * s * t ** 2, t ** 3)
+    xs = sum(weight * cubics[curve, 2 * k] for k, weight in enumerate(weights))
+    ys = sum(weight * cubics[curve, 2 * k + 1] for k, weight in enumerate(weights))
+    ends = np.cumsum(counts) - 1
+    xs[ends], ys[ends] = cubics[:, 6], cubics[:, 7]
+    return xs, ys, counts
+
+
+def _element_path(element: ElementTree.Element, tag: str) -> typing.Optional[str]:
+    """path data of an element, basic shapes converted (rectangles without rounded corners)"""
+    def value(name: str) -> float:
+        return float(element.get(name, 0))
+
+    if tag == 'path':
+        return element.get('d')
+    if tag == 'line':
+        return f"M{value('x1')},{value('y1')} L{value('x2')},{value('y2')}"
+    if tag in ('polyline', 'polygon'):
+        points = element.get('points', '').strip()
+        return f"M{points}" + ("Z" if tag == 'polygon' else "") if points else None
+    if tag == 'rect':
+        return f"M{value('x')},{value('y')} h{value('width')} v{value('height')} h{-value('width')} Z"
+    if tag in ('circle', 'ellipse'):
+        rx, ry = (value('r'), value('r')) if tag == 'circle' else (value('rx'), value('ry'))
+        cx, cy = value('cx'), value('cy')
+        return f"M{cx + rx},{cy} A{rx},{ry} 0 1 1 {cx - rx},{cy} A{rx},{ry} 0 1 1 {cx + rx},{cy} Z"
+    return None
+
+
+def _hidden(element: ElementTree.Element) -> bool:
+    style = element.get('style', '').replace(' ', '')
+    return element.get('display') == 'none' or 'display:none' in style
+
+
+def _viewport_transform(root: ElementTree.Element) -> np.ndarray:
+    """user units of the document -> mm, y upwards from the bottom of the page (the way gcodetools places it)"""
+    width, height = parse_length(root.get('width')), parse_length(root.get('height'))
+    view_box = [float(value) for value in _NUMBER_PATTERN.findall(root.get('viewBox', ''))]
+    if len(view_box) == 4 and view_box[2] > 0 and view_box[3] > 0:
+        min_x, min_y, box_width, box_height = view_box
+        width = width if width is not None else box_width * _UNITS['px']
+        height = height if height is not None else box_height * _UNITS['px']
+        sx, sy = width / box_width, height / box_height
+        offset_x = offset_y = 0.0
+        if root.get('preserveAspectRatio', '').split()[:1] != ['none']:  # xMidYMid meet
+            sx = sy = min(sx, sy)
+            offset_x, offset_y = (width - box_width * sx) / 2, (height - box_height * sy) / 2
+        viewport = np.array([[sx, 0, offset_x - min_x * sx], [0, sy, offset_y - min_y * sy], [0, 0, 1]])
+    else:
+        viewport = np.diag([_UNITS['px'], _UNITS['px'], 1.0])
+        height = height if height is not None else 0.0
+    return np.array([[1, 0, 0], [0, -1, height], [0, 0, 1]]) @ viewport
+
+
+def svg_subpaths(filename: str, tolerance: float = SVG_TOLERANCE) -> typing.List[np.ndarray]:
+    """the subpaths of the drawn elements of an SVG file in document order, as cubic curves (see parse_path) in mm,
+    transforms applied. Arcs are approximated within half of `tolerance`, leaving the other half to flattening."""
+    subpaths = []
+
+    def visit(element: ElementTree.Element, transform: np.ndarray):
+        tag = element.tag.rsplit('}', 1)[-1]
+        if tag in _NOT_RENDERED or _hidden(element):
+            return
+        transform = transform @ parse_transform(element.get('transform'))
+        d = _element_path(element, tag)
+        if d:
+            scale = math.hypot(*transform[:2, :2].ravel())  # at least as much as a length is stretched
+            for cubics in parse_path(d, tolerance / 2 / scale if scale > 0 else math.inf):
+                points = cubics.reshape(-1, 2) @ transform[:2, :2].T + transform[:2, 2]
+                subpaths.append(points.reshape(-1, 8))
+        elif tag == 'use':
+            logger.debug("<use> elements are not drawn")
+        for child in element:
+            visit(child, transform)
+
+    root = ElementTree.parse(filename).getroot()
+    visit(root, _viewport_transform(root))
+    return subpaths
+
+
+def flatten_subpaths(subpaths: typing.Sequence[np.ndarray], tolerance: float = SVG_TOLERANCE) \
+        -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """the subpaths as polylines, flattened together (see flatten_cubics)
+    return: xs, ys of the points of all polylines, indices of the first point of every polyline"""
+    if not subpaths:
+        return np.empty(0), np.empty(0), np.empty(0, dtype=np.int64)
+    cubics = np.concatenate(subpaths)
+    xs, ys, counts = flatten_cubics(cubics, tolerance / 2)
+    first_cubics = np.cumsum([0] + [len(cubics) for cubics in subpaths[:-1]])
+    first_points = np.concatenate(([0], np.cumsum(counts)))[first_cubics]  # in xs, ys without the start points
+    xs = np.insert(xs, first_points, cubics[first_cubics, 0])
+    ys = np.insert(ys, first_points, cubics[first_cubics, 1])
+    return xs, ys, first_points + np.arange(len(subpaths))
+
+
+def polyline_segments(xs: np.ndarray, ys: np.ndarray, starts: np.ndarray, feed: float = 0.0) -> np.ndarray:
+    """Segments (rows of `Segment` fields) drawing the polylines the way gcodetools writes them: the pen is lifted
+    (RAPID at PEN_UP_Z), travels to the start of the polyline, is lowered there (LINE at PEN_DOWN_Z) and draws it
+    with LINE segments at `feed`; at the end the pen is lifted."""
+    if len(xs) == 0:
+        return np.empty((0, len(Segment._fields)))
+    is_start = np.zeros(len(xs), dtype=bool)
+    is_start[starts] = True
+    rows = np.where(is_start, 3, 1)
+    rows[0] = 2  # no lift before the first polyline
+    ends = np.cumsum(rows) - 1
+    segments = np.zeros((ends[-1] + 2, len(Segment._fields)))  # and the lift at the end
+    kind, x0, y0, x1, y1, z, feeds = (segments[:, k] for k in (0, 1, 2, 3, 4, 5, 8))
+    feeds[:] = feed
+
+    previous = np.maximum(np.arange(len(xs)) - 1, 0)
+    kind[ends] = LINE  # plunge at the start point, or draw to the point
+    z[ends] = PEN_DOWN_Z
+    x0[ends] = np.where(is_start, xs, xs[previous])
+    y0[ends] = np.where(is_start, ys, ys[previous])
+    x1[ends], y1[ends] = xs, ys
+    # travels to the starts, lifts at the ends of the polylines (a rapid's start point is its end point)
+    for rapids, at in ((ends[starts] - 1, starts), (ends[starts[1:]] - 2, starts[1:] - 1),
+                       ([len(segments) - 1], [len(xs) - 1])):
+        kind[rapids] = RAPID
+        z[rapids] = PEN_UP_Z
+        x0[rapids] = x1[rapids] = xs[at]
+        y0[rapids] = y1[rapids] = ys[at]
+    return segments
+
+
+def svg_segments(filename: str, tolerance: float = SVG_TOLERANCE, feed: float = 0.0) -> np.ndarray:
+    """Segments (rows of `Segment` fields, see MotionProgram) drawing the paths and basic shapes of an SVG file,
+    curves flattened within `tolerance` mm, no G-code written in between. Coordinates are in mm with y upwards from
+    the bottom of the page, as gcodetools converts the drawing.
+    feed: mm/min of the drawing moves, 0: the speed of the DrawingProcess
+    """
+    xs, ys, starts = flatten_subpaths(svg_subpaths(filename, tolerance), tolerance)
+    logger.debug("%s: %d polylines, %d points", filename, len(starts), len(xs))
+    return polyline_segments(xs, ys, starts, feed)
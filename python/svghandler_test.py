@@ -0,0 +1,153 @@
+import math
+import os
+import tempfile
+import time
+import unittest
+
+from drawing_process import *
+from plotter_simulator import *
+from svghandler import *
+
+
+def write_svg(directory: str, body: str, attributes: str = 'width="80mm" height="80mm" viewBox="0 0 80 80"') -> str:
+    filename = os.path.join(directory, "drawing.svg")
+    with open(filename, "w") as f:
+        f.write(f'<svg xmlns="http://www.w3.org/2000/svg" {attributes}>{body}</svg>')
+    return filename
+
+
+def polylines(segments: np.ndarray) -> typing.List[typing.List[typing.Tuple[float, float]]]:
+    """the pen-down paths of the segments"""
+    result = []
+    for kind, x0, y0, x1, y1, z in segments[:, :6].tolist():
+        if kind == RAPID:
+            continue
+        if (x0, y0) == (x1, y1):  # the pen is lowered
+            result.append([(x1, y1)])
+        else:
+            result[-1].append((x1, y1))
+    return result
+
+
+class PathDataTest(unittest.TestCase):
+    def test_relative_and_absolute_commands(self):
+        absolute = parse_path("M10,10 L20,10 H30 V20 Z M50 50 L60 60")
+        relative = parse_path("m10 10 l10 0 h10 v10 z m40 40 10 10")
+        self.assertEqual(2, len(absolute))
+        np.testing.assert_allclose(absolute[0], relative[0])
+        np.testing.assert_allclose(absolute[1], relative[1])
+        self.assertEqual([(10, 10), (20, 10), (30, 10), (30, 20), (10, 10)],
+                         [tuple(absolute[0][0, :2])] + [tuple(cubic[6:]) for cubic in absolute[0]])
+
+    def test_smooth_curves_reflect_the_control_point(self):
+        cubic, smooth = parse_path("M0,0 C0,10 10,10 10,0 S20,-10 20,0")[0]
+        self.assertEqual((10, 0, 10, -10, 20, -10, 20, 0), tuple(smooth))
+        quadratic, smooth = parse_path("M0,0 Q5,10 10,0 T20,0")[0]
+        np.testing.assert_allclose([10, 0, 10 + 10 / 3, -20 / 3, 20 - 10 / 3, -20 / 3, 20, 0], smooth)
+
+    def test_arc_flags_written_together(self):
+        np.testing.assert_allclose(parse_path("M0,0 a10,10 0 0 1 10,10")[0], parse_path("M0,0a10,10 0 0110,10")[0])
+
+    def test_arcs_approximated_within_tolerance(self):
+        cubics = parse_path("M100,0 A100,100 0 1 1 -100,0 A100,100 0 1 1 100,0", tolerance=0.001)[0]
+        t = np.linspace(0, 1, 11)[:, None]
+        xs = sum(w * cubics[:, 2 * k] for k, w in enumerate(((1 - t) ** 3, 3 * (1 - t) ** 2 * t,
+                                                              3 * (1 - t) * t ** 2, t ** 3)))
+        ys = sum(w * cubics[:, 2 * k + 1] for k, w in enumerate(((1 - t) ** 3, 3 * (1 - t) ** 2 * t,
+                                                                  3 * (1 - t) * t ** 2, t ** 3)))
+        self.assertLess(np.abs(np.hypot(xs, ys) - 100).max(), 0.001)
+
+    def test_errors_end_the_path(self):
+        with self.assertLogs('svghandler', 'WARNING'):
+            subpaths = parse_path("M0,0 L10,0 L20")
+        self.assertEqual([(10, 0)], [tuple(cubic[6:]) for cubic in subpaths[0]])
+
+    def test_transforms(self):
+        matrix = parse_transform("translate(10, 5) scale(2)")
+        self.assertEqual([12, 7, 1], (matrix @ [1, 1, 1]).tolist())
+        np.testing.assert_allclose([10, 20, 1], parse_transform("rotate(90 10 10)") @ [20, 10, 1], atol=1e-12)
+        np.testing.assert_allclose(np.eye(3), parse_transform(None))
+
+
+class FlattenTest(unittest.TestCase):
+    def test_circle_within_tolerance(self):
+        cubics = parse_path("M50,0 A50,50 0 1 1 -50,0 A50,50 0 1 1 50,0", tolerance=0.0001)[0]
+        for tolerance in (0.1, 0.01):
+            xs, ys, counts = flatten_cubics(cubics, tolerance)
+            xs, ys = np.append(50, xs), np.append(0, ys)
+            middles = np.hypot((xs[1:] + xs[:-1]) / 2, (ys[1:] + ys[:-1]) / 2)
+            self.assertLess(np.abs(middles - 50).max(), tolerance)
+            self.assertGreater(np.abs(middles - 50).max(), tolerance / 10)  # not many more points than needed
+            self.assertEqual((50, 0), (xs[-1], ys[-1]))
+
+    def test_lines_not_subdivided(self):
+        xs, ys, counts = flatten_cubics(parse_path("M0,0 L10,0 L10,10")[0], 0.001)
+        self.assertEqual([1, 1], counts.tolist())
+        self.assertEqual([(10, 0), (10, 10)], list(zip(xs, ys)))
+
+
+class SvgFileTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.directory = tmp.name
+
+    def test_drawn_like_gcodetools(self):
+        filename = write_svg(self.directory, '<g transform="translate(10,10)"><path d="M0,0 h10 v10"/>'
+                                             '<rect x="20" y="0" width="5" height="5"/></g>')
+        segments = svg_segments(filename)
+        # mm, y upwards from the bottom of the page
+        self.assertEqual([[(10, 70), (20, 70), (20, 60)], [(30, 70), (35, 70), (35, 65), (30, 65), (30, 70)]],
+                         polylines(segments))
+        self.assertEqual([RAPID, LINE], segments[:2, 0].tolist())
+        self.assertEqual(RAPID, segments[-1, 0])
+        self.assertEqual(PEN_UP_Z, segments[-1, 5])
+
+        gcode = os.path.join(self.directory, "drawing.ngc")
+        with open(gcode, "w") as f:
+            f.write("G00 Z5\nG00 X10 Y70\nG01 Z-0.125\nG01 X20 Y70\nG01 X20 Y60\nG00 Z5\nG00 X30 Y70\n"
+                    "G01 Z-0.125\nG01 X35 Y70\nG01 X35 Y65\nG01 X30 Y65\nG01 X30 Y70\nG00 Z5\n")
+        svg_points = read_program(filename).points(0.5)
+        gcode_points = read_program(gcode).points(0.5)
+        np.testing.assert_allclose(gcode_points.xy, svg_points.xy)
+        self.assertEqual(np.sign(gcode_points.z).tolist(), np.sign(svg_points.z).tolist())
+
+    def test_document_units(self):
+        filename = write_svg(self.directory, '<path d="M0,0 L200,160"/>',
+                             'width="100mm" height="80mm" viewBox="0 0 200 160"')
+        self.assertEqual([[(0, 80), (100, 0)]], polylines(svg_segments(filename)))
+        filename = write_svg(self.directory, '<path d="M0,0 L96,0"/>', 'width="2in" height="1in"')
+        self.assertEqual([[(0, 25.4), (25.4, 25.4)]], polylines(svg_segments(filename)))
+
+    def test_hidden_elements_left_out(self):
+        filename = write_svg(self.directory, '<defs><path id="a" d="M0,0 L9,9"/></defs>'
+                                             '<g style="display:none"><path d="M0,0 L9,9"/></g>'
+                                             '<line x1="1" y1="2" x2="3" y2="4"/>')
+        self.assertEqual([[(1, 78), (3, 76)]], polylines(svg_segments(filename)))
+
+    def test_plotted_by_drawing_process(self):
+        filename = write_svg(self.directory, '<circle cx="40" cy="40" r="10"/><path d="M20,20 q10,-10 20,0"/>')
+        device = SimulatedPlotter()
+        process = DrawingProcess(PrinterCommander(connection=SimulatedSerial(device)), filename,
+                                 interpolation_resolution=1)
+        points = process.all_points()
+        process.run()
+        self.assertEqual(len(points), device.moves)
+        self.assertEqual(2, sum(1 for a, b in zip(points.z, points.z[1:]) if a > 0 > b))
+        self.assertGreater(len(points), 60)
+
+    def test_thousands_of_paths_at_job_start(self):
+        rnd = np.random.default_rng(0)
+        paths = "".join(f'<path transform="rotate({k % 90})" d="M{x:.3f},{y:.3f} '
+                        + " ".join("c" + " ".join(f"{v:.3f}" for v in rnd.uniform(-3, 3, 6)) for _ in range(10))
+                        + ' a3,2 20 0 1 4,4 q2,3 4,0 t4,0 z"/>'
+                        for k, (x, y) in enumerate(rnd.uniform(0, 70, (3000, 2))))
+        filename = write_svg(self.directory, paths)
+        start = time.perf_counter()
+        segments = svg_segments(filename)
+        self.assertLess(time.perf_counter() - start, 5)
+        self.assertEqual(3000, int(np.sum(segments[:, 0] == RAPID) - 1) // 2 + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
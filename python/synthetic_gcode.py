@@ -0,0 +1,85 @@
+"""Synthetic G-code for the benchmarks and the tests."""
+import math
+import random
+import typing
+
+_PEN_UP = "G00 Z5.000000"
+_PEN_DOWN = "G01 Z-0.125000 F100.0(Penetrate)"
+
+
+# --- synthetic G-code, every generator yields lines forever and stays inside [2, 76] mm and out of the far corner
+# of the 80x80 mm working area, where the arms can not reach or leave their angle limits (see preflight_check)
+
+_FAR_CORNER = (80., 80.)
+# mm, the points within 22 mm of the far corner fail the pre-flight check, a straight move between two points this
+# far from it (inside [2, 76] mm) stays farther away
+_CORNER_CLEARANCE = 30.
+
+
+def _within_reach(x: float, y: float, margin: float = 0.) -> bool:
+    """whether the point and the points within `margin` mm of it are far enough from the far corner"""
+    return math.hypot(_FAR_CORNER[0] - x, _FAR_CORNER[1] - y) >= _CORNER_CLEARANCE + margin
+
+
+def dense_arcs(seed: int = 0) -> typing.Iterator[str]:
+    """full circles of 0.5-5 mm radius, each drawn as eight G03 arcs"""
+    rnd = random.Random(seed)
+    while True:
+        r = rnd.uniform(.5, 5)
+        cx, cy = rnd.uniform(7, 71), rnd.uniform(7, 71)
+        if not _within_reach(cx, cy, r):
+            continue
+        yield _PEN_UP
+        yield f"G00 X{cx + r:.6f} Y{cy:.6f}"
+        yield _PEN_DOWN
+        for k in range(8):  # eighths of the circle
+            phi = (k + 1) * math.pi / 4
+            yield f"G03 X{cx + r * math.cos(phi):.6f} Y{cy + r * math.sin(phi):.6f} " \
+                  f"Z-0.125000 I{cx - (cx + r * math.cos(k * math.pi / 4)):.6f} " \
+                  f"J{cy - (cy + r * math.sin(k * math.pi / 4)):.6f} F400.000000"
+
+
+def long_polylines(seed: int = 0) -> typing.Iterator[str]:
+    """random walk of short G01 moves that never lifts the pen (the steps towards the far corner are not taken)"""
+    rnd = random.Random(seed)
+    x, y = 40., 40.
+    yield f"G00 X{x:.6f} Y{y:.6f}"
+    yield _PEN_DOWN
+    while True:
+        next_x = min(max(x + rnd.uniform(-1.5, 1.5), 2), 76)
+        next_y = min(max(y + rnd.uniform(-1.5, 1.5), 2), 76)
+        if not _within_reach(next_x, next_y):
+            continue
+        x, y = next_x, next_y
+        yield f"G01 X{x:.6f} Y{y:.6f} Z-0.125000 F400.000000"
+
+
+def pen_lifts(seed: int = 0) -> typing.Iterator[str]:
+    """many tiny two-segment strokes, each followed by a pen lift and a rapid"""
+    rnd = random.Random(seed)
+    while True:
+        x, y = rnd.uniform(2, 74), rnd.uniform(2, 74)
+        if not _within_reach(x + 2, y + 2):  # the corner of the strokes nearest to the far corner
+            continue
+        yield _PEN_UP
+        yield f"G00 X{x:.6f} Y{y:.6f}"
+        yield _PEN_DOWN
+        yield f"G01 X{x + rnd.uniform(0, 2):.6f} Y{y + rnd.uniform(0, 2):.6f} Z-0.125000 F400.000000"
+        yield f"G01 X{x + rnd.uniform(0, 2):.6f} Y{y + rnd.uniform(0, 2):.6f} Z-0.125000 F400.000000"
+
+
+def write_gcode(filename: str, lines: typing.Iterator[str], size_bytes: int) -> int:
+    """writes lines until the file reaches size_bytes, returns the number of lines written"""
+    written = 0
+    count = 0
+    with open(filename, "w") as f:
+        f.write("%\nG21 (All units in mm)\n")
+        for line in lines:
+            if written >= size_bytes:
+                break
+            f.write(line)
+            f.write("\n")
+            written += len(line) + 1
+            count += 1
+        f.write("M2\n%\n")
+    return count
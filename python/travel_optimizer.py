@@ -0,0 +1,309 @@
+import math
+import typing
+from collections import namedtuple, defaultdict
+
+import numpy as np
+
+from gcodehandler import *
+
+class TravelReport(namedtuple('TravelReport', ['strokes', 'chains', 'travel_before', 'travel_after',
+                                               'pen_lifts_before', 'pen_lifts_after'])):
+    __slots__ = ()
+
+    @property
+    def travel_saved(self) -> float:
+        return self.travel_before - self.travel_after
+
+Position = typing.Tuple[float, float]
+
+
+def segment_starts(segments: np.ndarray) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """start point of every segment (the end point of the previous one; a rapid's own end point for the first one)"""
+    xs = np.empty(len(segments))
+    ys = np.empty(len(segments))
+    if len(segments) > 0:
+        xs[0], ys[0] = segments[0, 1], segments[0, 2]
+        xs[1:], ys[1:] = segments[:-1, 3], segments[:-1, 4]
+    return xs, ys
+
+
+def is_drawing(segments: np.ndarray) -> np.ndarray:
+    """the pen is down (z < 0) while the segment is drawn"""
+    return segments[:, 5] < 0
+
+
+def split_strokes(segments: np.ndarray) -> typing.List[typing.Tuple[int, int]]:
+    """[start, end) row ranges of the maximal runs of drawing segments"""
+    drawing = np.concatenate(([False], is_drawing(segments), [False])).astype(np.int8)
+    edges = np.flatnonzero(np.diff(drawing))
+    return list(zip(edges[::2].tolist(), edges[1::2].tolist()))
+
+
+def pen_up_travel(segments: np.ndarray) -> typing.Tuple[float, int]:
+    """(XY distance moved with the pen up, number of pen lifts between strokes)"""
+    start_xs, start_ys = segment_starts(segments)
+    travel = ~is_drawing(segments)
+    distance = float(np.hypot(segments[travel, 3] - start_xs[travel], segments[travel, 4] - start_ys[travel]).sum())
+    return distance, max(len(split_strokes(segments)) - 1, 0)
+
+
+def reverse_segments(segments: np.ndarray, start_xs: np.ndarray, start_ys: np.ndarray) -> np.ndarray:
+    """the same path drawn backwards: rows in reverse order, each from its end point to its start point
+
+    Every row keeps its own z (constant within a stroke in practice).
+    """
+    kind, x0, y0, x1, y1, z, i, j, feed = segments.T
+    reversed_rows = np.column_stack((kind, x1, y1, start_xs, start_ys, z, x0 + i - x1, y0 + j - y1, feed))
+    reversed_rows[kind == ARC_CW, 0] = ARC_CCW
+    reversed_rows[kind == ARC_CCW, 0] = ARC_CW
+    rapid = kind == RAPID
+    reversed_rows[rapid, 1:3] = reversed_rows[rapid, 3:5]  # (x0, y0) of a rapid is its end point
+    reversed_rows[rapid, 6:8] = 0
+    return reversed_rows[::-1]
+
+
+class _EndpointGrid:
+    """Uniform grid of stroke chain end points for nearest neighbour queries.
+
+    Removed entries are dropped lazily; the grid is rebuilt with larger cells once most of its entries are gone,
+    so that queries stay cheap until the end of the tour.
+    """
+
+    def __init__(self, points: typing.Sequence[typing.Tuple[float, float, int, bool]]):
+        self.removed: typing.Set[int] = set()
+        self._build(points)
+
+    def _build(self, points):
+        self.points = [p for p in points if p[2] not in self.removed]
+        xs = [p[0] for p in self.points] or [0.0]
+        ys = [p[1] for p in self.points] or [0.0]
+        self.x_min, self.y_min = min(xs), min(ys)
+        width, height = max(xs) - self.x_min, max(ys) - self.y_min
+        n = max(len(self.points), 1)
+        # ~2 points per cell, also when the points are (almost) on a line
+        self.cell = max(math.sqrt(2 * width * height / n), 2 * max(width, height) / n, 1e-6)
+        self.cells: typing.Dict[typing.Tuple[int, int], list] = defaultdict(list)
+        for p in self.points:
+            self.cells[self._cell_of(p[0], p[1])].append(p)
+        self.alive_at_build = len(self.points)
+        self.alive = len(self.points)
+        self.size = self._cell_of(max(xs), max(ys))
+
+    def _cell_of(self, x: float, y: float) -> typing.Tuple[int, int]:
+        return int((x - self.x_min) // self.cell), int((y - self.y_min) // self.cell)
+
+    def remove(self, chain: int, count: int):
+        """removes the `count` end points of the chain"""
+        self.removed.add(chain)
+        self.alive -= count
+        if self.alive_at_build > 64 and self.alive < self.alive_at_build // 4:
+            self._build(self.points)
+
+    def nearest(self, x: float, y: float) -> typing.Optional[typing.Tuple[float, float, int, bool]]:
+        cx, cy = self._cell_of(x, y)
+        best, best_dist = None, math.inf
+        last_ring = max(abs(cx), abs(cy), abs(self.size[0] - cx), abs(self.size[1] - cy))
+        ring_limit = 2 * math.isqrt(self.alive) + 2  # rings of an almost empty area around a query far outside
+        ring = 0
+        while ring <= last_ring:
+            if best is not None and best_dist <= (ring - 1) * self.cell:
+                break  # every point in this ring and further out is farther away
+            if best is None and ring > ring_limit:
+                alive = (p for p in self.points if p[2] not in self.removed)
+                return min(alive, key=lambda p: math.hypot(p[0] - x, p[1] - y), default=None)
+            for key in self._ring(cx, cy, ring):
+                entries = self.cells.get(key)
+                if not entries:
+                    continue
+                entries[:] = [p for p in entries if p[2] not in self.removed]
+                for p in entries:
+                    dist = math.hypot(p[0] - x, p[1] - y)
+                    if dist < best_dist:
+                        best, best_dist = p, dist
+            ring += 1
+        return best
+
+    @staticmethod
+    def _ring(cx: int, cy: int, ring: int) -> typing.Iterator[typing.Tuple[int, int]]:
+        if ring == 0:
+            yield cx, cy
+            return
+        for dx in range(-ring, ring + 1):
+            yield cx + dx, cy - ring
+            yield cx + dx, cy + ring
+        for dy in range(-ring + 1, ring):
+            yield cx - ring, cy + dy
+            yield cx + ring, cy + dy
+
+
+def _chain_strokes(ends: np.ndarray, allow_reverse: bool,
+                   tolerance: float) -> typing.List[typing.List[typing.Tuple[int, bool]]]:
+    """Groups strokes into chains of (stroke, reversed) that continue where the previous one ended.
+
+    ends: start x, start y, end x, end y of every stroke (rows)
+    """
+    def key(x, y):
+        return round(x / tolerance), round(y / tolerance)
+
+    points = ends.tolist()
+    free_starts = defaultdict(list)  # stroke end points by grid cell of size `tolerance`
+    free_ends = defaultdict(list)
+    for stroke, (sx, sy, ex, ey) in enumerate(points):
+        free_starts[key(sx, sy)].append(stroke)
+        free_ends[key(ex, ey)].append(stroke)
+    used = [False] * len(points)
+
+    def take(table, x, y) -> typing.Optional[int]:
+        kx, ky = key(x, y)
+        for cell in ((kx + dx, ky + dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)):
+            candidates = table.get(cell)
+            while candidates and used[candidates[-1]]:
+                candidates.pop()
+            for stroke in candidates or ():
+                px, py = points[stroke][0:2] if table is free_starts else points[stroke][2:4]
+                if not used[stroke] and math.hypot(px - x, py - y) <= tolerance:
+                    used[stroke] = True
+                    return stroke
+        return None
+
+    def extend(chain, x, y):
+        """follows the chain from (x, y) as long as a stroke starts (or, if reversible, ends) there"""
+        while True:
+            stroke = take(free_starts, x, y)
+            if stroke is not None:
+                chain.append((stroke, False))
+                x, y = points[stroke][2:4]
+                continue
+            stroke = take(free_ends, x, y) if allow_reverse else None
+            if stroke is None:
+                return
+            chain.append((stroke, True))
+            x, y = points[stroke][0:2]
+
+    chains = []
+    for first in range(len(points)):
+        if used[first]:
+            continue
+        used[first] = True
+        chain = [(first, False)]
+        extend(chain, *points[first][2:4])
+        if allow_reverse:  # strokes ending at the start of the chain: extend backwards, then flip
+            before = []
+            extend(before, *points[first][0:2])
+            chain = [(stroke, not rev) for stroke, rev in reversed(before)] + chain
+        chains.append(chain)
+    return chains
+
+
+def _nearest_neighbour_tour(starts: np.ndarray, ends: np.ndarray, position: Position,
+                            allow_reverse: bool) -> typing.List[typing.Tuple[int, bool]]:
+    """visiting order of the chains (chain, reversed), always moving on to the closest free chain end"""
+    points = [(x, y, chain, False) for chain, (x, y) in enumerate(starts.tolist())]
+    if allow_reverse:
+        points += [(x, y, chain, True) for chain, (x, y) in enumerate(ends.tolist())]
+    grid = _EndpointGrid(points)
+    x, y = position
+    tour = []
+    for _ in range(len(starts)):
+        _, _, chain, reverse = grid.nearest(x, y)
+        grid.remove(chain, 2 if allow_reverse else 1)
+        tour.append((chain, reverse))
+        x, y = (starts if reverse else ends)[chain].tolist()
+    return tour
+
+
+def _two_opt(tour: typing.List[typing.Tuple[int, bool]], starts: np.ndarray, ends: np.ndarray,
+             position: Position, final_position: typing.Optional[Position],
+             window: int, max_passes: int) -> typing.List[typing.Tuple[int, bool]]:
+    """2-opt moves reversing at most `window` consecutive chains (each chain is drawn backwards afterwards)"""
+    n = len(tour)
+    if n < 2:
+        return tour
+    chain = np.array([c for c, _ in tour])
+    reverse = np.array([r for _, r in tour])
+    entry = np.where(reverse[:, None], ends[chain], starts[chain])  # where the pen goes down
+    exit_ = np.where(reverse[:, None], starts[chain], ends[chain])  # where it is lifted
+    # virtual last chain: the final position (weight 0 if the job may end anywhere)
+    entry = np.vstack((entry, [final_position if final_position is not None else (0.0, 0.0)]))
+    end_weight = 0.0 if final_position is None else 1.0
+
+    def dist(a, b):
+        return np.hypot(a[..., 0] - b[..., 0], a[..., 1] - b[..., 1])
+
+    for _ in range(max_passes):
+        improved = False
+        for i in range(n):
+            j = np.arange(i, min(i + window, n))
+            before = exit_[i - 1] if i > 0 else np.array(position)
+            weight = np.where(j + 1 == n, end_weight, 1.0)
+            old = dist(before, entry[i]) + weight * dist(exit_[j], entry[j + 1])
+            new = dist(before, exit_[j]) + weight * dist(entry[i], entry[j + 1])
+            best = int(np.argmax(old - new))
+            if old[best] - new[best] > 1e-9:
+                k = j[best]
+                entry[i:k + 1], exit_[i:k + 1] = exit_[i:k + 1][::-1].copy(), entry[i:k + 1][::-1].copy()
+                chain[i:k + 1] = chain[i:k + 1][::-1].copy()
+                reverse[i:k + 1] = ~reverse[i:k + 1][::-1]
+                improved = True
+        if not improved:
+            break
+    return list(zip(chain.tolist(), reverse.tolist()))
+
+
+def optimize_travel(program: MotionProgram,
+                    allow_reverse: bool = True,
+                    merge_tolerance: float = 0.001,
+                    two_opt_window: int = 32,
+                    two_opt_passes: int = 4) -> typing.Tuple[MotionProgram, TravelReport]:
+    """Reorders (and, if allowed, reverses) the pen-down strokes of the program to shorten the pen-up travel.
+
+    Strokes meeting within `merge_tolerance` mm are drawn one after the other without lifting the pen. The order is
+    built by nearest neighbour search on a grid of stroke end points, then improved with 2-opt moves of limited
+    length (2-opt needs reversible strokes), keeping the runtime near-linear in the number of strokes.
+    The head starts at the program's first point; if the program ends with pen-up travel, it still ends there.
+    """
+    segments = program.segments
+    travel_before, lifts_before = pen_up_travel(segments)
+    strokes = split_strokes(segments)
+    if not strokes:
+        return program, TravelReport(0, 0, travel_before, travel_before, lifts_before, lifts_before)
+
+    start_xs, start_ys = segment_starts(segments)
+    stroke_ends = np.array([(start_xs[a], start_ys[a], segments[b - 1, 3], segments[b - 1, 4]) for a, b in strokes])
+    position = (float(segments[0, 3]), float(segments[0, 4]))
+    final_position = None if is_drawing(segments[-1:]).any() else (float(segments[-1, 3]), float(segments[-1, 4]))
+    up_z = max(segments[~is_drawing(segments), 5].max(initial=0.0), 1.0)
+
+    chains = _chain_strokes(stroke_ends, allow_reverse, merge_tolerance)
+    chain_starts = np.array([stroke_ends[s, 2:4] if r else stroke_ends[s, 0:2] for s, r in (c[0] for c in chains)])
+    chain_ends = np.array([stroke_ends[s, 0:2] if r else stroke_ends[s, 2:4] for s, r in (c[-1] for c in chains)])
+    tour = _nearest_neighbour_tour(chain_starts, chain_ends, position, allow_reverse)
+    if allow_reverse:
+        tour = _two_opt(tour, chain_starts, chain_ends, position, final_position, two_opt_window, two_opt_passes)
+
+    pieces = [np.array([Segment(RAPID, *position, *position, up_z, 0.0, 0.0)], dtype=float)]
+    for chain_index, reverse_chain in tour:
+        chain = chains[chain_index]
+        if reverse_chain:
+            chain = [(stroke, not rev) for stroke, rev in reversed(chain)]
+        first_stroke, first_reversed = chain[0]
+        x, y = stroke_ends[first_stroke, 2:4] if first_reversed else stroke_ends[first_stroke, 0:2]
+        first_row = segments[strokes[first_stroke][1] - 1 if first_reversed else strokes[first_stroke][0]]
+        z, feed = first_row[5], first_row[8]
+        pieces.append(np.array([Segment(RAPID, *position, *position, up_z, 0.0, 0.0),
+                                Segment(RAPID, x, y, x, y, up_z, 0.0, 0.0),
+                                Segment(LINE, x, y, x, y, z, 0.0, 0.0, feed)], dtype=float))
+        for stroke, rev in chain:
+            a, b = strokes[stroke]
+            rows = segments[a:b]
+            if rev:
+                rows = reverse_segments(rows, start_xs[a:b], start_ys[a:b])
+            pieces.append(rows)
+        position = tuple(pieces[-1][-1, 3:5].tolist())
+    pieces.append(np.array([Segment(RAPID, *position, *position, up_z, 0.0, 0.0)], dtype=float))
+    if final_position is not None:
+        pieces.append(np.array([Segment(RAPID, *final_position, *final_position, up_z, 0.0, 0.0)], dtype=float))
+
+    optimized = MotionProgram(np.concatenate(pieces))
+    travel_after, lifts_after = pen_up_travel(optimized.segments)
+    return optimized, TravelReport(len(strokes), len(chains), travel_before, travel_after, lifts_before, lifts_after)
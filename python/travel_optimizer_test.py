@@ -0,0 +1,87 @@
+import collections
+import random
+import unittest
+
+from travel_optimizer import *
+
+
+def drawn_pieces(program: MotionProgram) -> typing.Counter[tuple]:
+    """pen-down segments of the program without direction: end points and arc center"""
+    segments = program.segments
+    start_xs, start_ys = segment_starts(segments)
+    pieces = collections.Counter()
+    for (kind, x0, y0, x1, y1, z, i, j, _), sx, sy in zip(segments.tolist(), start_xs.tolist(), start_ys.tolist()):
+        if z < 0 and (sx, sy) != (x1, y1):
+            center = (round(x0 + i, 6), round(y0 + j, 6)) if kind in (ARC_CW, ARC_CCW) else None
+            pieces[frozenset(((round(sx, 6), round(sy, 6)), (round(x1, 6), round(y1, 6)))), center] += 1
+    return pieces
+
+
+class OptimizeTravelTest(unittest.TestCase):
+    def program(self, strokes: typing.List[typing.List[str]]) -> MotionProgram:
+        lines = ["G00 X0 Y0 Z5\n"]
+        for stroke in strokes:
+            lines += [stroke[0], "G01 Z-1\n"] + stroke[1:] + ["G00 Z5\n"]
+        return MotionProgram.parse(lines + ["G00 X0 Y0\n"])
+
+    def test_reordered_and_reversed_strokes_draw_the_same(self):
+        program = self.program([
+            ["G00 X70 Y70\n", "G01 X60 Y70\n"],
+            ["G00 X10 Y0\n", "G01 X0 Y10\n"],
+            ["G00 X70 Y0\n", "G03 X60 Y10 I-10 J0\n"],
+            ["G00 X12 Y12\n", "G02 X30 Y30 I9 J9\n", "G01 X40 Y40\n"],
+        ])
+        optimized, report = optimize_travel(program)
+        self.assertLess(report.travel_after, report.travel_before)
+        self.assertAlmostEqual(report.travel_before - report.travel_after, report.travel_saved)
+        self.assertEqual((4, 3, 3), (report.strokes, report.pen_lifts_before, report.pen_lifts_after))
+        self.assertEqual(drawn_pieces(program), drawn_pieces(optimized))
+        self.assertEqual([0, 0, 5], optimized.segments[-1, [3, 4, 5]].tolist())  # still ends at home
+
+    def test_touching_strokes_merged_without_lifting(self):
+        program = self.program([
+            ["G00 X0 Y0\n", "G01 X10 Y0\n"],
+            ["G00 X20 Y10\n", "G01 X10 Y10\n"],  # continues the next one backwards
+            ["G00 X10 Y0\n", "G01 X10 Y10\n"],
+        ])
+        optimized, report = optimize_travel(program)
+        self.assertEqual((3, 1, 0), (report.strokes, report.chains, report.pen_lifts_after))
+        self.assertEqual(drawn_pieces(program), drawn_pieces(optimized))
+        self.assertAlmostEqual(math.hypot(20, 10), report.travel_after)
+
+    def test_strokes_keep_direction_unless_reversible(self):
+        program = self.program([
+            ["G00 X50 Y0\n", "G01 X0 Y0\n"],
+            ["G00 X50 Y10\n", "G01 X0 Y10\n"],
+        ])
+        optimized, _ = optimize_travel(program, allow_reverse=False)
+        drawing = optimized.segments[is_drawing(optimized.segments)]
+        lines = drawing[np.hypot(drawing[:, 3] - drawing[:, 1], drawing[:, 4] - drawing[:, 2]) > 0]
+        self.assertTrue((lines[:, 3] < lines[:, 1]).all())  # all still drawn right to left
+
+        _, report = optimize_travel(program)
+        self.assertLess(report.travel_after, optimize_travel(program, allow_reverse=False)[1].travel_after)
+
+    def test_reversed_arc_samples_the_same_points(self):
+        segments = np.array([Segment(ARC_CCW, 2, 0, 0, 2, -1, -2, 0, 600)], dtype=float)  # quarter circle
+        backwards = reverse_segments(segments, np.array([2.0]), np.array([0.0]))
+        self.assertEqual([ARC_CW, 0, 2, 2, 0, -1, 0, -2, 600], backwards[0].tolist())
+        xs, ys, _ = sample_segments(backwards, 0.1)
+        self.assertGreater(len(xs), 20)
+        self.assertTrue((xs >= -1e-9).all() and (ys >= -1e-9).all())  # not the long way round
+        np.testing.assert_allclose(2, np.hypot(xs, ys))
+
+    def test_many_strokes(self):
+        rnd = random.Random(1)
+        strokes = []
+        for _ in range(3000):
+            x, y = rnd.uniform(0, 75), rnd.uniform(0, 75)
+            strokes.append([f"G00 X{x} Y{y}\n", f"G01 X{x + 2} Y{y + 1}\n"])
+        program = self.program(strokes)
+        optimized, report = optimize_travel(program)
+        self.assertLess(report.travel_after, report.travel_before / 10)
+        self.assertEqual(drawn_pieces(program), drawn_pieces(optimized))
+
+
+if __name__ == '__main__':
+    unittest.main()